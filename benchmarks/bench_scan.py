@@ -0,0 +1,252 @@
+# coding: utf-8
+"""
+Scan benchmark: runs the real ocareport main() against the local fake OCI
+endpoint and records wall time, API calls and peak memory per scan mode.
+
+    python -m benchmarks.bench_scan                 # 40 regions x 3 ADs x 3 FDs
+    python -m benchmarks.bench_scan --quick         # small topology, for CI
+    python -m benchmarks.bench_scan --json bench.json
+
+Runs fully offline: the OCI config, API key and caches live in a temporary
+directory that is removed afterwards.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import ocareport
+from benchmarks.fake_oci import FakeOCI
+from modules.clients import ENDPOINT_TEMPLATE_ENV
+
+
+BENCH_SHAPE = 'VM.Standard.E4.Flex'
+
+# Stands for the rows of a fresh full sweep, written to a file before the scenario runs
+RESULTS_FILE = '{results}'
+
+# (name, description, extra arguments); run in this order, so 'warm' reuses
+# the topology cached by 'cold' and 'hedge' the latencies both recorded
+SCENARIOS = [
+    ('cold', 'full sweep, topology listed', ['-refresh-topology']),
+    ('warm', 'full sweep, cached topology', []),
+    ('hedge', 'full sweep with -hedge 5 (try --stall-rate)', ['-hedge', '5']),
+    ('first', 'stop at the first available location', ['-first', '1']),
+    ('multi-shape', '2 shapes x 2 configs in one sweep',
+     ['-shape', BENCH_SHAPE, 'VM.Standard3.Flex', '-ocpus', '1,2', '-memory', '16']),
+    ('probe', 'largest flex config per FD, 1-64 OCPUs',
+     ['-probe', '-ocpus', '1:64', '-memory', '16:1024:16']),
+    ('since', 'repeat check of a full sweep with -since',
+     ['-since', RESULTS_FILE]),
+    ('gpu', 'GPU shape offered in few regions, no catalog',
+     ['-shape', 'BM.GPU.H100.8']),
+    ('gpu-catalog', 'GPU shape with the -catalog pre-pass',
+     ['-shape', 'BM.GPU.H100.8', '-catalog']),
+    ('serial', 'one call at a time, topology listed',
+     ['-refresh-topology', '-workers', '1', '-region-workers', '1']),
+]
+
+
+def write_config(directory, server):
+    """
+    Write an OCI config file with a freshly generated API key for the fake tenancy.
+
+    Returns: path of the config file.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    key_path = os.path.join(directory, 'bench_key.pem')
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    public_der = key.public_key().public_bytes(serialization.Encoding.DER,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+    digest = hashlib.md5(public_der).hexdigest()
+    fingerprint = ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+    config_path = os.path.join(directory, 'config')
+    with open(config_path, 'w') as f:
+        f.write('[DEFAULT]\n'
+                'user=ocid1.user.oc1..aaaaaaaabenchmark\n'
+                f'fingerprint={fingerprint}\n'
+                f'tenancy={server.tenancy_id}\n'
+                f'region={server.home_region}\n'
+                f'key_file={key_path}\n')
+    return config_path
+
+
+@contextlib.contextmanager
+def fake_environment(server, directory):
+    """Point ocareport at the fake endpoint, with its caches in `directory`."""
+    saved = {name: os.environ.get(name) for name in (ENDPOINT_TEMPLATE_ENV, 'OCAREPORT_CACHE_DIR')}
+    os.environ[ENDPOINT_TEMPLATE_ENV] = server.endpoint_template
+    os.environ['OCAREPORT_CACHE_DIR'] = os.path.join(directory, 'cache')
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_main(argv):
+    """
+    Run ocareport.main() with the given arguments, capturing its output.
+
+    Returns: (exit code, stdout text)
+    """
+    stdout = io.StringIO()
+    saved_argv = sys.argv
+    sys.argv = ['ocareport.py'] + argv
+    code = 0
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            ocareport.main()
+    except SystemExit as e:
+        code = e.code
+    finally:
+        sys.argv = saved_argv
+    return code, stdout.getvalue()
+
+
+def run_scenario(server, base_argv, extra_argv, repeat):
+    """
+    Time a scan mode `repeat` times, then run it once more under tracemalloc.
+
+    Returns: dict with median wall time, API calls, rows and peak memory.
+    """
+    argv = base_argv + extra_argv
+    if '-shape' not in extra_argv:
+        argv += ['-shape', BENCH_SHAPE]
+
+    times, calls, rows = [], [], 0
+    for _ in range(repeat):
+        server.reset_stats()
+        start = time.perf_counter()
+        code, output = run_main(argv)
+        times.append(time.perf_counter() - start)
+        if code:
+            raise RuntimeError(f'ocareport exited with {code}: {" ".join(argv)}')
+        calls.append(server.stats())
+        rows = len(output.splitlines())
+
+    # Tracing slows allocations down, so memory is measured on a separate run
+    tracemalloc.start()
+    try:
+        run_main(argv)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    last = calls[-1]
+    return {
+        'wall_time_s': round(statistics.median(times), 3),
+        'wall_times_s': [round(t, 3) for t in times],
+        'api_calls': last['total'],
+        'calls_by_operation': {name: count for name, count in sorted(last.items()) if name != 'total'},
+        'rows': rows,
+        'peak_memory_mb': round(peak / 2 ** 20, 2),
+    }
+
+
+def run_benchmark(regions=40, ads=3, fds=3, latency=0.05, jitter=0.02, throttle_rate=0.0,
+                  error_rate=0.0, repeat=3, scenarios=None, seed=0, available_rate=0.3, stall_rate=0.0,
+                  stall=2.0):
+    """
+    Run the selected scan modes against a fresh fake endpoint.
+
+    Returns: dict with the setup and one result per scenario.
+    """
+    selected = [s for s in SCENARIOS if not scenarios or s[0] in scenarios]
+    results = {}
+    with FakeOCI(regions, ads, fds, latency, jitter, throttle_rate, error_rate, available_rate=available_rate,
+                 seed=seed, stall_rate=stall_rate, stall=stall) as server, \
+            tempfile.TemporaryDirectory(prefix='ocareport-bench-') as directory, \
+            fake_environment(server, directory):
+        config_path = write_config(directory, server)
+        base_argv = ['-auth', 'cf', '-config_file', config_path, '-region', 'all',
+                     '-format', 'jsonl']
+        for name, description, extra_argv in selected:
+            if RESULTS_FILE in extra_argv:
+                path = os.path.join(directory, 'results.jsonl')
+                with open(path, 'w') as f:
+                    f.write(run_main(base_argv + ['-shape', BENCH_SHAPE])[1])
+                extra_argv = [path if arg == RESULTS_FILE else arg for arg in extra_argv]
+            results[name] = dict(description=description,
+                                 **run_scenario(server, base_argv, extra_argv, repeat))
+    return {
+        'setup': {'regions': regions, 'ads': ads, 'fds': fds, 'latency_ms': latency * 1000,
+                  'jitter_ms': jitter * 1000, 'throttle_rate': throttle_rate,
+                  'error_rate': error_rate, 'available_rate': available_rate, 'stall_rate': stall_rate,
+                  'stall_s': stall, 'repeat': repeat, 'python': sys.version.split()[0]},
+        'scenarios': results,
+    }
+
+
+def format_report(report):
+    """Return the benchmark results as a text table."""
+    setup = report['setup']
+    lines = [
+        f"ocareport scan benchmark - {setup['regions']} regions x {setup['ads']} ADs x {setup['fds']} FDs, "
+        f"latency {setup['latency_ms']:g}+/-{setup['jitter_ms']:g} ms, "
+        f"429 rate {setup['throttle_rate']:g}, 5xx rate {setup['error_rate']:g}, "
+        f"available rate {setup['available_rate']:g}, "
+        f"stall rate {setup['stall_rate']:g} ({setup['stall_s']:g} s), "
+        f"median of {setup['repeat']}",
+        '',
+        f"{'SCENARIO':<12} {'WALL (s)':>9} {'API CALLS':>10} {'ROWS':>6} {'PEAK MEM (MB)':>14}  DESCRIPTION",
+    ]
+    for name, result in report['scenarios'].items():
+        lines.append(f"{name:<12} {result['wall_time_s']:>9.3f} {result['api_calls']:>10} "
+                     f"{result['rows']:>6} {result['peak_memory_mb']:>14.2f}  {result['description']}")
+    return '\n'.join(lines)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ocareport scans against a local fake OCI endpoint')
+    parser.add_argument('--regions', type=int, default=40, help='Number of subscribed regions')
+    parser.add_argument('--ads', type=int, default=3, help='Availability domains per region')
+    parser.add_argument('--fds', type=int, default=3, help='Fault domains per availability domain')
+    parser.add_argument('--latency', type=float, default=50, help='Mean latency per call (ms)')
+    parser.add_argument('--jitter', type=float, default=20, help='Latency jitter (+/- ms)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of scan calls answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of scan calls answered with 500')
+    parser.add_argument('--available-rate', type=float, default=0.3, help='Share of FDs with free capacity')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='Share of capacity reports that stall')
+    parser.add_argument('--stall', type=float, default=2, help='Extra latency of a stalled capacity report (s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per scenario')
+    parser.add_argument('--scenario', nargs='+', choices=[s[0] for s in SCENARIOS], help='Scenarios to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='Small topology and a single run (CI)')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results as JSON')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.regions, args.repeat, args.latency, args.jitter = 6, 1, 10, 5
+    return args
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    report = run_benchmark(args.regions, args.ads, args.fds, args.latency / 1000, args.jitter / 1000,
+                           args.throttle_rate, args.error_rate, args.repeat, args.scenario, args.seed,
+                           args.available_rate, args.stall_rate, args.stall)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
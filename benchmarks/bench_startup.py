@@ -0,0 +1,121 @@
+# coding: utf-8
+"""
+Startup benchmark: wall time of short ocareport commands in fresh
+interpreters, against a bare `python -c pass`, plus the slowest imports.
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --repeat 20 --json startup.json
+
+Nothing here touches OCI: the commands only print help or fail argument
+validation, which is what a user waits for before any API call.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, description, interpreter arguments); 'python' is the baseline
+COMMANDS = [
+    ('python', 'bare interpreter', ['-c', 'pass']),
+    ('help', 'ocareport.py --help', ['ocareport.py', '--help']),
+    ('query-help', 'ocareport.py query --help', ['ocareport.py', 'query', '--help']),
+    ('bad-args', 'argument error (-first -1)', ['ocareport.py', '-shape', 'X', '-first', '-1']),
+    ('import', 'import ocareport', ['-c', 'import ocareport']),
+    ('import-all', 'import ocareport and every module', ['-c', 'import ocareport, modules.scanner, '
+                                                              'modules.service, modules.watch, modules.probe']),
+]
+
+
+def time_command(arguments, repeat):
+    """Run `python arguments` `repeat` times. Returns: median wall time (s)"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + arguments, cwd=ROOT, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest_imports(arguments, count=10):
+    """
+    Run `python -X importtime arguments` once.
+
+    Returns: list of (module, cumulative ms) of the `count` slowest top-level imports
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, cwd=ROOT,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nesting shown by indentation
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name[1:].startswith(' '):
+            imports.append((name.strip(), int(cumulative) / 1000))
+    return sorted(imports, key=lambda item: -item[1])[:count]
+
+
+def run_benchmark(repeat=10, commands=None):
+    """Time every command. Returns: report dict"""
+    results = {}
+    for name, description, arguments in COMMANDS:
+        if commands and name not in commands and name != 'python':
+            continue
+        results[name] = {
+            'description': description,
+            'wall_time_s': round(time_command(arguments, repeat), 4),
+        }
+    baseline = results['python']['wall_time_s']
+    for result in results.values():
+        result['overhead_s'] = round(result['wall_time_s'] - baseline, 4)
+    return {
+        'setup': {'python': sys.version.split()[0], 'repeat': repeat},
+        'commands': results,
+        'slowest_imports': [{'module': name, 'cumulative_ms': round(ms, 1)}
+                            for name, ms in slowest_imports(['ocareport.py', '--help'])],
+    }
+
+
+def format_report(report):
+    """Return the benchmark results as a text table."""
+    setup = report['setup']
+    lines = [
+        f"ocareport startup benchmark - Python {setup['python']}, median of {setup['repeat']}",
+        '',
+        f"{'COMMAND':<12} {'WALL (s)':>9} {'OVER PYTHON (s)':>16}  DESCRIPTION",
+    ]
+    for name, result in report['commands'].items():
+        lines.append(f"{name:<12} {result['wall_time_s']:>9.3f} {result['overhead_s']:>16.3f}  "
+                     f"{result['description']}")
+    lines += ['', 'Slowest imports of ocareport.py --help (cumulative ms):']
+    lines += [f"  {item['cumulative_ms']:>8.1f}  {item['module']}" for item in report['slowest_imports']]
+    return '\n'.join(lines)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ocareport startup time')
+    parser.add_argument('--repeat', type=int, default=10, help='Runs per command')
+    parser.add_argument('--command', nargs='+', choices=[c[0] for c in COMMANDS], help='Commands to run')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results as JSON')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    report = run_benchmark(args.repeat, args.command)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+# coding: utf-8
+"""
+Local stand-in for the OCI Identity and Compute capacity-report APIs.
+
+Serves the calls a scan makes - tenancy, region subscriptions, availability
+and fault domains, capacity reports - for a synthetic tenancy of any size,
+with configurable latency, jitter and error rates. The free capacity of each
+location is derived from a seed, so every run of a benchmark sees the same
+answers, and larger configs never fit where smaller ones do not.
+
+Point ocareport at it with:
+
+    OCAREPORT_ENDPOINT_TEMPLATE=http://127.0.0.1:PORT/{region}
+
+Run standalone with `python -m benchmarks.fake_oci --port 8080`.
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# Real region identifiers, used in order; larger topologies get synthetic names
+REGION_NAMES = [
+    'us-ashburn-1', 'us-phoenix-1', 'us-sanjose-1', 'us-chicago-1', 'ca-toronto-1',
+    'ca-montreal-1', 'sa-saopaulo-1', 'sa-vinhedo-1', 'sa-santiago-1', 'sa-valparaiso-1',
+    'sa-bogota-1', 'mx-queretaro-1', 'mx-monterrey-1', 'uk-london-1', 'uk-cardiff-1',
+    'eu-frankfurt-1', 'eu-amsterdam-1', 'eu-zurich-1', 'eu-milan-1', 'eu-stockholm-1',
+    'eu-marseille-1', 'eu-paris-1', 'eu-madrid-1', 'eu-jovanovac-1', 'il-jerusalem-1',
+    'me-jeddah-1', 'me-dubai-1', 'me-abudhabi-1', 'me-riyadh-1', 'af-johannesburg-1',
+    'ap-mumbai-1', 'ap-hyderabad-1', 'ap-singapore-1', 'ap-singapore-2', 'ap-tokyo-1',
+    'ap-osaka-1', 'ap-seoul-1', 'ap-chuncheon-1', 'ap-sydney-1', 'ap-melbourne-1',
+    'ap-batam-1',
+]
+
+# Shapes of the fake catalog; GPU shapes are only offered in some regions
+STANDARD_SHAPES = [
+    'VM.Standard.E4.Flex', 'VM.Standard.E5.Flex', 'VM.Standard3.Flex', 'VM.Optimized3.Flex',
+    'VM.Standard.A1.Flex', 'VM.Standard2.1', 'VM.Standard2.2', 'BM.Standard.E4.128', 'BM.Standard.E5.192',
+]
+GPU_SHAPES = [
+    'VM.GPU.A10.1', 'VM.GPU.A10.2', 'BM.GPU.A10.4', 'BM.GPU4.8', 'BM.GPU.A100-v2.8',
+    'BM.GPU.H100.8', 'BM.GPU.L40S.4',
+]
+
+# API version prefix the SDK appends to every endpoint
+BASE_PATH = '/20160918'
+
+# Operations that can be failed on purpose; authentication and region
+# subscriptions always answer, so every run gets as far as its scan
+FAULTY_OPERATIONS = {'ListAvailabilityDomains', 'ListFaultDomains', 'ListShapes', 'CreateComputeCapacityReport'}
+
+
+def region_names(count):
+    """Return `count` region names, real ones first."""
+    names = REGION_NAMES[:count]
+    names += [f'xx-region{n}-1' for n in range(len(names) + 1, count + 1)]
+    return names
+
+
+class FakeTopology:
+    """Regions, ADs and FDs of the synthetic tenancy, plus its capacity answers."""
+
+    def __init__(self, regions=40, ads=3, fds=3, available_rate=0.3, gpu_rate=0.25, seed=0):
+        self.tenancy_id = 'ocid1.tenancy.oc1..aaaaaaaabenchmark'
+        self.available_rate = available_rate
+        self.seed = seed
+        self.regions = {}
+        for n, name in enumerate(region_names(regions)):
+            ad_names = [f'Bnch:{name.upper()}-AD-{i}' for i in range(1, ads + 1)]
+            has_gpus = random.Random(f'{seed}|{name}|gpu').random() < gpu_rate
+            self.regions[name] = {
+                'key': name.split('-')[1][:3].upper(),
+                'home': n == 0,
+                'ads': {ad: [f'FAULT-DOMAIN-{i}' for i in range(1, fds + 1)] for ad in ad_names},
+                'shapes': STANDARD_SHAPES + (GPU_SHAPES if has_gpus else []),
+            }
+
+    @property
+    def home_region(self):
+        return next(name for name, region in self.regions.items() if region['home'])
+
+    def free_capacity(self, region, ad, fd, shape):
+        """
+        Deterministic free capacity of a shape in one location.
+
+        Returns: (free OCPUs, free memory GB), or None without capacity.
+        """
+        rng = random.Random(f'{self.seed}|{region}|{ad}|{fd}|{shape}')
+        if rng.random() >= self.available_rate:
+            return None
+        free_ocpus = rng.randint(1, 128)
+        return free_ocpus, free_ocpus * rng.choice([8, 16, 32, 64])
+
+    def status(self, region, ad, fd, shape, config):
+        """Capacity status of a shape config: AVAILABLE if it fits the free capacity."""
+        if shape not in self.regions[region]['shapes']:
+            return 'HARDWARE_NOT_SUPPORTED'
+        free = self.free_capacity(region, ad, fd, shape)
+        if free is None:
+            return 'OUT_OF_HOST_CAPACITY'
+        ocpus = (config or {}).get('ocpus') or 0
+        memory = (config or {}).get('memoryInGBs') or 0
+        fits = ocpus <= free[0] and memory <= free[1]
+        return 'AVAILABLE' if fits else 'OUT_OF_HOST_CAPACITY'
+
+
+class ApiError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeOCIHandler(BaseHTTPRequestHandler):
+    """Routes /{region}/20160918/... requests to the FakeOCI server."""
+
+    # Keep-alive, like the real endpoints, so client session reuse is measured
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        ('GET', re.compile(r'/tenancies/([^/]+)$'), 'GetTenancy'),
+        ('GET', re.compile(r'/tenancies/([^/]+)/regionSubscriptions$'), 'ListRegionSubscriptions'),
+        ('GET', re.compile(r'/regions$'), 'ListRegions'),
+        ('GET', re.compile(r'/availabilityDomains$'), 'ListAvailabilityDomains'),
+        ('GET', re.compile(r'/faultDomains$'), 'ListFaultDomains'),
+        ('GET', re.compile(r'/shapes$'), 'ListShapes'),
+        ('POST', re.compile(r'/computeCapacityReports$'), 'CreateComputeCapacityReport'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def handle_api(self, method):
+        server = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null') if length else None
+        url = urlsplit(self.path)
+
+        if url.path == '/_stats':
+            return self.respond(200, server.stats())
+
+        try:
+            region, operation, match = self.route(method, url.path)
+            server.delay(region, operation)
+            server.count(operation)
+            if self.headers.get('Authorization') is None:
+                raise ApiError(401, 'NotAuthenticated', 'The required information to complete authentication was not provided.')
+            if operation in server.failing:
+                raise ApiError(500, 'InternalServerError', 'Internal server error')
+            if operation in FAULTY_OPERATIONS:
+                server.inject_error()
+            handler = getattr(server, operation)
+            self.respond(200, handler(region, match, parse_qs(url.query), body))
+        except ApiError as e:
+            self.respond(e.status, {'code': e.code, 'message': e.message})
+
+    def route(self, method, path):
+        parts = path.split('/', 2)
+        if len(parts) < 3 or not ('/' + parts[2]).startswith(BASE_PATH + '/'):
+            raise ApiError(404, 'NotFound', f'Unknown path {path}')
+        region = parts[1]
+        resource = ('/' + parts[2])[len(BASE_PATH):]
+        for route_method, pattern, operation in self.ROUTES:
+            match = pattern.match(resource)
+            if match and route_method == method:
+                return region, operation, match
+        raise ApiError(404, 'NotFound', f'Unknown path {path}')
+
+    def respond(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('opc-request-id', uuid.uuid4().hex)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeOCIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # A scan opens many connections at once; the default backlog of 5 makes
+    # the kernel drop SYNs, which shows up as 1s connect stalls
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out hang up before the answer is written
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeOCI:
+    """
+    Threaded HTTP server answering like the OCI APIs for a FakeTopology.
+
+    Every request waits `latency` +/- `jitter` seconds, plus the extra seconds
+    of its region in `slow_regions`. A `stall_rate` share of capacity reports
+    waits `stall` more seconds, as calls to a region sometimes hang. Scan calls fail with 429 at
+    `throttle_rate` and with 500 at `error_rate`; operations named in `failing`
+    always fail with 500. Calls are counted per operation; see stats(). Use as a context manager or start()/stop().
+    """
+
+    def __init__(self, regions=40, ads=3, fds=3, latency=0.0, jitter=0.0,
+                 throttle_rate=0.0, error_rate=0.0, available_rate=0.3, gpu_rate=0.25, seed=0,
+                 host='127.0.0.1', port=0, stall_rate=0.0, stall=0.0):
+        self.topology = FakeTopology(regions, ads, fds, available_rate, gpu_rate, seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.slow_regions = {}
+        self.failing = set()
+        self.calls = Counter()
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd = FakeOCIServer((host, port), FakeOCIHandler)
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def endpoint_template(self):
+        """Value for $OCAREPORT_ENDPOINT_TEMPLATE."""
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/{{region}}'
+
+    @property
+    def tenancy_id(self):
+        return self.topology.tenancy_id
+
+    @property
+    def home_region(self):
+        return self.topology.home_region
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        """Returns: dict of call counts per operation, plus 'total'."""
+        with self._lock:
+            stats = dict(self.calls)
+        stats['total'] = sum(count for name, count in stats.items()
+                             if name not in ('throttled', 'server_errors', 'stalled'))
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+
+    def count(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+
+    def delay(self, region=None, operation=None):
+        wait_time = self.slow_regions.get(region, 0.0)
+        if self.latency or self.jitter:
+            with self._lock:
+                wait_time += self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if self.stall_rate and operation == 'CreateComputeCapacityReport':
+            with self._lock:
+                if self.rng.random() < self.stall_rate:
+                    self.calls['stalled'] += 1
+                    wait_time += self.stall
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def inject_error(self):
+        with self._lock:
+            draw = self.rng.random()
+            if draw < self.throttle_rate:
+                self.calls['throttled'] += 1
+                raise ApiError(429, 'TooManyRequests', 'Too many requests for the tenancy')
+            if draw < self.throttle_rate + self.error_rate:
+                self.calls['server_errors'] += 1
+                raise ApiError(500, 'InternalServerError', 'Internal server error')
+
+    def _region(self, region):
+        if region not in self.topology.regions:
+            raise ApiError(404, 'NotAuthorizedOrNotFound', f'Region {region} is not subscribed')
+        return self.topology.regions[region]
+
+    # API operations: (region, path match, query, body) -> JSON response
+
+    def GetTenancy(self, region, match, query, body):
+        # Suffixed OCIDs (e.g. ...benchmark2) stand for more tenancies with the same topology
+        if not match.group(1).startswith(self.tenancy_id):
+            raise ApiError(404, 'NotAuthorizedOrNotFound', 'Tenancy not found')
+        suffix = match.group(1)[len(self.tenancy_id):]
+        return {'id': match.group(1), 'name': 'benchmark' + suffix, 'description': 'ocareport benchmark tenancy',
+                'homeRegionKey': self.topology.regions[self.home_region]['key']}
+
+    def ListRegionSubscriptions(self, region, match, query, body):
+        return [{'regionKey': r['key'], 'regionName': name, 'status': 'READY', 'isHomeRegion': r['home']}
+                for name, r in self.topology.regions.items()]
+
+    def ListRegions(self, region, match, query, body):
+        return [{'key': r['key'], 'name': name} for name, r in self.topology.regions.items()]
+
+    def ListAvailabilityDomains(self, region, match, query, body):
+        compartment_id = query.get('compartmentId', [''])[0]
+        return [{'name': ad, 'id': f'ocid1.availabilitydomain.oc1..{n}', 'compartmentId': compartment_id}
+                for n, ad in enumerate(self._region(region)['ads'])]
+
+    def ListFaultDomains(self, region, match, query, body):
+        compartment_id = query.get('compartmentId', [''])[0]
+        ad = query.get('availabilityDomain', [''])[0]
+        fds = self._region(region)['ads'].get(ad)
+        if fds is None:
+            raise ApiError(400, 'InvalidParameter', f'Invalid availability domain {ad}')
+        return [{'name': fd, 'id': f'ocid1.faultdomain.oc1..{n}', 'compartmentId': compartment_id,
+                 'availabilityDomain': ad} for n, fd in enumerate(fds)]
+
+    def ListShapes(self, region, match, query, body):
+        return [{'shape': shape, 'processorDescription': 'benchmark'} for shape in self._region(region)['shapes']]
+
+    def CreateComputeCapacityReport(self, region, match, query, body):
+        body = body or {}
+        ad = body.get('availabilityDomain')
+        fds = self._region(region)['ads'].get(ad)
+        if fds is None:
+            raise ApiError(400, 'InvalidParameter', f'Invalid availability domain {ad}')
+        answers = []
+        for entry in body.get('shapeAvailabilities') or []:
+            fd = entry.get('faultDomain')
+            if fd is not None and fd not in fds:
+                raise ApiError(400, 'InvalidParameter', f'Invalid fault domain {fd}')
+            if entry.get('instanceShape') not in STANDARD_SHAPES + GPU_SHAPES:
+                raise ApiError(400, 'InvalidParameter', f"Invalid shape {entry.get('instanceShape')}")
+            status = self.topology.status(region, ad, fd, entry.get('instanceShape'),
+                                          entry.get('instanceShapeConfig'))
+            answers.append({
+                'faultDomain': fd,
+                'instanceShape': entry.get('instanceShape'),
+                'instanceShapeConfig': entry.get('instanceShapeConfig'),
+                'availableCount': 1 if status == 'AVAILABLE' else 0,
+                'availabilityStatus': status,
+            })
+        return {'compartmentId': body.get('compartmentId'), 'availabilityDomain': ad,
+                'shapeAvailabilities': answers, 'timeCreated': '2024-01-01T00:00:00.000Z'}
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for the OCI capacity report APIs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--regions', type=int, default=40, help='Number of subscribed regions')
+    parser.add_argument('--ads', type=int, default=3, help='Availability domains per region')
+    parser.add_argument('--fds', type=int, default=3, help='Fault domains per availability domain')
+    parser.add_argument('--latency', type=float, default=50, help='Mean latency per call (ms)')
+    parser.add_argument('--jitter', type=float, default=20, help='Latency jitter (+/- ms)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of scan calls answered with 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of scan calls answered with 500')
+    parser.add_argument('--available-rate', type=float, default=0.3, help='Share of AVAILABLE locations')
+    parser.add_argument('--gpu-rate', type=float, default=0.25, help='Share of regions offering GPU shapes')
+    parser.add_argument('--slow-region', nargs='+', default=[], metavar='REGION=SECONDS',
+                        help='Extra latency of every call to these regions, e.g. us-phoenix-1=30')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='Share of capacity reports that stall')
+    parser.add_argument('--stall', type=float, default=5, help='Extra latency of a stalled capacity report (s)')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    server = FakeOCI(args.regions, args.ads, args.fds, args.latency / 1000, args.jitter / 1000,
+                     args.throttle_rate, args.error_rate, args.available_rate, args.gpu_rate,
+                     args.seed, args.host, args.port, args.stall_rate, args.stall)
+    for value in args.slow_region:
+        region, _, seconds = value.partition('=')
+        server.slow_regions[region] = float(seconds)
+    print(f'Fake OCI endpoint: OCAREPORT_ENDPOINT_TEMPLATE={server.endpoint_template}')
+    print(f'Tenancy: {server.tenancy_id}, home region: {server.home_region}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+# coding: utf-8
+"""Python API: capacity scans of one tenancy, without any terminal output."""
+
+import threading
+
+import oci
+
+from modules.cache import TopologyCache
+from modules.catalog import load_catalogs
+from modules.clients import ClientPool
+from modules.identity import init_authentication, list_region_subscriptions, select_regions
+from modules.options import DEFAULT_REGION_WORKERS, DEFAULT_TOPOLOGY_TTL, DEFAULT_WORKERS
+from modules.ratelimit import RateLimiter
+from modules.scanner import build_queries, iter_capacity, prioritize_regions, take_available
+
+
+class CapacityScanner:
+    """
+    Capacity scans of one tenancy, reusable across calls.
+
+    The clients (and their signer), the topology cache, the region
+    subscriptions and the rate limiter live as long as the scanner, so
+    repeated scans only pay for their capacity report calls. Nothing is
+    printed and nobody is prompted: failures are raised as exceptions.
+    Safe to use from several threads. With a Hedger (see modules.hedge),
+    slow capacity reports get a duplicate.
+
+        scanner = CapacityScanner.login(profile='DEFAULT')
+        for result in scanner.scan(['BM.GPU.H100.8'], region='all'):
+            print(result.region, result.fault_domain, result.status)
+    """
+
+    def __init__(self, clients, tenancy_id, name=None, topology=None, limiter=None,
+                 workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS, hedger=None):
+        self.clients = clients
+        self.tenancy_id = tenancy_id
+        self.name = name or tenancy_id
+        self.topology = topology
+        self.limiter = limiter or RateLimiter(max_concurrency=region_workers)
+        self.workers = workers
+        self.region_workers = region_workers
+        self.hedger = hedger
+        self._subscriptions = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_login(cls, login, metrics=None, timeout=None, topology_ttl=DEFAULT_TOPOLOGY_TTL,
+                   refresh_topology=False, **options):
+        """
+        Build a scanner from the result of init_authentication().
+
+        Retries are left to the rate limiter, so the clients get none of
+        their own; `timeout` is the SDK (connect, read) timeout of every call.
+        With `topology_ttl` 0, the topology is not cached on disk.
+        Returns: CapacityScanner
+        """
+        config, signer, tenancy, _, _, tenancy_id = login
+        client_kwargs = {'timeout': timeout} if timeout else {}
+        clients = ClientPool(config, signer, metrics=metrics, retry_strategy=oci.retry.NoneRetryStrategy(),
+                             **client_kwargs)
+        topology = TopologyCache(tenancy_id, ttl=topology_ttl, refresh=refresh_topology) if topology_ttl else None
+        return cls(clients, tenancy_id, tenancy.name, topology, **options)
+
+    @classmethod
+    def login(cls, auth='', config_file='~/.oci/config', profile='DEFAULT', trust=False, parallel=False,
+              cache_signer=False, **options):
+        """
+        Authenticate as the CLI does ('cs', 'cf', 'ip' or '' for the first that works).
+
+        With `cache_signer`, CloudShell and Instance Principals reuse the
+        security token of an earlier login while valid (see modules.tokens).
+
+        `options` are passed to from_login() and the constructor.
+        Returns: CapacityScanner
+        Raises: AuthenticationError if no method works
+        """
+        login = init_authentication(auth, config_file, profile, trust=trust, parallel=parallel, quiet=True,
+                                    cache_signer=cache_signer)
+        return cls.from_login(login, **options)
+
+    def regions(self, region='', priority=None):
+        """
+        Return the regions to scan: '' (home), 'all' or a region name.
+
+        Subscriptions are listed once per scanner (or read from the topology
+        cache); regions named in `priority` come first.
+        Returns: list of RegionSubscription
+        Raises: ValueError if the region is not subscribed or does not exist
+        """
+        with self._lock:
+            if self._subscriptions is None:
+                self._subscriptions = list_region_subscriptions(
+                    self.clients.identity(), self.tenancy_id, self.topology, quiet=True,
+                    limiter=self.limiter, region_name=self.clients.home_region)
+        return prioritize_regions(select_regions(self.clients.identity(), self._subscriptions, region), priority)
+
+    def catalogs(self, regions, deadline=None, on_error=None):
+        """
+        Return the shape catalog of every region; `deadline` and `on_error`
+        work as in modules.catalog.load_catalogs().
+
+        Returns: {region_name: set of shape names, or None if unknown}
+        """
+        return load_catalogs(self.clients, self.tenancy_id, regions, self.workers, self.region_workers,
+                             self.topology, self.limiter, deadline, on_error)
+
+    def iter_scan(self, queries, regions, catalogs=None, plan=None, deadline=None, on_error=None):
+        """
+        Scan a list of ShapeQuery in the given regions; with a RescanPlan,
+        only what it leaves open (see modules.incremental).
+
+        `deadline` and `on_error` work as in modules.scanner.iter_capacity().
+        Yields: (order, CapacityResult) in completion order; `order` sorts
+        into region/AD/FD/query order.
+        """
+        if plan is not None:
+            from modules.incremental import iter_rescan
+            return iter_rescan(self.clients, self.tenancy_id, regions, queries, plan, self.workers,
+                               self.region_workers, topology=self.topology, limiter=self.limiter,
+                               catalogs=catalogs, deadline=deadline, on_error=on_error, hedger=self.hedger)
+        return iter_capacity(self.clients, self.tenancy_id, regions, queries, self.workers, self.region_workers,
+                             topology=self.topology, limiter=self.limiter, catalogs=catalogs,
+                             deadline=deadline, on_error=on_error, hedger=self.hedger)
+
+    def iter_probe(self, shapes, ocpus, memories, regions, catalogs=None, deadline=None, on_error=None):
+        """
+        Search the largest available config of flex shapes, as modules.probe.probe_capacity().
+
+        Yields: (order, CapacityResult) per FD as each AD finishes
+        """
+        from modules.probe import probe_capacity
+        return probe_capacity(self.clients, self.tenancy_id, regions, shapes, sorted(ocpus), sorted(memories),
+                              self.workers, self.region_workers, topology=self.topology, limiter=self.limiter,
+                              catalogs=catalogs, deadline=deadline, on_error=on_error, hedger=self.hedger)
+
+    def iter_units(self, units, deadline=None, on_error=None):
+        """
+        Run (position, WorkUnit) pairs of a plan (see modules.shard), without topology listing.
+
+        Yields: ((position,), CapacityResult) in completion order
+        """
+        from modules.shard import iter_units
+        return iter_units(self.clients, self.tenancy_id, units, self.workers, self.region_workers,
+                          limiter=self.limiter, deadline=deadline, on_error=on_error, hedger=self.hedger)
+
+    def scan(self, shapes, ocpus=(1,), memories=(1,), region='', priority=None, catalog=False, first=0,
+             deadline=None, on_error=None):
+        """
+        Check shapes (flex ones at every ocpus x memories config) in the selected regions.
+
+        With `catalog`, regions that do not offer a shape answer
+        HARDWARE_NOT_SUPPORTED without capacity report calls. With `first`,
+        the scan stops after that many AVAILABLE rows.
+        Yields: CapacityResult as each capacity report answers
+        """
+        regions = self.regions(region, priority)
+        catalogs = self.catalogs(regions) if catalog else None
+        results = self.iter_scan(build_queries(shapes, sorted(ocpus), sorted(memories)), regions, catalogs,
+                                 deadline=deadline, on_error=on_error)
+        if first:
+            results = take_available(results, first)
+        try:
+            for _, result in results:
+                yield result
+        finally:
+            results.close()
+            self.save()
+
+    def probe(self, shapes, ocpus, memories, region='', priority=None, catalog=False, deadline=None,
+              on_error=None):
+        """
+        Find the largest available config of flex shapes in every fault domain
+        of the selected regions, among the candidate `ocpus` and `memories`.
+
+        Yields: CapacityResult per FD as each AD finishes
+        """
+        regions = self.regions(region, priority)
+        catalogs = self.catalogs(regions) if catalog else None
+        results = self.iter_probe(shapes, ocpus, memories, regions, catalogs, deadline, on_error)
+        try:
+            for _, result in results:
+                yield result
+        finally:
+            results.close()
+            self.save()
+
+    def save(self):
+        """Write the topology cache to disk, if there is one."""
+        if self.topology is not None:
+            self.topology.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
@@ -0,0 +1,180 @@
+# coding: utf-8
+"""On-disk caches for OCI data that rarely changes between runs."""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from modules.options import DEFAULT_TOPOLOGY_TTL
+
+CACHE_VERSION = 1
+
+
+def cache_dir():
+    """
+    Return the cache directory.
+
+    Uses $OCAREPORT_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/ocareport
+    (default: ~/.cache/ocareport).
+    """
+    path = os.environ.get('OCAREPORT_CACHE_DIR')
+    if not path:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(base, 'ocareport')
+    return path
+
+
+def read_json(path):
+    """Load a JSON cache file. Returns: dict, or None if missing or unreadable."""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def write_json_atomic(path, data):
+    """
+    Write a JSON cache file atomically.
+
+    The data is written to a temporary file in the same directory and renamed
+    over the target, so readers never see a partial file. The file is only
+    readable by the current user.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _auth_cache_key(config_file_path, config_profile):
+    return f'{os.path.abspath(os.path.expanduser(config_file_path))}|{config_profile}'
+
+
+def read_auth_hint(config_file_path, config_profile):
+    """
+    Return the last successful authentication for a config file/profile.
+
+    Returns: dict with method, tenancy_id, tenancy_name, home_region_key; or None.
+    """
+    data = read_json(os.path.join(cache_dir(), 'auth.json')) or {}
+    hint = data.get(_auth_cache_key(config_file_path, config_profile))
+    return hint if isinstance(hint, dict) and hint.get('method') else None
+
+
+def write_auth_hint(config_file_path, config_profile, method, tenancy):
+    """Remember the authentication method and tenancy details that worked. Write errors are not fatal."""
+    path = os.path.join(cache_dir(), 'auth.json')
+    data = read_json(path) or {}
+    data[_auth_cache_key(config_file_path, config_profile)] = {
+        'method': method,
+        'tenancy_id': tenancy.id,
+        'tenancy_name': tenancy.name,
+        'home_region_key': tenancy.home_region_key,
+        'saved_at': time.time(),
+    }
+    try:
+        write_json_atomic(path, data)
+    except OSError:
+        pass
+
+
+class TopologyCache:
+    """
+    Region subscriptions, availability domains, fault domains and shape
+    catalogs of one tenancy.
+
+    Entries older than `ttl` seconds are treated as missing; with `refresh`
+    every lookup misses, so the topology is re-listed and the file rewritten.
+    Updates and save() are locked, so concurrent scans can share one cache.
+    """
+
+    def __init__(self, tenancy_id, ttl=DEFAULT_TOPOLOGY_TTL, refresh=False, path=None):
+        self.tenancy_id = tenancy_id
+        self.ttl = ttl
+        self.refresh = refresh
+        self.path = path or os.path.join(cache_dir(), f'topology-{tenancy_id}.json')
+        self.dirty = False
+        self._lock = threading.Lock()
+
+        data = read_json(self.path)
+        if not data or data.get('version') != CACHE_VERSION or data.get('tenancy_id') != tenancy_id:
+            data = {'version': CACHE_VERSION, 'tenancy_id': tenancy_id,
+                    'regions': None, 'availability_domains': {}, 'fault_domains': {}, 'shapes': {}}
+        data.setdefault('shapes', {})
+        self.data = data
+
+    def _fresh(self, entry):
+        """Return the cached items if the entry is present and within its TTL."""
+        if self.refresh or not entry:
+            return None
+        if time.time() - entry.get('fetched_at', 0) > self.ttl:
+            return None
+        return entry.get('items')
+
+    def _set(self, section, key, items):
+        """Store a fresh entry under data[section][key] (data[key] without a section)."""
+        entries = self.data[section] if section else self.data
+        with self._lock:
+            self.dirty = True
+            entries[key] = {'fetched_at': time.time(), 'items': items}
+
+    def regions(self):
+        """Returns: list of RegionSubscription, or None on a cache miss."""
+        items = self._fresh(self.data.get('regions'))
+        if items is None:
+            return None
+        # The SDK is only needed on a hit; importing it here keeps this module light
+        from oci.identity.models import RegionSubscription
+        return [RegionSubscription(**item) for item in items]
+
+    def set_regions(self, regions):
+        self._set(None, 'regions', [
+            {'region_key': r.region_key, 'region_name': r.region_name,
+             'status': r.status, 'is_home_region': r.is_home_region}
+            for r in regions
+        ])
+
+    def availability_domains(self, region_name):
+        """Returns: list of AD names, or None on a cache miss."""
+        return self._fresh(self.data['availability_domains'].get(region_name))
+
+    def set_availability_domains(self, region_name, ads):
+        self._set('availability_domains', region_name, list(ads))
+
+    def fault_domains(self, region_name, availability_domain):
+        """Returns: list of FD names, or None on a cache miss."""
+        return self._fresh(self.data['fault_domains'].get(f'{region_name}/{availability_domain}'))
+
+    def set_fault_domains(self, region_name, availability_domain, fds):
+        self._set('fault_domains', f'{region_name}/{availability_domain}', list(fds))
+
+    def shapes(self, region_name):
+        """Returns: list of shape names offered in the region, or None on a cache miss."""
+        return self._fresh(self.data['shapes'].get(region_name))
+
+    def set_shapes(self, region_name, shapes):
+        self._set('shapes', region_name, list(shapes))
+
+    def save(self):
+        """Persist the cache if anything changed. Write errors are not fatal."""
+        with self._lock:
+            if not self.dirty:
+                return
+            try:
+                write_json_atomic(self.path, self.data)
+                self.dirty = False
+            except OSError:
+                pass
@@ -0,0 +1,86 @@
+# coding: utf-8
+"""Shape catalog pre-pass: which regions offer which compute shapes."""
+
+import difflib
+from concurrent.futures import wait
+
+from modules.clients import list_all_pages
+from modules.ratelimit import RateLimiter
+from modules.scanner import DEFAULT_WORKERS, DEFAULT_REGION_WORKERS, DaemonThreadPool, time_left
+
+
+def get_shapes(compute_client, compartment_id):
+    """Get the names of the compute shapes offered to a compartment in the client's region."""
+    shapes = list_all_pages(compute_client.list_shapes, compartment_id)
+    return sorted({shape.shape for shape in shapes})
+
+
+def load_catalogs(clients, tenancy_id, regions, workers=DEFAULT_WORKERS,
+                  region_workers=DEFAULT_REGION_WORKERS, topology=None, limiter=None,
+                  deadline=None, on_error=None):
+    """
+    Fetch the shape catalog of every region, one list_shapes call per region.
+
+    With a TopologyCache, fresh catalogs are taken from it and fetched ones
+    are stored back. With `on_error`, a failed call is passed to it and the
+    region's catalog is None (unknown: the region is scanned in full), as
+    are the catalogs still unanswered at the time.monotonic() `deadline`.
+    Returns: {region_name: set of shape names, or None}
+    Raises: the error of a failed call, without `on_error`
+    """
+    in_region = (limiter or RateLimiter(max_concurrency=region_workers)).call
+    catalogs = {}
+    missing = []
+    for region in regions:
+        cached = topology.shapes(region.region_name) if topology else None
+        if cached is not None:
+            catalogs[region.region_name] = set(cached)
+        else:
+            missing.append(region.region_name)
+
+    if missing:
+        pool = DaemonThreadPool(workers)
+        try:
+            futures = {
+                name: pool.submit(in_region, name, get_shapes, clients.compute(name), tenancy_id)
+                for name in missing
+            }
+            wait(futures.values(), timeout=time_left(deadline))
+            for name, future in futures.items():
+                if not future.done():
+                    future.cancel()
+                    catalogs[name] = None
+                    continue
+                try:
+                    shapes = future.result()
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(e)
+                    catalogs[name] = None
+                    continue
+                if topology:
+                    topology.set_shapes(name, shapes)
+                catalogs[name] = set(shapes)
+        finally:
+            pool.shutdown()
+    return catalogs
+
+
+def unknown_shapes(shapes, catalogs):
+    """
+    Return the shapes no catalog offers, each with close matches of known names.
+
+    Nothing is returned while a catalog is unknown (None): its region may
+    offer any shape.
+    Returns: list of (shape, [suggestions])
+    """
+    if any(names is None for names in catalogs.values()):
+        return []
+    known = set().union(*catalogs.values()) if catalogs else set()
+    # Suggestions ignore case, so 'vm.standard.e4.flex' finds its proper spelling
+    by_lower = {name.lower(): name for name in sorted(known)}
+    return [
+        (shape, [by_lower[match] for match in difflib.get_close_matches(shape.lower(), by_lower, n=3, cutoff=0.6)])
+        for shape in shapes if shape not in known
+    ]
@@ -0,0 +1,105 @@
+# coding: utf-8
+"""Per-region OCI client pool."""
+
+import os
+import threading
+from types import MappingProxyType
+
+import oci
+
+
+# Endpoint template of a local API stand-in, e.g. http://127.0.0.1:8080/{region}
+ENDPOINT_TEMPLATE_ENV = 'OCAREPORT_ENDPOINT_TEMPLATE'
+
+
+def endpoint_kwargs(region):
+    """
+    Return the client kwargs that point a region's clients at the endpoint
+    given by $OCAREPORT_ENDPOINT_TEMPLATE; empty when it is not set.
+    """
+    template = os.environ.get(ENDPOINT_TEMPLATE_ENV)
+    if not template:
+        return {}
+    return {'service_endpoint': template.format(region=region)}
+
+
+def list_all_pages(list_func, *args, **kwargs):
+    """
+    Call a paginated list operation and follow its next pages.
+
+    Unlike oci.pagination.list_call_get_all_results(), no retry strategy is
+    added to the calls: the client's own applies (none for pooled clients),
+    so throttling and failures reach the caller's RateLimiter at once.
+    Returns: list of items of every page
+    """
+    items = []
+    page = None
+    while True:
+        response = list_func(*args, page=page, **kwargs) if page else list_func(*args, **kwargs)
+        items.extend(response.data)
+        page = response.next_page
+        if not page:
+            return items
+
+
+class ClientPool:
+    """
+    OCI service clients per region, built once and reused.
+
+    Each region gets a read-only copy of the base config, so clients never
+    share mutable state, and each client keeps its HTTP session (and its
+    keep-alive connections) for the life of the pool. With `metrics`, every
+    HTTP call of the pooled clients is recorded. Safe to use from several
+    threads.
+    """
+
+    CLIENT_TYPES = {
+        'identity': lambda: oci.identity.IdentityClient,
+        'compute': lambda: oci.core.ComputeClient,
+    }
+
+    def __init__(self, config, signer, metrics=None, **client_kwargs):
+        self.base_config = MappingProxyType(dict(config))
+        self.signer = signer
+        self.metrics = metrics
+        self.client_kwargs = client_kwargs
+        self._configs = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def home_region(self):
+        """Region of the authentication config."""
+        return self.base_config.get('region')
+
+    def config(self, region):
+        """Return the read-only config for a region."""
+        with self._lock:
+            if region not in self._configs:
+                self._configs[region] = MappingProxyType(dict(self.base_config, region=region))
+            return self._configs[region]
+
+    def get(self, kind, region):
+        """Return the client of the given kind ('identity', 'compute') for a region."""
+        key = (kind, region)
+        client = self._clients.get(key)
+        if client is None:
+            region_config = self.config(region)
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client_class = self.CLIENT_TYPES[kind]()
+                    kwargs = dict(endpoint_kwargs(region), **self.client_kwargs)
+                    client = client_class(config=dict(region_config), signer=self.signer, **kwargs)
+                    if self.metrics is not None:
+                        client.base_client.session.hooks['response'].append(self.metrics.response_hook(region))
+                    self._clients[key] = client
+        return client
+
+    def identity(self, region=None):
+        """Return the IdentityClient for a region (default: home region)."""
+        return self.get('identity', region or self.home_region)
+
+    def compute(self, region=None):
+        """Return the ComputeClient for a region (default: home region)."""
+        return self.get('compute', region or self.home_region)
@@ -0,0 +1,182 @@
+# coding: utf-8
+"""Dry-run estimates: the API calls and wall time of a scan, before sending any capacity report."""
+
+import math
+from collections import Counter, namedtuple
+from functools import partial
+
+from modules.options import DEFAULT_RATE, DEFAULT_REGION_WORKERS, DEFAULT_WORKERS
+from modules.scanner import DEFAULT_BATCH_SIZE
+
+# Operations of a scan, named as modules.metrics records them
+LIST_AVAILABILITY_DOMAINS = 'GET availabilityDomains'
+LIST_FAULT_DOMAINS = 'GET faultDomains'
+LIST_SHAPES = 'GET shapes'
+CAPACITY_REPORT = 'POST computeCapacityReports'
+
+# Seconds assumed for a call no earlier run has recorded a latency for
+DEFAULT_LATENCY = 0.3
+
+# One way to run a scan: its name, calls per operation, estimated wall time
+# (seconds) and a short explanation
+Estimate = namedtuple('Estimate', ['strategy', 'calls', 'seconds', 'note'])
+
+
+def call_latency(latencies, region_name, operation):
+    """
+    Latency of one call: the p50 recorded for the region and operation,
+    else the median of the operation's p50 in other regions, else DEFAULT_LATENCY.
+
+    `latencies` comes from modules.metrics.read_latencies().
+    Returns: seconds
+    """
+    entry = latencies.get((region_name, operation))
+    if entry:
+        return entry['p50']
+    others = sorted(entry['p50'] for (_, name), entry in latencies.items() if name == operation)
+    return others[len(others) // 2] if others else DEFAULT_LATENCY
+
+
+def region_calls(queries, locations, offered=None, list_topology=False, list_catalog=False,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Count the calls a scan sends to one region.
+
+    `locations` is the region's [(availability_domain, [fault_domain, ...])];
+    with `offered` (shape names of its catalog), other shapes cost nothing.
+    Capacity reports batch the FDs x configs of one AD, as the scanner does.
+    Returns: Counter {operation: calls}
+    """
+    calls = Counter()
+    if list_catalog:
+        calls[LIST_SHAPES] += 1
+    checked = [query for query in queries if offered is None or query.shape in offered]
+    if list_topology and checked:
+        calls[LIST_AVAILABILITY_DOMAINS] += 1
+        calls[LIST_FAULT_DOMAINS] += len(locations)
+    for _, fds in locations if checked else []:
+        calls[CAPACITY_REPORT] += math.ceil(len(fds) * len(checked) / batch_size)
+    return calls
+
+
+def region_seconds(calls, latency, region_workers=DEFAULT_REGION_WORKERS, rate=DEFAULT_RATE):
+    """
+    Wall time of one region: the catalog, the AD listing and the FD listings
+    one round after another, then the capacity reports `region_workers` at
+    a time and no faster than `rate` per second.
+
+    `latency(operation)` returns the seconds of one call.
+    Returns: seconds
+    """
+    seconds = 0.0
+    for operation in (LIST_SHAPES, LIST_AVAILABILITY_DOMAINS, LIST_FAULT_DOMAINS):
+        if calls.get(operation):
+            seconds += latency(operation) * math.ceil(calls[operation] / region_workers)
+    reports = calls.get(CAPACITY_REPORT, 0)
+    if reports:
+        # The limiter starts with a burst of `rate` tokens
+        seconds += max(math.ceil(reports / region_workers) * latency(CAPACITY_REPORT),
+                       max(0, reports - max(1.0, rate)) / rate)
+    return seconds
+
+
+def scan_seconds(per_region, latencies, workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+                 rate=DEFAULT_RATE):
+    """
+    Wall time of a scan: regions run side by side, so it takes as long as its
+    slowest region, unless the `workers` shared by all regions are the bottleneck.
+
+    Returns: seconds
+    """
+    slowest = busy = 0.0
+    for name, calls in per_region.items():
+        latency = partial(call_latency, latencies, name)
+        slowest = max(slowest, region_seconds(calls, latency, region_workers, rate))
+        busy += sum(count * latency(operation) for operation, count in calls.items())
+    return max(slowest, busy / workers)
+
+
+def yield_order(regions, availability):
+    """
+    Order regions by the share of their recorded checks that were AVAILABLE;
+    regions without history keep their place after the others.
+
+    Returns: list of region names
+    """
+    names = [region.region_name for region in regions]
+    return sorted(names, key=lambda name: (name not in availability, -availability.get(name, 0.0)))
+
+
+def _first_regions(order, expected, first):
+    """Regions scanned, in `order`, until `first` AVAILABLE rows are expected. Returns: list of names"""
+    scanned, found = [], 0.0
+    for name in order:
+        if found >= first:
+            break
+        scanned.append(name)
+        found += expected.get(name, 0.0)
+    return scanned
+
+
+def estimate_scan(regions, queries, locations, latencies=None, catalogs=None, catalog=False, first=0,
+                  availability=None, list_topology=False, workers=DEFAULT_WORKERS,
+                  region_workers=DEFAULT_REGION_WORKERS, rate=DEFAULT_RATE, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Estimate the ways to run a scan of one tenancy.
+
+    `locations` comes from modules.shard.list_locations(); `catalogs` are the
+    shape catalogs known so far ({region_name: set of names or None}), used by
+    the scan with `catalog` and otherwise priced as the -catalog alternative.
+    With `list_topology`, the scan lists ADs and FDs again. `availability`
+    ({region_name: 0..1}, from the history) prices `first` in the given and
+    in the high-yield region order.
+    Returns: list of Estimate, the scan as given first
+    """
+    latencies = latencies or {}
+    catalogs = catalogs or {}
+
+    def price(strategy, list_catalog, use_catalog, names, note):
+        per_region = {
+            name: region_calls(queries, locations.get(name, []),
+                               catalogs.get(name) if use_catalog else None, list_topology,
+                               list_catalog and catalogs.get(name) is None, batch_size)
+            for name in names
+        }
+        calls = sum(per_region.values(), Counter())
+        return Estimate(strategy, calls, scan_seconds(per_region, latencies, workers, region_workers, rate), note)
+
+    names = [region.region_name for region in regions]
+    estimates = [price('scan', False, catalog, names, 'as given')]
+    if not catalog:
+        unknown = sum(1 for name in names if catalogs.get(name) is None)
+        estimates.append(price('-catalog', True, True, names,
+                               f'+{unknown} catalog calls, skips unoffered regions' if unknown
+                               else 'skips unoffered regions'))
+
+    if first and availability:
+        known = list(availability.values())
+        average = sum(known) / len(known)
+        expected = {name: sum(len(fds) for _, fds in locations.get(name, [])) * len(queries)
+                    * availability.get(name, average) for name in names}
+        for strategy, order in ((f'-first {first}', names),
+                                (f'-first {first}, by yield', yield_order(regions, availability))):
+            scanned = _first_regions(order, expected, first)
+            note = (f'about {len(scanned)} of {len(names)} regions' if sum(expected.values()) >= first
+                    else f'under {first} AVAILABLE expected')
+            estimates.append(price(strategy, False, catalog, scanned, note))
+    return estimates
+
+
+def combine(estimates):
+    """
+    Add up the estimates of several tenancies, strategy by strategy. Tenancies
+    are scanned side by side, so the run takes as long as the slowest one.
+
+    Returns: list of Estimate
+    """
+    combined = {}
+    for estimate in (e for tenancy in estimates for e in tenancy):
+        total = combined.get(estimate.strategy)
+        combined[estimate.strategy] = estimate if total is None else total._replace(
+            calls=total.calls + estimate.calls, seconds=max(total.seconds, estimate.seconds))
+    return list(combined.values())
@@ -0,0 +1,151 @@
+# coding: utf-8
+"""Hedged capacity report calls: a call still running past its region's p95 gets a duplicate."""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+from modules.estimate import CAPACITY_REPORT
+from modules.metrics import percentile
+
+# Answered calls of a region needed before its p95 in this run replaces the recorded one
+MIN_SAMPLES = 20
+
+# Latencies per region kept for the p95 of this run
+MAX_SAMPLES = 200
+
+
+class Hedger:
+    """
+    Sends a duplicate of a call that is still running after its region's p95
+    latency, and returns whichever answer arrives first.
+
+    The p95 is that of the region's answered calls in this run once there are
+    MIN_SAMPLES of them, before that the one recorded by earlier runs
+    (`latencies`, see modules.metrics.read_latencies()); regions with neither
+    are not hedged. Hedges are capped at `budget` (a fraction) of the calls
+    made so far, and duplicates go through the rate limiter of the original
+    call, so the extra API volume stays bounded. One hedger can be shared by
+    the scans of several tenancies. Safe to use from several threads.
+    """
+
+    def __init__(self, budget, latencies=None, operation=CAPACITY_REPORT, clock=time.monotonic):
+        self.budget = budget
+        self.latencies = latencies or {}
+        self.operation = operation
+        self.clock = clock
+        self.calls = 0
+        self.hedged = 0
+        self.won = 0
+        self.saved = 0.0
+        self.samples = {}
+        self._outrun = {}
+        self._lock = threading.Lock()
+
+    def threshold(self, region_name):
+        """Returns: seconds after which a call to the region is hedged, or None."""
+        with self._lock:
+            samples = list(self.samples.get(region_name, ()))
+        if len(samples) >= MIN_SAMPLES:
+            return percentile(samples, 0.95)
+        entry = self.latencies.get((region_name, self.operation))
+        return entry['p95'] if entry else None
+
+    def _timed(self, region_name, func, started=None):
+        """Wrap func to record the latency of its answers (not of its wait for the limiter)."""
+        def run(*args, **kwargs):
+            if started is not None:
+                started.set()
+            begin = self.clock()
+            result = func(*args, **kwargs)
+            with self._lock:
+                self.samples.setdefault(region_name, deque(maxlen=MAX_SAMPLES)).append(self.clock() - begin)
+            return result
+        return run
+
+    @staticmethod
+    def _start(func, *args, **kwargs):
+        """
+        Run func on a daemon thread while the scan's worker waits for the first
+        answer; a call that was outrun never holds up the end of the run.
+        Returns: Future
+        """
+        future = Future()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def _take(self):
+        """Spend one hedge of the budget. Returns: False if it is used up"""
+        with self._lock:
+            if self.hedged + 1 > max(1.0, self.budget * self.calls):
+                return False
+            self.hedged += 1
+            return True
+
+    def _outrun_done(self, future):
+        """The original call of a won hedge finished: the time it took past the hedge's answer was saved."""
+        with self._lock:
+            answered = self._outrun.pop(future, None)
+            if answered is not None:
+                self.saved += self.clock() - answered
+
+    def call(self, limiter, region_name, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) as limiter.call(region_name, ...) would, with
+        a duplicate once it runs past the region's threshold().
+
+        Returns: the first answer
+        Raises: the error of the original call when neither answers
+        """
+        with self._lock:
+            self.calls += 1
+        threshold = self.threshold(region_name)
+        if threshold is None:
+            return limiter.call(region_name, self._timed(region_name, func), *args, **kwargs)
+        started = threading.Event()
+        primary = self._start(limiter.call, region_name, self._timed(region_name, func, started), *args, **kwargs)
+
+        # The threshold counts from the call itself, not from its wait for the limiter
+        primary.add_done_callback(lambda _: started.set())
+        started.wait()
+        if wait([primary], timeout=threshold).done or not self._take():
+            return primary.result()
+
+        hedge = self._start(limiter.call, region_name, self._timed(region_name, func), *args, **kwargs)
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        first = primary if primary in done else hedge
+        if first.exception() is not None:
+            # The other call may still answer
+            other = hedge if first is primary else primary
+            if other.exception() is not None:
+                raise primary.exception()
+            first = other
+        if first is hedge:
+            with self._lock:
+                self.won += 1
+                self._outrun[primary] = self.clock()
+            primary.add_done_callback(self._outrun_done)
+        return first.result()
+
+    def summary(self):
+        """
+        Return a one-line hedging report, or None if nothing was hedged.
+
+        Originals still running count as saved up to now.
+        """
+        with self._lock:
+            if not self.hedged:
+                return None
+            now = self.clock()
+            saved = self.saved + sum(now - answered for answered in self._outrun.values())
+            return (f"Hedging: {self.hedged} of {self.calls} capacity report calls hedged "
+                    f"({100 * self.hedged / self.calls:.1f}%), {self.won} answered first, "
+                    f"{saved:.1f}s of latency saved")
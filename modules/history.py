@@ -0,0 +1,148 @@
+# coding: utf-8
+"""Local SQLite history of capacity results, and the queries behind `ocareport.py query`."""
+
+import os
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timezone
+
+from modules.cache import cache_dir
+
+
+# Groupings of the history query: output column -> SQL expression
+HISTORY_GROUPS = {
+    'region': 'region',
+    'ad': 'availability_domain',
+    'fd': "availability_domain || ' ' || fault_domain",
+    'config': "CASE WHEN ocpus IS NULL THEN '-' ELSE printf('%g OCPU, %g GB', ocpus, memory) END",
+    'day': "date(checked_at, 'unixepoch')",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    tenancy_id TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    scan_id INTEGER NOT NULL REFERENCES scans(id),
+    checked_at REAL NOT NULL,
+    tenancy_id TEXT NOT NULL,
+    region TEXT NOT NULL,
+    availability_domain TEXT NOT NULL,
+    fault_domain TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    ocpus REAL,
+    memory REAL,
+    status TEXT NOT NULL
+);
+-- Time-series lookups filter by shape, optionally region, over a time range;
+-- status and scan_id make the index covering for availability counts
+CREATE INDEX IF NOT EXISTS results_shape_region_time
+    ON results (shape, region, checked_at, status, scan_id);
+CREATE INDEX IF NOT EXISTS results_time ON results (checked_at);
+"""
+
+
+def history_path():
+    """Return the default history database path, next to the other caches."""
+    return os.path.join(cache_dir(), 'history.sqlite')
+
+
+def connect(path):
+    """Open (and create if needed) a history database. Returns: sqlite3.Connection"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    # WAL lets queries run while another process appends a scan
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class HistoryRecorder:
+    """
+    Collects the rows of one scan in memory and appends them in a single
+    transaction when the scan is over, so recording adds no API-path latency.
+    """
+
+    def __init__(self, path, tenancy_id, clock=time.time):
+        self.path = path
+        self.tenancy_id = tenancy_id
+        self.clock = clock
+        self.started_at = clock()
+        self.rows = []
+
+    def add(self, result):
+        """Remember a CapacityResult with the time it arrived."""
+        self.rows.append((self.clock(), result))
+
+    def flush(self):
+        """
+        Append the collected rows as one scan. An empty scan writes nothing.
+
+        Returns: number of rows written.
+        """
+        if not self.rows:
+            return 0
+        rows, self.rows = self.rows, []
+        with closing(connect(self.path)) as connection, connection:
+            scan_id = connection.execute(
+                'INSERT INTO scans (tenancy_id, started_at, finished_at, rows) VALUES (?, ?, ?, ?)',
+                (self.tenancy_id, self.started_at, self.clock(), len(rows))
+            ).lastrowid
+            connection.executemany(
+                'INSERT INTO results (scan_id, checked_at, tenancy_id, region, availability_domain, '
+                'fault_domain, shape, ocpus, memory, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(scan_id, checked_at, self.tenancy_id) + tuple(result[:7]) for checked_at, result in rows]
+            )
+        return len(rows)
+
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc).isoformat(timespec='seconds') if value else None
+
+
+def query_history(connection, shape, region=None, since=None, until=None, group_by='region',
+                  ocpus=None, memory=None):
+    """
+    Summarize the recorded checks of a shape, per `group_by` (see HISTORY_GROUPS).
+
+    `since`/`until` are Unix timestamps; `region` (in any case, as region
+    names are recorded in lower case), `ocpus` and `memory` narrow the rows further.
+    Returns: list of dicts with the group, checks, available, availability
+    (0..1) and the first/last time a location was seen AVAILABLE.
+    """
+    conditions = ['shape = ?']
+    params = [shape]
+    for column, operator, value in (('region', '=', region.lower() if region else region), ('checked_at', '>=', since),
+                                    ('checked_at', '<', until), ('ocpus', '=', ocpus), ('memory', '=', memory)):
+        if value is not None:
+            conditions.append(f'{column} {operator} ?')
+            params.append(value)
+
+    group = HISTORY_GROUPS[group_by]
+    sql = (
+        f"SELECT {group} AS grp, COUNT(*), "
+        f"SUM(status = 'AVAILABLE'), "
+        f"MIN(CASE WHEN status = 'AVAILABLE' THEN checked_at END), "
+        f"MAX(CASE WHEN status = 'AVAILABLE' THEN checked_at END), "
+        f"COUNT(DISTINCT scan_id) "
+        f"FROM results WHERE {' AND '.join(conditions)} GROUP BY grp ORDER BY grp"
+    )
+    return [
+        {
+            group_by: name,
+            'scans': scans,
+            'checks': checks,
+            'available': available,
+            'availability': available / checks,
+            'first_available': _timestamp(first),
+            'last_available': _timestamp(last),
+        }
+        for name, checks, available, first, last, scans in connection.execute(sql, params)
+    ]
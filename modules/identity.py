@@ -1,29 +1,63 @@
 # coding: utf-8
 """OCI authentication and identity management."""
 
+import configparser
 import os
-import oci
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
 from modules.utils import yellow, green, red, print_info, print_error
+from modules.cache import read_auth_hint, write_auth_hint
+
+# The OCI SDK is imported by the functions that use it: listing the profiles
+# of a config file (-profile ALL) happens while parsing arguments
+
+
+def custom_retry_strategy():
+    """Returns: the retry strategy of the Instance Principals metadata and token calls"""
+    import oci
+    return oci.retry.RetryStrategyBuilder(
+        max_attempts_check=True,
+        max_attempts=5,
+        total_elapsed_time_check=True,
+        total_elapsed_time_seconds=20,
+        retry_max_wait_between_calls_seconds=5,
+        retry_base_sleep_time_seconds=2,
+    ).get_retry_strategy()
+
+
+class AuthenticationError(Exception):
+    """Raised by quiet authentication when no method works; `errors` maps each method to its failure."""
+
+    def __init__(self, errors):
+        self.errors = dict(errors)
+        super().__init__('; '.join(f'{method}: {error}' for method, error in self.errors.items())
+                         or 'no authentication method worked')
 
 
-# Custom retry strategy for OCI API calls
-custom_retry_strategy = oci.retry.RetryStrategyBuilder(
-    max_attempts_check=True,
-    max_attempts=5,
-    total_elapsed_time_check=True,
-    total_elapsed_time_seconds=20,
-    retry_max_wait_between_calls_seconds=5,
-    retry_base_sleep_time_seconds=2,
-).get_retry_strategy()
+def _progress(message, quiet):
+    """Show a transient progress line unless `quiet`."""
+    if not quiet:
+        print(yellow(message), end=' ' * 30 + '\r', flush=True)
 
 
-def init_authentication(user_auth, config_file_path, config_profile):
+def init_authentication(user_auth, config_file_path, config_profile, trust=False, parallel=False, quiet=False,
+                        cache_signer=False):
     """
     Initialize OCI authentication.
 
     If user_auth is specified, uses that method only.
-    Otherwise, tries all methods in order: CloudShell → Config File → Instance Principals.
+    Otherwise, tries the method that last worked for this config file/profile
+    first, then the others in order: CloudShell → Config File → Instance Principals.
 
+    With `trust`, the get_tenancy validation call is skipped and the tenancy
+    name/home region come from the cache. With `parallel`, all candidate
+    methods are probed concurrently and the first one in order that works wins.
+    With `cache_signer`, CloudShell and Instance Principals reuse the security
+    token of an earlier run (see modules.tokens).
+
+    With `quiet`, nothing is printed and nobody is prompted: when every
+    method fails, AuthenticationError is raised instead of offering a retry.
     Returns: (config, signer, tenancy, auth_name, details, tenancy_id)
     """
     auth_errors = {}
@@ -34,15 +68,37 @@ def init_authentication(user_auth, config_file_path, config_profile):
         'ip': (authenticate_instance_principals, [])
     }
 
-    # If auth method specified, try only that one; otherwise try all
-    methods = [auth_methods[user_auth]] if user_auth else list(auth_methods.values())
+    hint = read_auth_hint(config_file_path, config_profile)
+
+    # If auth method specified, try only that one; otherwise try all, last successful first
+    if user_auth:
+        order = [user_auth]
+    else:
+        order = list(auth_methods)
+        if hint and hint['method'] in order:
+            order.remove(hint['method'])
+            order.insert(0, hint['method'])
+
+    def attempt(method):
+        auth_func, args = auth_methods[method]
+        tenancy_hint = _cached_tenancy(hint) if hint and hint['method'] == method else None
+        kwargs = {'cache_signer': True} if cache_signer and method != 'cf' else {}
+        return auth_func(auth_errors, *args, validate=not trust, tenancy_hint=tenancy_hint, quiet=quiet, **kwargs)
+
+    if parallel and len(order) > 1:
+        futures = [(method, _in_background(attempt, method)) for method in order]
+        attempts = ((method, future.result()) for method, future in futures)
+    else:
+        attempts = ((method, attempt(method)) for method in order)
 
-    for auth_func, args in methods:
-        result = auth_func(auth_errors, *args)
+    for method, result in attempts:
         if result[0] is not None:
+            write_auth_hint(config_file_path, config_profile, method, result[2])
             return result
 
     # All methods failed
+    if quiet:
+        raise AuthenticationError(auth_errors)
     for auth_type, error in auth_errors.items():
         print_error(auth_type, error)
 
@@ -50,6 +106,105 @@ def init_authentication(user_auth, config_file_path, config_profile):
     return retry_auth()
 
 
+def _in_background(func, *args):
+    """
+    Run func on a daemon thread: a probe that lost (e.g. instance metadata
+    retries off OCI) never holds up the end of the run.
+    Returns: Future
+    """
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def config_profiles(config_file_path):
+    """
+    List the profiles of an OCI config file.
+
+    DEFAULT is included only if it names a tenancy of its own.
+    Returns: list of profile names, in file order.
+    """
+    parser = configparser.ConfigParser(interpolation=None)
+    if not parser.read(os.path.expanduser(config_file_path)):
+        raise ValueError(f'cannot read config file {config_file_path}')
+    profiles = parser.sections()
+    if parser.defaults().get('tenancy'):
+        profiles.insert(0, 'DEFAULT')
+    return profiles
+
+
+def authenticate_profiles(config_file_path, config_profiles, trust=False):
+    """
+    Authenticate several profiles of one config file concurrently, with config file auth.
+
+    Profiles that fail are reported and left out, without prompting; the
+    run stops only if none works. With `trust`, the get_tenancy validation
+    calls are skipped as in init_authentication().
+    Returns: list of (config, signer, tenancy, auth_name, details, tenancy_id), in profile order.
+    """
+    hints = {profile: read_auth_hint(config_file_path, profile) for profile in config_profiles}
+
+    def attempt(profile):
+        auth_errors = {}
+        hint = hints[profile]
+        tenancy_hint = _cached_tenancy(hint) if hint and hint['method'] == 'cf' else None
+        result = authenticate_config_file(auth_errors, config_file_path, profile,
+                                          validate=not trust, tenancy_hint=tenancy_hint)
+        return result, auth_errors
+
+    with ThreadPoolExecutor(max_workers=len(config_profiles)) as pool:
+        attempts = list(pool.map(attempt, config_profiles))
+
+    logins = []
+    for profile, (result, auth_errors) in zip(config_profiles, attempts):
+        if result[0] is None:
+            print_error(f'Profile {profile}', *auth_errors.values())
+            continue
+        # Hints share one file, so they are written one at a time
+        write_auth_hint(config_file_path, profile, 'cf', result[2])
+        logins.append(result)
+
+    if not logins:
+        raise SystemExit("\nAuthentication failed for every profile. Exiting.\n")
+    return logins
+
+
+def _cached_tenancy(hint):
+    """Build a Tenancy model from a cached authentication hint."""
+    import oci
+    return oci.identity.models.Tenancy(
+        id=hint.get('tenancy_id'),
+        name=hint.get('tenancy_name'),
+        home_region_key=hint.get('home_region_key')
+    )
+
+
+def get_tenancy(config, signer, tenancy_id, validate=True, tenancy_hint=None):
+    """
+    Fetch the tenancy, which also validates the credentials.
+
+    Without `validate`, no API call is made: the cached tenancy is returned
+    if it matches, otherwise a Tenancy carrying only the OCID.
+    """
+    import oci
+    from modules.clients import endpoint_kwargs
+
+    if not validate:
+        if tenancy_hint is not None and tenancy_hint.id == tenancy_id:
+            return tenancy_hint
+        return oci.identity.models.Tenancy(id=tenancy_id, name=tenancy_id, home_region_key='-')
+
+    identity = oci.identity.IdentityClient(config=config, signer=signer, **endpoint_kwargs(config.get('region')))
+    return identity.get_tenancy(tenancy_id).data
+
+
 def retry_auth():
     """Prompt user to retry with custom config file path."""
     print(yellow("\n-- All authentication methods failed --\n"))
@@ -66,14 +221,19 @@ def retry_auth():
         raise SystemExit("\nAuthentication failed. Exiting.\n")
 
 
-def authenticate_cloud_shell(auth_errors):
+def authenticate_cloud_shell(auth_errors, validate=True, tenancy_hint=None, quiet=False, cache_signer=False):
     """
     Authenticate using OCI CloudShell delegation token.
 
+    With `cache_signer`, the security token exchanged for the delegation
+    token is saved and reused while it is valid (see modules.tokens).
+
     Returns: (config, signer, tenancy, auth_name, details, tenancy_id) or (None, ...) on failure.
     """
+    import oci
+
     try:
-        print(yellow("\r => Trying CloudShell authentication..."), end=' ' * 30 + '\r', flush=True)
+        _progress("\r => Trying CloudShell authentication...", quiet)
 
         env_config_file = os.environ.get('OCI_CONFIG_FILE')
         env_config_section = os.environ.get('OCI_CONFIG_PROFILE')
@@ -90,13 +250,17 @@ def authenticate_cloud_shell(auth_errors):
         with open(delegation_token_file, 'r') as f:
             delegation_token = f.read().strip()
 
-        signer = oci.auth.signers.InstancePrincipalsDelegationTokenSigner(
-            delegation_token=delegation_token
-        )
+        def build():
+            return oci.auth.signers.InstancePrincipalsDelegationTokenSigner(delegation_token=delegation_token)
+
+        if cache_signer:
+            from modules.tokens import CachedTokenSigner
+            signer = CachedTokenSigner.load('cs', build, delegation_token)
+        else:
+            signer = build()
 
         # Validate by fetching tenancy
-        identity = oci.identity.IdentityClient(config=config, signer=signer)
-        tenancy = identity.get_tenancy(tenancy_id).data
+        tenancy = get_tenancy(config, signer, tenancy_id, validate, tenancy_hint)
 
         return config, signer, tenancy, 'delegation_token', delegation_token_file, tenancy_id
 
@@ -105,14 +269,17 @@ def authenticate_cloud_shell(auth_errors):
         return None, None, None, None, None, None
 
 
-def authenticate_config_file(auth_errors, config_file_path, config_profile):
+def authenticate_config_file(auth_errors, config_file_path, config_profile, validate=True, tenancy_hint=None,
+                             quiet=False):
     """
     Authenticate using OCI config file.
 
     Returns: (config, signer, tenancy, auth_name, details, tenancy_id) or (None, ...) on failure.
     """
+    import oci
+
     try:
-        print(yellow("\r => Trying Config File authentication..."), end=' ' * 30 + '\r', flush=True)
+        _progress("\r => Trying Config File authentication...", quiet)
 
         config = oci.config.from_file(
             file_location=config_file_path,
@@ -131,8 +298,7 @@ def authenticate_config_file(auth_errors, config_file_path, config_profile):
         )
 
         # Validate by fetching tenancy
-        identity = oci.identity.IdentityClient(config=config, signer=signer)
-        tenancy = identity.get_tenancy(tenancy_id).data
+        tenancy = get_tenancy(config, signer, tenancy_id, validate, tenancy_hint)
 
         return config, signer, tenancy, 'config_file', config_profile, tenancy_id
 
@@ -141,24 +307,34 @@ def authenticate_config_file(auth_errors, config_file_path, config_profile):
         return None, None, None, None, None, None
 
 
-def authenticate_instance_principals(auth_errors):
+def authenticate_instance_principals(auth_errors, validate=True, tenancy_hint=None, quiet=False, cache_signer=False):
     """
     Authenticate using OCI Instance Principals.
 
+    With `cache_signer`, the security token and session key are saved and
+    reused while valid, skipping the metadata and token exchange calls
+    (see modules.tokens).
+
     Returns: (config, signer, tenancy, auth_name, details, tenancy_id) or (None, ...) on failure.
     """
+    import oci
+
     try:
-        print(yellow("\r => Trying Instance Principals authentication..."), end=' ' * 30 + '\r', flush=True)
+        _progress("\r => Trying Instance Principals authentication...", quiet)
 
-        signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner(
-            retry_strategy=custom_retry_strategy
-        )
+        def build():
+            return oci.auth.signers.InstancePrincipalsSecurityTokenSigner(retry_strategy=custom_retry_strategy())
+
+        if cache_signer:
+            from modules.tokens import CachedTokenSigner
+            signer = CachedTokenSigner.load('ip', build)
+        else:
+            signer = build()
         tenancy_id = signer.tenancy_id
         config = {'region': signer.region, 'tenancy': tenancy_id}
 
         # Validate by fetching tenancy
-        identity = oci.identity.IdentityClient(config=config, signer=signer)
-        tenancy = identity.get_tenancy(tenancy_id).data
+        tenancy = get_tenancy(config, signer, tenancy_id, validate, tenancy_hint)
 
         return config, signer, tenancy, 'instance_principals', signer.region, tenancy_id
 
@@ -167,65 +343,92 @@ def authenticate_instance_principals(auth_errors):
         return None, None, None, None, None, None
 
 
-def get_region_subscription_list(identity_client, tenancy_id, target_region):
+def list_region_subscriptions(identity_client, tenancy_id, topology=None, quiet=False, limiter=None,
+                              region_name=None):
     """
-    Get list of subscribed regions.
+    Get the regions the tenancy is subscribed to, from a TopologyCache when fresh.
+
+    With a RateLimiter, the call goes through it as a call to `region_name`
+    (the region of the client).
+    Returns: list of RegionSubscription
+    """
+    subscribed_regions = topology.regions() if topology else None
+    if subscribed_regions is None:
+        _progress("\r => Loading regions...", quiet)
+        list_call = identity_client.list_region_subscriptions
+        response = limiter.call(region_name, list_call, tenancy_id) if limiter else list_call(tenancy_id)
+        subscribed_regions = response.data
+        if topology:
+            topology.set_regions(subscribed_regions)
+    return subscribed_regions
+
+
+def select_regions(identity_client, subscribed_regions, target_region):
+    """
+    Pick the regions to analyze among the subscribed ones.
 
     - If target_region is empty: returns home region only
     - If target_region is 'all': returns all subscribed regions
     - Otherwise: returns the specified region if subscribed
+
+    Raises: ValueError if the region is not subscribed or does not exist
+    """
+    # No target specified: return home region
+    if not target_region:
+        home = next((r for r in subscribed_regions if r.is_home_region), None)
+        if home:
+            return [home]
+
+    # All regions requested
+    if target_region.lower() == 'all':
+        return list(subscribed_regions)
+
+    # Specific region requested
+    region_map = {r.region_name.lower(): r for r in subscribed_regions}
+    region = region_map.get(target_region.lower())
+    if region:
+        return [region]
+
+    # Check if region exists but not subscribed
+    all_oci_regions = {r.name.lower() for r in identity_client.list_regions().data}
+    if target_region.lower() in all_oci_regions:
+        raise ValueError(f"Region '{target_region}' is not subscribed")
+    raise ValueError(f"Region '{target_region}' does not exist")
+
+
+def get_region_subscription_list(identity_client, tenancy_id, target_region, topology=None):
     """
+    Get list of subscribed regions to analyze, as select_regions() does,
+    printing the choice; errors are printed and end the run.
+
+    If a TopologyCache is given, subscriptions are read from it when fresh.
+    """
+    import oci
+
     try:
-        print(yellow("\r => Loading regions..."), end=' ' * 30 + '\r', flush=True)
-        subscribed_regions = identity_client.list_region_subscriptions(tenancy_id).data
-
-        # No target specified: return home region
-        if not target_region:
-            home = next((r for r in subscribed_regions if r.is_home_region), None)
-            if home:
-                print_info(green, 'Region', 'analyzed', home.region_name)
-                return [home]
-
-        # All regions requested
-        if target_region.lower() == 'all':
-            print_info(green, 'Region', 'analyzed', 'all subscribed regions')
-            return subscribed_regions
-
-        # Specific region requested
-        region_map = {r.region_name.lower(): r for r in subscribed_regions}
-        region = region_map.get(target_region.lower())
-
-        if region:
-            print_info(green, 'Region', 'analyzed', target_region)
-            return [region]
-
-        # Check if region exists but not subscribed
-        all_oci_regions = {r.name.lower() for r in identity_client.list_regions().data}
-        if target_region.lower() in all_oci_regions:
-            print_error(f"Region '{target_region}' is not subscribed")
-        else:
-            print_error(f"Region '{target_region}' does not exist")
+        regions = select_regions(identity_client, list_region_subscriptions(identity_client, tenancy_id, topology),
+                                 target_region)
+    except ValueError as e:
+        print_error(str(e))
         raise SystemExit(1)
-
     except oci.exceptions.ServiceError as e:
         print_error("Region error:", str(e))
         raise SystemExit(1)
 
+    analyzed = 'all subscribed regions' if target_region.lower() == 'all' else (target_region or regions[0].region_name)
+    print_info(green, 'Region', 'analyzed', analyzed)
+    return regions
+
 
 def get_availability_domains(identity_client, compartment_id):
     """Get list of availability domain names for a compartment."""
-    ads = oci.pagination.list_call_get_all_results(
-        identity_client.list_availability_domains,
-        compartment_id
-    ).data
+    from modules.clients import list_all_pages
+    ads = list_all_pages(identity_client.list_availability_domains, compartment_id)
     return [ad.name for ad in ads]
 
 
 def get_fault_domains(identity_client, compartment_id, availability_domain):
     """Get list of fault domain names for an availability domain."""
-    fds = oci.pagination.list_call_get_all_results(
-        identity_client.list_fault_domains,
-        compartment_id,
-        availability_domain
-    ).data
+    from modules.clients import list_all_pages
+    fds = list_all_pages(identity_client.list_fault_domains, compartment_id, availability_domain)
     return [fd.name for fd in fds]
@@ -0,0 +1,153 @@
+# coding: utf-8
+"""Incremental re-scan: reuse the settled rows of an earlier run and re-check the rest."""
+
+import json
+import os
+import time
+from collections import namedtuple
+
+from modules.options import DEFAULT_STALE_AFTER
+from modules.output import parse_utc
+from modules.ratelimit import RateLimiter
+from modules.scanner import (
+    DEFAULT_WORKERS,
+    DEFAULT_REGION_WORKERS,
+    DEFAULT_BATCH_SIZE,
+    UNLISTED,
+    CapacityResult,
+    ShapeQuery,
+    iter_capacity,
+    iter_reports,
+    merge_scans
+)
+
+
+# Statuses that rarely change between runs; fresh rows with them are carried forward
+CARRIED_STATUSES = ('AVAILABLE', 'HARDWARE_NOT_SUPPORTED')
+
+# What a previous run answers: `carried` (order, CapacityResult) rows reused as
+# they are, `requery` (order, region, AD, FD, ShapeQuery) locations asked again,
+# `missing` {region_name: [ShapeQuery]} pairs the run did not cover
+RescanPlan = namedtuple('RescanPlan', ['carried', 'requery', 'missing'])
+
+
+def load_results(path):
+    """
+    Read the rows of an earlier `-format jsonl` run (watch transitions included).
+
+    Returns: list of CapacityResult with their checked_at timestamp
+    Raises: ValueError if the file cannot be read or a line is not a result row
+    """
+    results = []
+    try:
+        with open(os.path.expanduser(path), 'r') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    parse_utc(record['checked_at'])
+                    results.append(CapacityResult(
+                        record['region'], record['availability_domain'], record['fault_domain'],
+                        record['shape'], record.get('ocpus'), record.get('memory'), record['status'],
+                        record.get('tenancy'), record['checked_at']
+                    ))
+                except (KeyError, TypeError, ValueError):
+                    raise ValueError(f"{path}:{number} is not a -format jsonl result row")
+    except OSError as e:
+        raise ValueError(f"cannot read results file {path}: {e.strerror}")
+    return results
+
+
+def _order(result, r_index, q_index):
+    """Sort key of a row: region and query by position, AD and FD by name."""
+    query = ShapeQuery(result.shape, result.ocpus, result.memory)
+    return r_index[result.region], result.availability_domain, result.fault_domain, q_index[query]
+
+
+def plan_rescan(previous, regions, queries, stale_after=DEFAULT_STALE_AFTER, now=None, tenancy=None):
+    """
+    Split a scan into the rows a previous run already answers and the calls still needed.
+
+    Only the latest row of each location counts. AVAILABLE and
+    HARDWARE_NOT_SUPPORTED rows younger than `stale_after` seconds are
+    carried; other rows are re-checked at their known location, without
+    topology listing. Regions/queries the run did not cover, and stale
+    region-level rows of the shape catalog, are scanned in full. With
+    `tenancy`, only rows of that tenancy are used.
+    Returns: RescanPlan
+    """
+    now = time.time() if now is None else now
+    r_index = {region.region_name: r_idx for r_idx, region in enumerate(regions)}
+    q_index = {query: q_idx for q_idx, query in enumerate(queries)}
+
+    latest = {}
+    for result in previous:
+        query = ShapeQuery(result.shape, result.ocpus, result.memory)
+        if result.region not in r_index or query not in q_index:
+            continue
+        if tenancy is not None and result.tenancy != tenancy:
+            continue
+        key = (result.region, result.availability_domain, result.fault_domain, query)
+        if key not in latest or parse_utc(latest[key].checked_at) < parse_utc(result.checked_at):
+            latest[key] = result
+
+    carried, requery = [], []
+    covered, rescan = set(), set()
+    for (region_name, ad, fd, query), result in latest.items():
+        covered.add((region_name, query))
+        order = _order(result, r_index, q_index)
+        fresh = now - parse_utc(result.checked_at) <= stale_after
+        if fresh and result.status in CARRIED_STATUSES:
+            carried.append((order, result._replace(tenancy=None)))
+        elif fd == UNLISTED:
+            rescan.add((region_name, query))
+        else:
+            requery.append((order, region_name, ad, fd, query))
+
+    missing = {}
+    for region in regions:
+        for query in queries:
+            if (region.region_name, query) in rescan or (region.region_name, query) not in covered:
+                missing.setdefault(region.region_name, []).append(query)
+    return RescanPlan(sorted(carried), sorted(requery), missing)
+
+
+def iter_rescan(clients, tenancy_id, regions, queries, plan,
+                workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+                batch_size=DEFAULT_BATCH_SIZE, topology=None, limiter=None, catalogs=None,
+                deadline=None, on_error=None, hedger=None):
+    """
+    Run a RescanPlan made by plan_rescan() for the same regions and queries.
+
+    Re-checked locations and missing regions are queried concurrently through
+    one rate limiter; regions missing the same queries share one scan.
+    `deadline`, `on_error` and `hedger` work as in iter_capacity().
+
+    Yields: (order, CapacityResult), the carried rows first (with their
+    checked_at), then the others in completion order. `order` sorts into
+    region/AD/FD/query order across both.
+    Without `on_error`, errors are raised to the caller.
+    """
+    limiter = limiter or RateLimiter(max_concurrency=region_workers)
+    r_index = {region.region_name: r_idx for r_idx, region in enumerate(regions)}
+    q_index = {query: q_idx for q_idx, query in enumerate(queries)}
+
+    yield from plan.carried
+
+    scans = []
+    if plan.requery:
+        scans.append(iter_reports(clients, tenancy_id, plan.requery, workers, region_workers,
+                                  batch_size, limiter, deadline, on_error, hedger))
+    groups = {}
+    for region in regions:
+        if region.region_name in plan.missing:
+            groups.setdefault(tuple(plan.missing[region.region_name]), []).append(region)
+    for group_queries, group_regions in groups.items():
+        scans.append(iter_capacity(clients, tenancy_id, group_regions, list(group_queries), workers,
+                                   region_workers, batch_size, topology, limiter, catalogs, deadline, on_error,
+                                   hedger))
+
+    for _, order, result in merge_scans(scans):
+        # Orders of full scans index their own region/query subset
+        yield _order(result, r_index, q_index), result
@@ -0,0 +1,299 @@
+# coding: utf-8
+"""Per-call latency, call counts and bytes of OCI API calls, and where a run's time goes."""
+
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+from rich import box
+from rich.table import Table
+
+from modules.cache import CACHE_VERSION, cache_dir, read_json, write_json_atomic
+from modules.options import METRICS_FORMATS
+
+# Weight of the latest run in the recorded latencies (exponential moving average)
+LATENCY_WEIGHT = 0.3
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers (q in 0..1); 0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1))]
+
+
+def operation_name(method, url):
+    """
+    Name an API call by HTTP method and resource path, without OCIDs.
+
+    Returns: e.g. 'GET faultDomains', 'POST computeCapacityReports'.
+    """
+    path = url.split('?', 1)[0].split('://', 1)[-1]
+    segments = [s for s in path.split('/')[1:] if s and not s.startswith('ocid1.')]
+    # Drop everything up to the API version (endpoint prefix, /20160918)
+    for i, segment in enumerate(segments):
+        if segment.isdigit() and len(segment) == 8:
+            segments = segments[i + 1:]
+            break
+    return f"{method} {'/'.join(segments)}"
+
+
+class Metrics:
+    """
+    Timings of one run: every HTTP call of the pooled OCI clients, tagged by
+    region and operation, plus the wall time of each stage (auth, regions, scan).
+
+    Calls are recorded by a requests response hook (see response_hook()), so
+    retries show up as separate calls. Safe to use from several threads.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.latencies = defaultdict(list)
+        self.statuses = Counter()
+        self.bytes_sent = Counter()
+        self.bytes_received = Counter()
+        self.retries = Counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, region, operation, seconds, status, sent=0, received=0):
+        """Record one API call."""
+        key = (region, operation)
+        with self._lock:
+            self.latencies[key].append(seconds)
+            self.statuses[key + (status,)] += 1
+            self.bytes_sent[key] += sent
+            self.bytes_received[key] += received
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage of the run; repeated stages add up."""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + self.clock() - start
+
+    def response_hook(self, region):
+        """Return a requests response hook recording the calls of a region's client."""
+        def hook(response, *args, **kwargs):
+            request = response.request
+            body = request.body or b''
+            received = response.headers.get('Content-Length')
+            self.record(
+                region,
+                operation_name(request.method, request.url),
+                response.elapsed.total_seconds(),
+                response.status_code,
+                sent=len(body),
+                received=int(received) if received else len(response.content or b''),
+            )
+        return hook
+
+    def _summary(self, keys):
+        latencies = [value for key in keys for value in self.latencies[key]]
+        errors = sum(count for (region, operation, status), count in self.statuses.items()
+                     if (region, operation) in keys and status >= 400)
+        return {
+            'calls': len(latencies),
+            'errors': errors,
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'max': max(latencies, default=0.0),
+            'total': sum(latencies),
+            'bytes_sent': sum(self.bytes_sent[key] for key in keys),
+            'bytes_received': sum(self.bytes_received[key] for key in keys),
+        }
+
+    def by_operation(self):
+        """Returns: {operation: summary} over all regions."""
+        with self._lock:
+            operations = sorted({operation for _, operation in self.latencies})
+            return {operation: self._summary({key for key in self.latencies if key[1] == operation})
+                    for operation in operations}
+
+    def by_region(self):
+        """Returns: {region: summary} over all operations, with the region's retries."""
+        with self._lock:
+            regions = sorted({region for region, _ in self.latencies})
+            summaries = {region: self._summary({key for key in self.latencies if key[0] == region})
+                         for region in regions}
+        for region, summary in summaries.items():
+            summary['retries'] = self.retries[region]
+        return summaries
+
+    def to_dict(self):
+        """Return all metrics as a JSON-serializable dict."""
+        with self._lock:
+            calls = [
+                dict(region=region, operation=operation, **self._summary({(region, operation)}))
+                for region, operation in sorted(self.latencies)
+            ]
+            stages = dict(self.stages)
+        return {
+            'stages': stages,
+            'operations': self.by_operation(),
+            'regions': self.by_region(),
+            'calls': calls,
+            'retries': dict(self.retries),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        def labels(**values):
+            return '{' + ','.join(f'{name}="{value}"' for name, value in values.items()) + '}'
+
+        lines = [
+            '# HELP ocareport_stage_seconds Wall time of each stage of the run.',
+            '# TYPE ocareport_stage_seconds gauge',
+        ]
+        with self._lock:
+            stages = dict(self.stages)
+            statuses = dict(self.statuses)
+            keys = sorted(self.latencies)
+            summaries = {key: self._summary({key}) for key in keys}
+        lines += [f'ocareport_stage_seconds{labels(stage=name)} {seconds:.6f}' for name, seconds in stages.items()]
+
+        lines += ['# HELP ocareport_api_calls_total OCI API calls by region, operation and HTTP status.',
+                  '# TYPE ocareport_api_calls_total counter']
+        lines += [f'ocareport_api_calls_total{labels(region=r, operation=o, status=s)} {count}'
+                  for (r, o, s), count in sorted(statuses.items())]
+
+        lines += ['# HELP ocareport_api_latency_seconds OCI API call latency.',
+                  '# TYPE ocareport_api_latency_seconds summary']
+        for (region, operation), summary in summaries.items():
+            for quantile, name in (('0.5', 'p50'), ('0.95', 'p95')):
+                value = summary[name]
+                lines.append(f'ocareport_api_latency_seconds'
+                             f'{labels(region=region, operation=operation, quantile=quantile)} {value:.6f}')
+            lines.append(f'ocareport_api_latency_seconds_sum'
+                         f'{labels(region=region, operation=operation)} {summary["total"]:.6f}')
+            lines.append(f'ocareport_api_latency_seconds_count'
+                         f'{labels(region=region, operation=operation)} {summary["calls"]}')
+
+        lines += ['# HELP ocareport_api_bytes_total Bytes sent and received by OCI API calls.',
+                  '# TYPE ocareport_api_bytes_total counter']
+        for (region, operation), summary in summaries.items():
+            for direction in ('sent', 'received'):
+                lines.append(f'ocareport_api_bytes_total'
+                             f'{labels(region=region, operation=operation, direction=direction)} '
+                             f'{summary["bytes_" + direction]}')
+
+        lines += ['# HELP ocareport_api_retries_total Throttled or failed calls retried, by region.',
+                  '# TYPE ocareport_api_retries_total counter']
+        lines += [f'ocareport_api_retries_total{labels(region=region)} {count}'
+                  for region, count in sorted(self.retries.items())]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, metrics_format='json'):
+        """Write the metrics to a file as JSON or Prometheus text."""
+        content = self.to_prometheus() if metrics_format == 'prometheus' else self.to_json() + '\n'
+        with open(path, 'w') as f:
+            f.write(content)
+
+
+def latency_path():
+    """Return the file the latencies of earlier runs are recorded in."""
+    return os.path.join(cache_dir(), 'latency.json')
+
+
+def read_latencies(path=None):
+    """
+    Return the API latencies recorded by earlier runs (see record_latencies()).
+
+    Returns: {(region, operation): {'p50': seconds, 'p95': seconds, 'calls': count}}
+    """
+    data = read_json(path or latency_path()) or {}
+    entries = data.get('latencies') if data.get('version') == CACHE_VERSION else None
+    latencies = {}
+    for key, entry in (entries if isinstance(entries, dict) else {}).items():
+        region, _, operation = key.partition('|')
+        try:
+            latencies[(region, operation)] = {'p50': float(entry['p50']), 'p95': float(entry['p95']),
+                                              'calls': int(entry.get('calls', 0))}
+        except (KeyError, TypeError, ValueError):
+            continue
+    return latencies
+
+
+def record_latencies(metrics, path=None, weight=LATENCY_WEIGHT):
+    """
+    Blend the p50/p95 latency of this run's calls into the recorded ones, per
+    region and operation, as a moving average giving the run `weight`.
+    Write errors are not fatal.
+
+    Returns: the recorded latencies, as read_latencies()
+    """
+    path = path or latency_path()
+    latencies = read_latencies(path)
+    with metrics._lock:
+        summaries = {key: metrics._summary({key}) for key in metrics.latencies}
+    if not summaries:
+        return latencies
+    for key, summary in summaries.items():
+        entry = latencies.get(key)
+        if entry is None:
+            latencies[key] = {'p50': summary['p50'], 'p95': summary['p95'], 'calls': summary['calls']}
+        else:
+            latencies[key] = {
+                'p50': (1 - weight) * entry['p50'] + weight * summary['p50'],
+                'p95': (1 - weight) * entry['p95'] + weight * summary['p95'],
+                'calls': entry['calls'] + summary['calls'],
+            }
+    data = {'version': CACHE_VERSION, 'updated_at': time.time(),
+            'latencies': {f'{region}|{operation}': entry for (region, operation), entry in latencies.items()}}
+    try:
+        write_json_atomic(path, data)
+    except OSError:
+        pass
+    return latencies
+
+
+def _ms(seconds):
+    return f'{seconds * 1000:.0f}'
+
+
+def _kb(count):
+    return f'{count / 1024:.1f}'
+
+
+def create_timings_tables(metrics, slowest=5):
+    """
+    Build the timing breakdown of a run: stages, API operations and the
+    `slowest` regions by p95 latency.
+
+    Returns: list of rich Tables.
+    """
+    stages = Table(title='Stages', box=box.MARKDOWN)
+    stages.add_column('STAGE', justify='left')
+    stages.add_column('TIME (s)', justify='right')
+    for name, seconds in metrics.stages.items():
+        stages.add_row(name, f'{seconds:.2f}')
+
+    def summary_table(title, first_column, rows):
+        table = Table(title=title, box=box.MARKDOWN)
+        table.add_column(first_column, justify='left', no_wrap=True)
+        for column in ('CALLS', 'ERRORS', 'P50 ms', 'P95 ms', 'MAX ms', 'KB OUT', 'KB IN'):
+            table.add_column(column, justify='right')
+        for name, s in rows:
+            table.add_row(name, str(s['calls']), str(s['errors']), _ms(s['p50']), _ms(s['p95']),
+                          _ms(s['max']), _kb(s['bytes_sent']), _kb(s['bytes_received']))
+        return table
+
+    operations = summary_table('API calls by operation', 'OPERATION', metrics.by_operation().items())
+    regions = sorted(metrics.by_region().items(), key=lambda item: item[1]['p95'], reverse=True)
+    slow = summary_table('Slowest regions (by p95)', 'REGION', regions[:slowest])
+    retried = [f'{name} {summary["retries"]}' for name, summary in regions if summary['retries']]
+    if retried:
+        slow.caption = 'Retries: ' + ', '.join(retried)
+    return [stages, operations, slow]
@@ -0,0 +1,41 @@
+# coding: utf-8
+"""
+Defaults and choices of the command line options.
+
+Imported by the argument parsers before anything else runs, so this module
+must not import the OCI SDK, rich or any module that does.
+"""
+
+
+# Default size of the shared worker pool
+DEFAULT_WORKERS = 16
+
+# Default maximum number of in-flight API calls against a single region
+DEFAULT_REGION_WORKERS = 4
+
+# Default sustained call rate per region (calls per second)
+DEFAULT_RATE = 10.0
+
+# Default number of retries of a throttled or failed call
+DEFAULT_MAX_RETRIES = 5
+
+# Stable locations are polled at most every DEFAULT_MAX_BACKOFF base intervals
+DEFAULT_MAX_BACKOFF = 8
+
+# Default lifetime of cached topology entries (seconds)
+DEFAULT_TOPOLOGY_TTL = 24 * 3600
+
+# Rows of a -since file older than this are checked again (seconds)
+DEFAULT_STALE_AFTER = 3600
+
+# Default lifetime of a cached scan in serve mode (seconds)
+DEFAULT_CACHE_TTL = 60.0
+
+OUTPUT_FORMATS = ['table', 'jsonl', 'csv']
+
+METRICS_FORMATS = ['json', 'prometheus']
+
+
+def is_flex_shape(shape):
+    """Return True if the shape accepts a custom OCPU/memory configuration."""
+    return 'flex' in shape.lower()
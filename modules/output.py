@@ -0,0 +1,276 @@
+# coding: utf-8
+"""Streaming output of capacity results: live table, JSON Lines and CSV."""
+
+import csv
+import json
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from rich import box
+from rich.console import Group
+from rich.live import Live
+from rich.table import Table
+
+from modules.options import OUTPUT_FORMATS
+from modules.scanner import ShapeQuery
+
+# Columns of the machine-readable formats
+RESULT_FIELDS = ['region', 'availability_domain', 'fault_domain', 'shape',
+                 'ocpus', 'memory', 'status', 'checked_at']
+
+
+def format_number(value):
+    """Format an OCPU/memory amount without a trailing '.0'."""
+    return f'{value:g}'
+
+
+def utc_now():
+    """Return the current UTC time as an ISO 8601 string."""
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def parse_utc(text):
+    """Return the Unix time of an ISO 8601 timestamp (UTC if it has no offset)."""
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    moment = datetime.fromisoformat(text)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def format_age(seconds):
+    """Format an age in seconds as '5m', '3h07m' or '2d04h'."""
+    minutes = int(max(seconds, 0) // 60)
+    if minutes < 60:
+        return f'{minutes}m'
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f'{hours}h{minutes:02d}m'
+    days, hours = divmod(hours, 24)
+    return f'{days}d{hours:02d}h'
+
+
+def result_age(result):
+    """Return the age in seconds of a row carried from an earlier run, or None for a fresh row."""
+    return None if result.checked_at is None else time.time() - parse_utc(result.checked_at)
+
+
+def result_record(result, checked_at=None):
+    """
+    Return a CapacityResult as a plain dict with a check timestamp (and its tenancy, if set).
+
+    Rows carried from an earlier run keep their own check time and get their age in seconds.
+    """
+    record = result._asdict()
+    if record['tenancy'] is None:
+        del record['tenancy']
+    if result.checked_at is None:
+        record['checked_at'] = checked_at or utc_now()
+    else:
+        record['age_s'] = round(result_age(result))
+    return record
+
+
+def create_results_table(query, results, probe=False, tenancies=False, ages=False):
+    """
+    Build the results table of one shape/config group.
+
+    With `probe`, the group is a whole shape and each row shows the largest
+    available config of its fault domain. With `tenancies`, rows start with
+    their tenancy. With `ages`, an AGE column marks rows carried from an
+    earlier run.
+    """
+    title = f"Shape: {query.shape}"
+    if probe:
+        title += " | Largest available config"
+    elif query.ocpus is not None:
+        title += f" | OCPU: {format_number(query.ocpus)} | Memory: {format_number(query.memory)} GB"
+
+    table = Table(title=title, box=box.MARKDOWN)
+    if tenancies:
+        table.add_column("TENANCY", justify="left")
+    table.add_column("REGION", justify="left")
+    table.add_column("AVAILABILITY DOMAIN", justify="left")
+    table.add_column("FAULT DOMAIN", justify="left")
+    table.add_column("SHAPE", justify="left")
+    if probe:
+        table.add_column("OCPUS", justify="right")
+        table.add_column("MEMORY (GB)", justify="right")
+    table.add_column("STATUS", justify="left")
+    if ages:
+        table.add_column("AGE", justify="right")
+
+    for result in results:
+        available = result.status == 'AVAILABLE'
+        config = []
+        if probe:
+            config = [format_number(result.ocpus), format_number(result.memory)] if available else ['-', '-']
+        tenancy = [result.tenancy] if tenancies else []
+        age = []
+        if ages:
+            age = ['-' if result.checked_at is None else format_age(result_age(result))]
+        table.add_row(*tenancy, result.region, result.availability_domain, result.fault_domain,
+                      result.shape, *config, result.status, *age, style='green' if available else 'red')
+    return table
+
+
+class ResultWriter:
+    """
+    Base class of the output writers.
+
+    Call write() for each (order, CapacityResult) as it arrives and close()
+    once at the end; close() emits the summary footer.
+    """
+
+    def __init__(self, console):
+        self.console = console
+        self.counts = Counter()
+        self.carried = 0
+        # How rows with their own checked_at came in
+        self.carried_as = 'carried forward'
+        self.started = time.monotonic()
+
+    def write(self, order, result):
+        self.counts[result.status] += 1
+        if result.checked_at is not None:
+            self.carried += 1
+
+    def summary(self):
+        """Return the summary footer line."""
+        total = sum(self.counts.values())
+        elapsed = time.monotonic() - self.started
+        statuses = ', '.join(f'{status}: {count}' for status, count in sorted(self.counts.items()))
+        if self.carried == total and total:
+            line = f"{total} locations {self.carried_as}"
+        else:
+            line = f"{total - self.carried} locations checked in {elapsed:.1f}s"
+            if self.carried:
+                line += f", {self.carried} {self.carried_as}"
+        return line + (f" ({statuses})" if statuses else '')
+
+    def write_transition(self, order, result, previous):
+        """Report a status change seen in watch mode."""
+        config = ''
+        if result.ocpus is not None:
+            config = f" ({format_number(result.ocpus)} OCPU, {format_number(result.memory)} GB)"
+        style = 'green' if result.status == 'AVAILABLE' else 'red'
+        self.console.print(
+            f"{utc_now()} {result.region} {result.availability_domain} {result.fault_domain} "
+            f"{result.shape}{config}: {previous} → {result.status}",
+            style=style, highlight=False
+        )
+
+    def close(self):
+        self.console.print(self.summary(), style='bold')
+
+
+class TableWriter(ResultWriter):
+    """
+    Live-updating tables, one per shape/config, rows in region/AD/FD order.
+
+    The display is refreshed as rows arrive and left on screen when closed.
+    In probe mode there is one table per shape; with `tenancies`, rows of
+    several tenancies share each table; with `ages`, carried rows show their age.
+    """
+
+    def __init__(self, console, queries, probe=False, tenancies=False, ages=False):
+        super().__init__(console)
+        self.probe = probe
+        self.tenancies = tenancies
+        self.ages = ages
+        self.groups = {self._group(query): {} for query in queries}
+        # The refresh thread renders while the scan keeps adding rows
+        self.lock = threading.Lock()
+        self.live = Live(self, console=console, refresh_per_second=4)
+        self.live.start()
+
+    def __rich__(self):
+        with self.lock:
+            groups = [(query, [rows[key] for key in sorted(rows)]) for query, rows in self.groups.items()]
+        return Group(*(create_results_table(query, rows, self.probe, self.tenancies, self.ages) for query, rows in groups))
+
+    def _group(self, query):
+        shape, ocpus, memory = query
+        return ShapeQuery(shape, None, None) if self.probe else ShapeQuery(shape, ocpus, memory)
+
+    def write(self, order, result):
+        super().write(order, result)
+        query = self._group((result.shape, result.ocpus, result.memory))
+        with self.lock:
+            self.groups.setdefault(query, {})[order] = result
+
+    def close(self):
+        self.live.stop()
+        self.console.print()
+        super().close()
+
+
+class JsonlWriter(ResultWriter):
+    """One JSON object per line, flushed as each row arrives."""
+
+    def __init__(self, console, stream):
+        super().__init__(console)
+        self.stream = stream
+
+    def write(self, order, result):
+        super().write(order, result)
+        self.stream.write(json.dumps(result_record(result)) + '\n')
+        self.stream.flush()
+
+    def write_transition(self, order, result, previous):
+        record = result_record(result)
+        record['previous_status'] = previous
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+
+class CsvWriter(ResultWriter):
+    """
+    CSV with a header row, flushed as each row arrives.
+
+    In watch mode a previous_status column carries the status before each change;
+    with `ages`, an age_s column carries the age of rows from an earlier run.
+    """
+
+    def __init__(self, console, stream, watch=False, tenancies=False, ages=False):
+        super().__init__(console)
+        self.stream = stream
+        fields = (['tenancy'] if tenancies else []) + RESULT_FIELDS
+        if ages:
+            fields.append('age_s')
+        if watch:
+            fields.append('previous_status')
+        self.writer = csv.DictWriter(stream, fieldnames=fields)
+        self.writer.writeheader()
+        self.stream.flush()
+
+    def write(self, order, result):
+        super().write(order, result)
+        self.writer.writerow(result_record(result))
+        self.stream.flush()
+
+    def write_transition(self, order, result, previous):
+        record = result_record(result)
+        record['previous_status'] = previous
+        self.writer.writerow(record)
+        self.stream.flush()
+
+
+def create_writer(output_format, console, stream, queries, watch=False, probe=False, tenancies=False,
+                  ages=False):
+    """
+    Build the writer for an output format.
+
+    Tables are drawn on `console`; jsonl/csv rows go to `stream` and the
+    summary footer goes to `console`. With `tenancies`, rows carry a
+    tenancy column; with `ages`, rows carried from an earlier run carry
+    their age.
+    """
+    if output_format == 'jsonl':
+        return JsonlWriter(console, stream)
+    if output_format == 'csv':
+        return CsvWriter(console, stream, watch, tenancies, ages)
+    return TableWriter(console, queries, probe, tenancies, ages)
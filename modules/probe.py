@@ -0,0 +1,209 @@
+# coding: utf-8
+"""Probe mode: find the largest available flex shape config of each fault domain."""
+
+from concurrent.futures import TimeoutError, as_completed
+from functools import partial
+
+from modules.ratelimit import RateLimiter
+from modules.scanner import (
+    DEFAULT_WORKERS,
+    DEFAULT_REGION_WORKERS,
+    DEFAULT_BATCH_SIZE,
+    DaemonThreadPool,
+    ShapeQuery,
+    create_capacity_reports,
+    iter_capacity,
+    time_left
+)
+
+
+class BoundSearch:
+    """
+    Search for the last AVAILABLE value of a sorted candidate list.
+
+    Availability is assumed monotonic: if a config is available, every
+    smaller one is too. `low` is the index of the largest value known to be
+    available (-1: none), `high` the index of the smallest value known not
+    to be (len: none). Every answer narrows the bounds; the search is done
+    when they are adjacent.
+    """
+
+    def __init__(self, values, low=-1, high=None):
+        self.values = values
+        self.low = low
+        self.high = len(values) if high is None else high
+
+    @property
+    def done(self):
+        return self.high - self.low <= 1
+
+    @property
+    def best(self):
+        """Largest value known to be available, or None."""
+        return self.values[self.low] if self.low >= 0 else None
+
+    def candidates(self, count):
+        """
+        Return up to `count` indexes to probe next.
+
+        Without an upper bound the probes gallop (1, 2, 4, ... steps above the
+        lower bound, plus the top value); with one, they split the remaining
+        interval evenly, so each round shrinks it about `count` + 1 times.
+        """
+        if self.done or count < 1:
+            return []
+        if self.high == len(self.values):
+            steps = [2 ** i for i in range(count - 1)]
+            picks = [self.low + step for step in steps if self.low + step < self.high - 1]
+            picks.append(self.high - 1)
+        else:
+            gap = self.high - self.low
+            picks = [self.low + round(gap * i / (count + 1)) for i in range(1, count + 1)]
+        return sorted({i for i in picks if self.low < i < self.high})
+
+    def update(self, index, available):
+        """Record the answer for one candidate index."""
+        if available:
+            self.low = max(self.low, index)
+            # Answers that break monotonicity drop the upper bound above them
+            if self.high <= self.low:
+                self.high = len(self.values)
+        elif index > self.low:
+            self.high = min(self.high, index)
+
+
+def probe_rounds(searches, ask, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Run several BoundSearches to completion, sharing each round's requests.
+
+    `searches` maps a key (e.g. a fault domain) to its BoundSearch; `ask`
+    takes a list of (key, value) and returns their availability (True/False)
+    in the same order. Each round gives every open search an equal share of
+    `batch_size` candidates, so one round costs one request.
+    Returns: number of rounds.
+    """
+    rounds = 0
+    while True:
+        open_searches = {key: search for key, search in searches.items() if not search.done}
+        if not open_searches:
+            return rounds
+        share = max(1, batch_size // len(open_searches))
+        asked = [(key, index) for key, search in open_searches.items() for index in search.candidates(share)]
+        answers = ask([(key, searches[key].values[index]) for key, index in asked])
+        for (key, index), available in zip(asked, answers):
+            searches[key].update(index, available)
+        rounds += 1
+
+
+def _probe_ad(clients, tenancy_id, region_name, ad, base, shape, ocpus, memory_per_ocpu,
+              memories, batch_size, in_region, deadline=None):
+    """
+    Find the largest available config of each FD of one AD.
+
+    `base` maps each FD to its answer at the smallest config. OCPUs are
+    searched first at a fixed memory-per-OCPU ratio, then memory at the
+    best OCPU count. No round starts after `deadline`.
+    Returns: list of (fd, ocpus, memory), with None for FDs without capacity.
+    Raises: TimeoutError once the deadline has passed
+    """
+    compute = clients.compute(region_name)
+
+    def ask(queries):
+        if time_left(deadline) == 0:
+            raise TimeoutError(f'deadline passed while probing {region_name} {ad}')
+        statuses = []
+        for i in range(0, len(queries), batch_size):
+            entries = [(fd, query) for fd, query in queries[i:i + batch_size]]
+            statuses += in_region(region_name, create_capacity_reports, compute, tenancy_id, ad, entries)
+        return [status == 'AVAILABLE' for status in statuses]
+
+    available = [fd for fd, status in base.items() if status == 'AVAILABLE']
+
+    # OCPUs, at the memory-per-OCPU ratio of the smallest config
+    by_ocpus = {fd: BoundSearch(ocpus, low=0) for fd in available}
+    probe_rounds(by_ocpus, lambda asked: ask([
+        (fd, ShapeQuery(shape, value, round(value * memory_per_ocpu, 6))) for fd, value in asked
+    ]), batch_size)
+    best = {fd: (search.best, round(search.best * memory_per_ocpu, 6)) for fd, search in by_ocpus.items()}
+
+    # Then memory beyond that ratio, at the best OCPU count
+    by_memory = {}
+    for fd, (best_ocpus, best_memory) in best.items():
+        larger = [value for value in memories if value > best_memory]
+        if larger:
+            by_memory[fd] = BoundSearch([best_memory] + larger, low=0)
+    probe_rounds(by_memory, lambda asked: ask([
+        (fd, ShapeQuery(shape, best[fd][0], value)) for fd, value in asked
+    ]), batch_size)
+    for fd, search in by_memory.items():
+        best[fd] = (best[fd][0], search.best)
+
+    return [(fd,) + best.get(fd, (None, None)) for fd in base]
+
+
+def probe_capacity(clients, tenancy_id, regions, shapes, ocpus, memories,
+                   workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+                   batch_size=DEFAULT_BATCH_SIZE, topology=None, limiter=None, catalogs=None,
+                   deadline=None, on_error=None, hedger=None):
+    """
+    Find the largest available config of flex shapes in every fault domain.
+
+    `ocpus` and `memories` are the sorted candidate values. A regular scan
+    at the smallest config (memories[0] GB at ocpus[0] OCPUs) lists the
+    topology and rules out FDs without any capacity; the others are then
+    searched per AD, all FDs of an AD sharing each round's request.
+
+    `deadline`, `on_error` and `hedger` work as in iter_capacity(); an AD
+    whose search fails or runs out of time keeps its answers at the smallest config.
+
+    Yields: (order, CapacityResult) per FD as each AD finishes; AVAILABLE rows
+    carry the largest config found, others the smallest config and its status.
+    """
+    limiter = limiter or RateLimiter(max_concurrency=region_workers)
+    memory_per_ocpu = memories[0] / ocpus[0]
+    queries = [ShapeQuery(shape, float(ocpus[0]), float(memories[0])) for shape in shapes]
+
+    # Smallest config everywhere: topology plus the first bound of each FD
+    ads = {}
+    for order, result in iter_capacity(clients, tenancy_id, regions, queries, workers, region_workers,
+                                       batch_size, topology, limiter, catalogs, deadline, on_error, hedger):
+        key = (result.region, result.availability_domain, result.shape)
+        ads.setdefault(key, {})[result.fault_domain] = (order, result)
+
+    report = partial(hedger.call, limiter) if hedger else limiter.call
+    pool = DaemonThreadPool(workers)
+    futures = {
+        pool.submit(_probe_ad, clients, tenancy_id, region_name, ad,
+                    {fd: result.status for fd, (order, result) in rows.items()},
+                    shape, ocpus, memory_per_ocpu, memories, batch_size, report, deadline): rows
+        for (region_name, ad, shape), rows in ads.items()
+    }
+    finished = set()
+    try:
+        try:
+            for future in as_completed(futures, timeout=time_left(deadline)):
+                finished.add(future)
+                rows = futures[future]
+                try:
+                    best = future.result()
+                except TimeoutError:
+                    best = [(fd, None, None) for fd in rows]
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(e)
+                    best = [(fd, None, None) for fd in rows]
+                for fd, best_ocpus, best_memory in best:
+                    order, result = rows[fd]
+                    if best_ocpus is not None:
+                        result = result._replace(ocpus=best_ocpus, memory=best_memory)
+                    yield order, result
+        except TimeoutError:
+            # Out of time: unfinished ADs keep their smallest-config answers
+            for future, rows in futures.items():
+                if future not in finished:
+                    yield from rows.values()
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown()
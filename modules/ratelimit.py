@@ -0,0 +1,151 @@
+# coding: utf-8
+"""Per-region rate limiting with adaptive concurrency and throttling-aware retries."""
+
+import random
+import threading
+import time
+from collections import Counter
+
+import oci
+
+from modules.options import DEFAULT_MAX_RETRIES, DEFAULT_RATE
+
+# Backoff before retry n is about BACKOFF_BASE * 2**n seconds, capped at BACKOFF_MAX
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 20.0
+
+
+def is_retryable(error):
+    """Return True for throttling (429) and server-side (5xx) service errors."""
+    return isinstance(error, oci.exceptions.ServiceError) and (error.status == 429 or error.status >= 500)
+
+
+class RegionLimit:
+    """
+    Token bucket plus AIMD concurrency limit of one region.
+
+    Tokens refill at `rate` per second up to `burst`. The concurrency limit
+    grows by about one slot per window of successful calls and halves on every
+    throttled or failed call, never dropping below one.
+    """
+
+    def __init__(self, rate, burst, max_concurrency, clock):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.clock = clock
+        self.condition = threading.Condition()
+
+    def acquire(self, sleep):
+        """Block until a concurrency slot and a token are available."""
+        with self.condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+
+        while True:
+            with self.condition:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            sleep(wait_time)
+
+    def release(self, success):
+        """
+        Free the slot and adapt the limit: additive increase on success,
+        multiplicative decrease on failure, unchanged when `success` is None.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if success is True:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif success is False:
+                self.limit = max(1.0, self.limit / 2)
+            self.condition.notify_all()
+
+
+class RateLimiter:
+    """
+    Rate limiter shared by every identity and compute call of a scan.
+
+    Each region has its own RegionLimit; a call that fails with 429 or 5xx
+    shrinks that region's concurrency and is retried with exponential backoff
+    and jitter, up to `max_retries` times. Throttle counts are kept per region.
+    No retry is started if its backoff would end after `deadline` (a `clock` time).
+    Raises: ValueError if `max_concurrency` is below 1
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=None, max_concurrency=4,
+                 max_retries=DEFAULT_MAX_RETRIES, clock=time.monotonic, sleep=time.sleep, deadline=None):
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be at least 1')
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.clock = clock
+        self.sleep = sleep
+        self.regions = {}
+        self.throttled = Counter()
+        self.server_errors = Counter()
+        self.retries = Counter()
+        self._lock = threading.Lock()
+
+    def region(self, region_name):
+        """Return the RegionLimit of a region, creating it on first use."""
+        with self._lock:
+            if region_name not in self.regions:
+                self.regions[region_name] = RegionLimit(self.rate, self.burst, self.max_concurrency, self.clock)
+            return self.regions[region_name]
+
+    def call(self, region_name, func, *args, **kwargs):
+        """Run an API call under the region's limits, retrying throttled and 5xx failures."""
+        limit = self.region(region_name)
+        attempt = 0
+        while True:
+            limit.acquire(self.sleep)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    limit.release(success=None)
+                    raise
+                limit.release(success=False)
+                with self._lock:
+                    if e.status == 429:
+                        self.throttled[region_name] += 1
+                    else:
+                        self.server_errors[region_name] += 1
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                    late = self.deadline is not None and self.clock() + delay / 2 >= self.deadline
+                    if attempt >= self.max_retries or late:
+                        raise
+                    self.retries[region_name] += 1
+                self.sleep(delay / 2 + random.uniform(0, delay / 2))
+                attempt += 1
+            else:
+                limit.release(success=True)
+                return result
+
+    def summary(self):
+        """Return a one-line throttling report, or None if nothing was throttled."""
+        if not (self.throttled or self.server_errors):
+            return None
+        regions = sorted(set(self.throttled) | set(self.server_errors))
+        details = ', '.join(
+            f"{name}: {self.throttled[name]}x429 {self.server_errors[name]}x5xx "
+            f"(limit {self.regions[name].limit:.1f})"
+            for name in regions
+        )
+        return (f"API throttling: {sum(self.throttled.values())} throttled, "
+                f"{sum(self.server_errors.values())} server errors, "
+                f"{sum(self.retries.values())} retries - {details}")
@@ -0,0 +1,505 @@
+# coding: utf-8
+"""Concurrent capacity scan across regions, availability domains and fault domains."""
+
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from functools import partial
+
+import oci
+
+from modules.identity import get_availability_domains, get_fault_domains
+from modules.options import DEFAULT_WORKERS, DEFAULT_REGION_WORKERS, is_flex_shape
+from modules.ratelimit import RateLimiter
+
+
+# Maximum number of shape availabilities packed into one capacity report request
+DEFAULT_BATCH_SIZE = 20
+
+# A shape and its flex configuration to check (ocpus/memory are ignored for fixed shapes)
+ShapeQuery = namedtuple('ShapeQuery', ['shape', 'ocpus', 'memory'])
+
+# One row of the capacity report; `tenancy` is only set when several tenancies are
+# scanned, `checked_at` only on rows carried forward from an earlier run
+CapacityResult = namedtuple(
+    'CapacityResult',
+    ['region', 'availability_domain', 'fault_domain', 'shape', 'ocpus', 'memory', 'status', 'tenancy',
+     'checked_at'],
+    defaults=[None, None]
+)
+
+# AD/FD of a region-level row, for shapes the region's catalog does not offer
+UNLISTED = '-'
+
+# Statuses of locations the API did not answer: the run's deadline passed, or the call failed
+TIMEOUT = 'TIMEOUT'
+ERROR = 'ERROR'
+UNANSWERED = (TIMEOUT, ERROR)
+
+
+def _shape_availability_details(fault_domain, query):
+    """Build one shape availability entry of a capacity report request."""
+    shape_config = None
+    if query.ocpus is not None:
+        shape_config = oci.core.models.CapacityReportInstanceShapeConfig(
+            ocpus=query.ocpus,
+            memory_in_gbs=query.memory
+        )
+
+    return oci.core.models.CreateCapacityReportShapeAvailabilityDetails(
+        instance_shape=query.shape,
+        fault_domain=fault_domain,
+        instance_shape_config=shape_config
+    )
+
+
+def _availability_key(fault_domain, shape, shape_config):
+    """Key used to match a returned shape availability to its request entry."""
+    if shape_config is None or shape_config.ocpus is None:
+        return fault_domain, shape, None, None
+    return fault_domain, shape, float(shape_config.ocpus), float(shape_config.memory_in_gbs)
+
+
+def create_capacity_report(core_client, compartment_id, availability_domain,
+                           fault_domain, shape, is_flex=False, ocpu=1.0, memory=1.0):
+    """
+    Query the Compute Capacity Report API for shape availability.
+
+    Returns: availability_status string ('AVAILABLE', 'HARDWARE_NOT_SUPPORTED', 'OUT_OF_HOST_CAPACITY')
+    """
+    query = ShapeQuery(shape, ocpu, memory) if is_flex else ShapeQuery(shape, None, None)
+    return create_capacity_reports(
+        core_client, compartment_id, availability_domain, [(fault_domain, query)]
+    )[0]
+
+
+def create_capacity_reports(core_client, compartment_id, availability_domain, entries):
+    """
+    Query availability for several fault domain/shape combinations of one AD in a single call.
+
+    `entries` is a list of (fault_domain, ShapeQuery) tuples; a query without
+    ocpus is sent without a shape config.
+    Returns: list of availability_status strings, in the same order as `entries`.
+    """
+    details = [_shape_availability_details(fd, query) for fd, query in entries]
+
+    report_details = oci.core.models.CreateComputeCapacityReportDetails(
+        compartment_id=compartment_id,
+        availability_domain=availability_domain,
+        shape_availabilities=details
+    )
+
+    report = core_client.create_compute_capacity_report(
+        create_compute_capacity_report_details=report_details
+    )
+    returned = report.data.shape_availabilities
+
+    # Match answers by fault domain, shape and config; fall back to request order
+    by_key = {}
+    for entry in returned:
+        try:
+            key = _availability_key(entry.fault_domain, entry.instance_shape, entry.instance_shape_config)
+            by_key.setdefault(key, entry.availability_status)
+            by_key.setdefault(key[:2] + (None, None), entry.availability_status)
+        except (TypeError, ValueError):
+            continue
+
+    statuses = []
+    for position, detail in enumerate(details):
+        key = _availability_key(detail.fault_domain, detail.instance_shape, detail.instance_shape_config)
+        status = by_key.get(key)
+        if status is None and len(returned) == len(details):
+            status = returned[position].availability_status
+        statuses.append(status)
+    return statuses
+
+
+def _chunks(items, size):
+    """Split a list into consecutive chunks of at most `size` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _flex_query(query):
+    """Return the query as sent to the API: fixed shapes carry no OCPU/memory."""
+    if is_flex_shape(query.shape):
+        return ShapeQuery(query.shape, float(query.ocpus), float(query.memory))
+    return ShapeQuery(query.shape, None, None)
+
+
+def build_queries(shapes, ocpus, memories):
+    """
+    Expand shapes and flex configurations into the list of queries to scan.
+
+    Flex shapes get one query per (ocpus, memory) combination; fixed shapes
+    get a single query. Duplicates are dropped, order is preserved.
+    Returns: list of ShapeQuery.
+    """
+    queries = []
+    seen = set()
+    for shape in shapes:
+        configs = [(o, m) for o in ocpus for m in memories] if is_flex_shape(shape) else [(None, None)]
+        for ocpu, memory in configs:
+            query = _flex_query(ShapeQuery(shape, ocpu, memory))
+            if query not in seen:
+                seen.add(query)
+                queries.append(query)
+    return queries
+
+
+def _resolved(value):
+    """Return an already completed future holding `value`."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def _batch_results(region_name, ad, batch, statuses):
+    """Yield (order, CapacityResult) for each (order, fd, query) of an answered batch."""
+    for (order, fd, query), status in zip(batch, statuses):
+        yield order, CapacityResult(region_name, ad, fd, query.shape, query.ocpus, query.memory, status)
+
+
+def _unanswered(stage, region_name, order, context, queries, status):
+    """
+    Yield (order, CapacityResult) with `status` for every location behind an unanswered call.
+
+    A capacity report covers its batch; a listing covers every query of its
+    region or AD, reported with UNLISTED for the AD/FD it could not list.
+    """
+    if stage == 'report':
+        ad, batch = context
+        yield from _batch_results(region_name, ad, batch, [status] * len(batch))
+        return
+    ad = context if stage == 'fds' else UNLISTED
+    order = order + (-1,) * (3 - len(order))
+    for q_idx, query in queries:
+        yield order + (q_idx,), CapacityResult(region_name, ad, UNLISTED, query.shape,
+                                               query.ocpus, query.memory, status)
+
+
+class DaemonThreadPool:
+    """
+    Bounded thread pool for scan calls, like ThreadPoolExecutor but with
+    daemon worker threads.
+
+    A scan that stops early (deadline, -first, an error) leaves its calls in
+    flight behind; ThreadPoolExecutor workers would be joined at interpreter
+    exit, so one hanging call could hold the process open long after the
+    results are written.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        self.max_workers = max_workers
+        self._queue = queue.SimpleQueue()
+        self._idle = threading.Semaphore(0)
+        self._threads = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on a worker. Returns: Future"""
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new calls after shutdown')
+            self._queue.put((future, func, args, kwargs))
+            if not self._idle.acquire(blocking=False) and self._threads < self.max_workers:
+                self._threads += 1
+                threading.Thread(target=self._work, daemon=True).start()
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            self._idle.release()
+
+    def shutdown(self):
+        """Let the workers stop once the calls queued so far are done, without waiting for them."""
+        with self._lock:
+            self._shutdown = True
+            threads = self._threads
+        for _ in range(threads):
+            self._queue.put(None)
+
+
+def time_left(deadline):
+    """Seconds left until a time.monotonic() deadline (None: no deadline)."""
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def iter_capacity(clients, tenancy_id, regions, queries,
+                  workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+                  batch_size=DEFAULT_BATCH_SIZE, topology=None, limiter=None, catalogs=None,
+                  deadline=None, on_error=None, hedger=None):
+    """
+    Scan every region/AD/FD combination concurrently for a list of ShapeQuery.
+
+    Clients come from a ClientPool and are reused across calls. AD listing,
+    FD listing and capacity calls all run on one pool of `workers` threads
+    and go through a RateLimiter (default: one allowing `region_workers`
+    calls in flight per region), which adapts to throttling and retries.
+    Every completed listing immediately queues the next stage, so a slow
+    region never holds up the others. All (fault domain, query) pairs of an
+    AD are packed into capacity report requests of up to `batch_size` entries.
+    With a TopologyCache, fresh AD/FD listings are taken from the cache and
+    live listings are stored back into it. With `catalogs` ({region_name:
+    set of shape names}), shapes a region does not offer get one
+    HARDWARE_NOT_SUPPORTED row for the region (AD/FD UNLISTED) without any
+    call, and regions offering none of the shapes are not listed at all.
+
+    Once the time.monotonic() `deadline` passes, the scan stops and every
+    location still waiting for a call gets a TIMEOUT row. With `on_error`,
+    a failed call is passed to it and its locations get ERROR rows instead
+    of ending the scan. With a Hedger (see modules.hedge), capacity reports
+    running past their region's p95 latency get a duplicate.
+
+    Yields: (order, CapacityResult) in completion order, where `order` is a
+    (region, AD, FD, query) index tuple that sorts into topology order.
+    Without `on_error`, errors are raised to the caller; queued calls are cancelled.
+    """
+    queries = [_flex_query(query) for query in queries]
+    limiter = limiter or RateLimiter(max_concurrency=region_workers)
+    in_region = limiter.call
+    report = partial(hedger.call, limiter) if hedger else in_region
+
+    pool = DaemonThreadPool(workers)
+    pending = {}
+    from_cache = set()
+    region_queries = {}
+
+    try:
+        for r_idx, region in enumerate(regions):
+            offered = catalogs.get(region.region_name) if catalogs is not None else None
+            region_queries[region.region_name] = [
+                (q_idx, query) for q_idx, query in enumerate(queries)
+                if offered is None or query.shape in offered
+            ]
+            if offered is not None:
+                for q_idx, query in enumerate(queries):
+                    if query.shape not in offered:
+                        yield (r_idx, -1, -1, q_idx), CapacityResult(
+                            region.region_name, UNLISTED, UNLISTED, query.shape,
+                            query.ocpus, query.memory, 'HARDWARE_NOT_SUPPORTED')
+            if not region_queries[region.region_name]:
+                continue
+
+            region_clients = (region.region_name,
+                              clients.identity(region.region_name),
+                              clients.compute(region.region_name))
+
+            cached = topology.availability_domains(region.region_name) if topology else None
+            if cached is not None:
+                future = _resolved(cached)
+                from_cache.add(future)
+            else:
+                future = pool.submit(in_region, region.region_name,
+                                     get_availability_domains, region_clients[1], tenancy_id)
+            pending[future] = ('ads', region_clients, (r_idx,), None)
+
+        while pending:
+            done, _ = wait(pending, timeout=time_left(deadline), return_when=FIRST_COMPLETED)
+            if not done:
+                for stage, region_clients, order, context in pending.values():
+                    yield from _unanswered(stage, region_clients[0], order, context,
+                                           region_queries[region_clients[0]], TIMEOUT)
+                return
+            for future in done:
+                stage, region_clients, order, context = pending.pop(future)
+                region_name, identity_client, core_client = region_clients
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(e)
+                    yield from _unanswered(stage, region_name, order, context, region_queries[region_name], ERROR)
+                    continue
+                store = topology is not None and future not in from_cache
+                from_cache.discard(future)
+
+                if stage == 'ads':
+                    if store:
+                        topology.set_availability_domains(region_name, result)
+                    for ad_idx, ad in enumerate(result):
+                        cached = topology.fault_domains(region_name, ad) if topology else None
+                        if cached is not None:
+                            next_future = _resolved(cached)
+                            from_cache.add(next_future)
+                        else:
+                            next_future = pool.submit(in_region, region_name, get_fault_domains,
+                                                      identity_client, tenancy_id, ad)
+                        pending[next_future] = ('fds', region_clients, order + (ad_idx,), ad)
+
+                elif stage == 'fds':
+                    ad = context
+                    if store:
+                        topology.set_fault_domains(region_name, ad, result)
+                    work = [(order + (fd_idx, q_idx), fd, query)
+                            for fd_idx, fd in enumerate(result)
+                            for q_idx, query in region_queries[region_name]]
+                    for batch in _chunks(work, batch_size):
+                        entries = [(fd, query) for _, fd, query in batch]
+                        next_future = pool.submit(report, region_name, create_capacity_reports,
+                                                  core_client, tenancy_id, ad, entries)
+                        pending[next_future] = ('report', region_clients, None, (ad, batch))
+
+                else:
+                    ad, batch = context
+                    yield from _batch_results(region_name, ad, batch, result)
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def iter_reports(clients, tenancy_id, work,
+                 workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+                 batch_size=DEFAULT_BATCH_SIZE, limiter=None, deadline=None, on_error=None, hedger=None):
+    """
+    Query capacity for already known locations, without any topology discovery.
+
+    `work` is a list of (order, region_name, availability_domain, fault_domain,
+    ShapeQuery) tuples; entries of the same AD are batched together.
+    `deadline`, `on_error` and `hedger` work as in iter_capacity().
+
+    Yields: (order, CapacityResult) in completion order.
+    Without `on_error`, errors are raised to the caller; queued calls are cancelled.
+    """
+    groups = {}
+    for order, region_name, ad, fd, query in work:
+        groups.setdefault((region_name, ad), []).append((order, fd, _flex_query(query)))
+    limiter = limiter or RateLimiter(max_concurrency=region_workers)
+    report = partial(hedger.call, limiter) if hedger else limiter.call
+
+    pool = DaemonThreadPool(workers)
+    pending = {}
+
+    try:
+        for (region_name, ad), items in groups.items():
+            core_client = clients.compute(region_name)
+            for batch in _chunks(items, batch_size):
+                entries = [(fd, query) for _, fd, query in batch]
+                future = pool.submit(report, region_name, create_capacity_reports,
+                                     core_client, tenancy_id, ad, entries)
+                pending[future] = (region_name, ad, batch)
+
+        while pending:
+            done, _ = wait(pending, timeout=time_left(deadline), return_when=FIRST_COMPLETED)
+            if not done:
+                for region_name, ad, batch in pending.values():
+                    yield from _unanswered('report', region_name, None, (ad, batch), None, TIMEOUT)
+                return
+            for future in done:
+                region_name, ad, batch = pending.pop(future)
+                try:
+                    statuses = future.result()
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(e)
+                    statuses = [ERROR] * len(batch)
+                yield from _batch_results(region_name, ad, batch, statuses)
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def prioritize_regions(regions, priority):
+    """
+    Reorder regions so the ones named in `priority` are scanned first, in that order.
+
+    Regions not listed keep their original relative order after the prioritized ones.
+    """
+    rank = {name.lower(): position for position, name in enumerate(priority or [])}
+    return sorted(regions, key=lambda r: rank.get(r.region_name.lower(), len(rank)))
+
+
+def take_available(results, count):
+    """
+    Pass (order, CapacityResult) items through until `count` AVAILABLE results were seen.
+
+    The underlying scan is then closed, which cancels every queued call; calls
+    already in flight finish in the background and their answers are dropped.
+    """
+    found = 0
+    try:
+        for order, result in results:
+            yield order, result
+            if result.status == 'AVAILABLE':
+                found += 1
+                if found >= count:
+                    return
+    finally:
+        results.close()
+
+
+def merge_scans(scans):
+    """
+    Run several scans concurrently and pass their rows on as they arrive.
+
+    `scans` is a list of (order, CapacityResult) iterators, e.g. one per
+    tenancy; each is drained by its own thread. The first error stops the
+    other scans and is raised to the caller.
+
+    Yields: (scan index, order, CapacityResult)
+    """
+    rows = queue.Queue()
+    stop = threading.Event()
+    finished = object()
+
+    def drain(index, scan):
+        error = None
+        try:
+            for order, result in scan:
+                if stop.is_set():
+                    break
+                rows.put((index, order, result))
+        except Exception as e:
+            error = e
+        finally:
+            if hasattr(scan, 'close'):
+                scan.close()
+            rows.put((index, finished, error))
+
+    for index, scan in enumerate(scans):
+        threading.Thread(target=drain, args=(index, scan), daemon=True).start()
+
+    remaining = len(scans)
+    try:
+        while remaining:
+            index, order, result = rows.get()
+            if order is finished:
+                remaining -= 1
+                if result is not None:
+                    raise result
+                continue
+            yield index, order, result
+    finally:
+        stop.set()
+
+
+def scan_capacity(clients, tenancy_id, regions, queries,
+                  workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+                  batch_size=DEFAULT_BATCH_SIZE, topology=None, limiter=None, catalogs=None,
+                  deadline=None, on_error=None, hedger=None):
+    """
+    Scan every region/AD/FD combination concurrently for a list of ShapeQuery.
+
+    Returns: list of CapacityResult in deterministic region/AD/FD order.
+    """
+    results = iter_capacity(clients, tenancy_id, regions, queries, workers, region_workers,
+                            batch_size, topology, limiter, catalogs, deadline, on_error, hedger)
+    return [result for _, result in sorted(results, key=lambda item: item[0])]
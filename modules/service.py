@@ -0,0 +1,247 @@
+# coding: utf-8
+"""Long-running capacity service: a local HTTP/JSON API over one authenticated session."""
+
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import oci
+
+from modules.options import DEFAULT_CACHE_TTL, DEFAULT_WORKERS, DEFAULT_REGION_WORKERS
+from modules.output import result_record, utc_now
+from modules.scanner import build_queries, scan_capacity
+
+# Failures to reach the OCI endpoints, as the SDK wraps them
+TRANSPORT_ERRORS = (oci.exceptions.RequestException, oci.exceptions.ConnectTimeout)
+
+
+class CoalescingCache:
+    """
+    TTL cache of computed values where concurrent requests for the same key
+    share one computation.
+
+    The first caller of a missing or expired key computes it; callers
+    arriving meanwhile wait for that result instead of starting their own.
+    Failures are passed to every waiting caller and are not cached.
+    """
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Return the value of `key`, calling compute() only if no fresh or pending value exists.
+
+        Returns: (value, source, age) with source 'miss' (computed by this
+        call), 'coalesced' (computed by a concurrent call) or 'hit'.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                future, stored_at = entry
+                if not future.done():
+                    source = 'coalesced'
+                elif self.clock() - stored_at <= self.ttl:
+                    return future.result(), 'hit', self.clock() - stored_at
+                else:
+                    entry = None
+            if entry is None:
+                future = Future()
+                self._entries[key] = (future, None)
+                self._prune()
+                source = 'miss'
+
+        if source == 'coalesced':
+            return future.result(), source, 0.0
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                self._entries.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[key] = (future, self.clock())
+        future.set_result(value)
+        return value, source, 0.0
+
+    def _prune(self):
+        """Drop expired entries (called with the lock held)."""
+        now = self.clock()
+        expired = [key for key, (future, stored_at) in self._entries.items()
+                   if stored_at is not None and now - stored_at > self.ttl]
+        for key in expired:
+            del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CapacityService:
+    """
+    Capacity scans of one tenancy for many callers.
+
+    The client pool (and its signer), the topology cache and the rate limiter
+    live as long as the service. Identical requests within `ttl` seconds are
+    answered from the cache; concurrent identical requests share one scan.
+    """
+
+    def __init__(self, clients, tenancy_id, regions, topology=None, limiter=None, ttl=DEFAULT_CACHE_TTL,
+                 workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS):
+        self.clients = clients
+        self.tenancy_id = tenancy_id
+        self.regions = regions
+        self.topology = topology
+        self.limiter = limiter
+        self.workers = workers
+        self.region_workers = region_workers
+        self.cache = CoalescingCache(ttl)
+        self.stats = Counter()
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        """Increment a service counter (requests, hit, miss, coalesced, errors)."""
+        with self._lock:
+            self.stats[name] += 1
+
+    def select_regions(self, region=''):
+        """Return the subscribed regions for a region argument: '' (home), 'all' or a name."""
+        region = region.lower()
+        if region == 'all':
+            return list(self.regions)
+        if not region:
+            return [r for r in self.regions if r.is_home_region]
+        selected = [r for r in self.regions if r.region_name == region]
+        if not selected:
+            raise ValueError(f"region '{region}' is not subscribed")
+        return selected
+
+    def capacity(self, shapes, ocpus, memories, region=''):
+        """
+        Return the capacity of shapes/configs in the selected regions.
+
+        Returns: dict with the cache source, the scan time and age, and the
+        result records in region/AD/FD order.
+        """
+        regions = self.select_regions(region)
+        queries = build_queries(sorted(set(shapes)), sorted(set(ocpus)), sorted(set(memories)))
+        key = (tuple(queries), tuple(r.region_name for r in regions))
+        self.count('requests')
+
+        (checked_at, results), source, age = self.cache.get(key, lambda: self._scan(regions, queries))
+        self.count(source)
+        return {
+            'source': source,
+            'checked_at': checked_at,
+            'age_s': round(age, 3),
+            'results': [result_record(result, checked_at) for result in results],
+        }
+
+    def _scan(self, regions, queries):
+        results = scan_capacity(self.clients, self.tenancy_id, regions, queries, self.workers,
+                                self.region_workers, topology=self.topology, limiter=self.limiter)
+        if self.topology is not None:
+            self.topology.save()
+        return utc_now(), results
+
+    def health(self):
+        """Return the service status and counters."""
+        return {
+            'status': 'ok',
+            'tenancy_id': self.tenancy_id,
+            'regions': len(self.regions),
+            'uptime_s': round(time.monotonic() - self.started, 1),
+            'cached_scans': len(self.cache),
+            'stats': dict(self.stats),
+        }
+
+
+def _split(values):
+    return [item.strip() for value in values for item in value.split(',') if item.strip()]
+
+
+def parse_capacity_request(query_string):
+    """
+    Parse the query string of GET /capacity.
+
+    `shape` (required), `ocpus` and `memory` take comma separated lists and
+    may repeat; `region` is '' (home), 'all' or a region name.
+    Returns: (shapes, ocpus, memories, region)
+    """
+    params = parse_qs(query_string)
+    shapes = _split(params.get('shape', []))
+    if not shapes:
+        raise ValueError("missing 'shape' parameter")
+    try:
+        ocpus = [float(value) for value in _split(params.get('ocpus', ['1']))]
+        memories = [float(value) for value in _split(params.get('memory', ['1']))]
+    except ValueError:
+        raise ValueError("'ocpus' and 'memory' must be numbers")
+    if not ocpus or not memories or min(ocpus + memories) <= 0:
+        raise ValueError("'ocpus' and 'memory' must be positive")
+    return shapes, ocpus, memories, params.get('region', [''])[-1]
+
+
+class CapacityHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/JSON front end of a CapacityService.
+
+        GET /capacity?shape=BM.GPU.H100.8&region=all
+        GET /capacity?shape=VM.Standard.E5.Flex&ocpus=8,16&memory=128&region=eu-frankfurt-1
+        GET /health
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'ocareport'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def respond(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == '/health':
+            self.respond(200, service.health())
+            return
+        if url.path != '/capacity':
+            self.respond(404, {'error': f'unknown path {url.path}'})
+            return
+        try:
+            self.respond(200, service.capacity(*parse_capacity_request(url.query)))
+        except ValueError as e:
+            self.respond(400, {'error': str(e)})
+        except oci.exceptions.ServiceError as e:
+            service.count('errors')
+            self.respond(502, {'error': e.message, 'code': e.code, 'status': e.status})
+        except TRANSPORT_ERRORS as e:
+            service.count('errors')
+            self.respond(502, {'error': str(e), 'code': type(e).__name__})
+
+
+class CapacityServer(ThreadingHTTPServer):
+    """Threaded HTTP server bound to a CapacityService."""
+
+    daemon_threads = True
+
+    def __init__(self, service, host='127.0.0.1', port=8080, verbose=False):
+        self.service = service
+        self.verbose = verbose
+        super().__init__((host, port), CapacityHandler)
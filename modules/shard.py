@@ -0,0 +1,248 @@
+# coding: utf-8
+"""Sharded scans: plan the work units of a scan, run a slice per host, merge the outputs."""
+
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.identity import get_availability_domains, get_fault_domains
+from modules.incremental import load_results
+from modules.options import DEFAULT_REGION_WORKERS, DEFAULT_WORKERS
+from modules.output import parse_utc
+from modules.ratelimit import RateLimiter
+from modules.scanner import (
+    DEFAULT_BATCH_SIZE,
+    UNLISTED,
+    CapacityResult,
+    ShapeQuery,
+    iter_reports
+)
+
+
+# One location/shape/config of a planned scan. `profile` is the config profile
+# to log in with, `tenancy` the tenancy name rows are tagged with. Units with
+# an UNLISTED fault domain are shapes the region does not offer (-catalog)
+WorkUnit = namedtuple('WorkUnit', ['profile', 'tenancy', 'region', 'availability_domain', 'fault_domain',
+                                   'shape', 'ocpus', 'memory'])
+
+
+def parse_shard(value):
+    """
+    Parse a shard spec 'i/N' (1 <= i <= N).
+
+    Returns: (index, count)
+    Raises: ValueError
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"invalid shard '{value}' (expected i/N, e.g. 2/4)")
+    if not 1 <= index <= count:
+        raise ValueError(f"invalid shard '{value}': i must be between 1 and N")
+    return index, count
+
+
+def list_locations(clients, tenancy_id, regions, workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+                   topology=None, limiter=None):
+    """
+    List the ADs and FDs of every region, one region per thread.
+
+    With a TopologyCache, fresh listings are taken from it and live ones
+    are stored back.
+    Returns: {region_name: [(availability_domain, [fault_domain, ...]), ...]}
+    """
+    in_region = (limiter or RateLimiter(max_concurrency=region_workers)).call
+
+    def region_locations(region_name):
+        identity_client = clients.identity(region_name)
+        ads = topology.availability_domains(region_name) if topology else None
+        if ads is None:
+            ads = in_region(region_name, get_availability_domains, identity_client, tenancy_id)
+            if topology:
+                topology.set_availability_domains(region_name, ads)
+        locations = []
+        for ad in ads:
+            fds = topology.fault_domains(region_name, ad) if topology else None
+            if fds is None:
+                fds = in_region(region_name, get_fault_domains, identity_client, tenancy_id, ad)
+                if topology:
+                    topology.set_fault_domains(region_name, ad, fds)
+            locations.append((ad, fds))
+        return locations
+
+    names = [region.region_name for region in regions]
+    if not names:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(names))) as pool:
+        return dict(zip(names, pool.map(region_locations, names)))
+
+
+def plan_units(profile, tenancy, regions, queries, locations, catalogs=None):
+    """
+    Expand a scan into its work units, in region/AD/FD/query order.
+
+    `locations` comes from list_locations(); with `catalogs`, shapes a
+    region does not offer get one region-level unit (AD/FD UNLISTED).
+    Returns: list of WorkUnit
+    """
+    units = []
+    for region in regions:
+        name = region.region_name
+        offered = catalogs.get(name) if catalogs is not None else None
+        for query in queries:
+            if offered is not None and query.shape not in offered:
+                units.append(WorkUnit(profile, tenancy, name, UNLISTED, UNLISTED, *query))
+        region_queries = [query for query in queries if offered is None or query.shape in offered]
+        for ad, fds in locations.get(name, []) if region_queries else []:
+            units.extend(WorkUnit(profile, tenancy, name, ad, fd, *query) for fd in fds for query in region_queries)
+    return units
+
+
+def plan_scan(scanner, profile, regions, queries, catalogs=None):
+    """
+    List the topology of a CapacityScanner's regions and expand it into work units.
+
+    Regions whose catalog offers none of the shapes are not listed.
+    Returns: list of WorkUnit
+    """
+    shapes = {query.shape for query in queries}
+    listed = [region for region in regions
+              if catalogs is None or catalogs.get(region.region_name) is None
+              or shapes & catalogs[region.region_name]]
+    locations = list_locations(scanner.clients, scanner.tenancy_id, listed, scanner.workers,
+                               scanner.region_workers, scanner.topology, scanner.limiter)
+    return plan_units(profile, scanner.name, regions, queries, locations, catalogs)
+
+
+def write_units(units, stream):
+    """Write work units as JSON Lines, one unit per line."""
+    for unit in units:
+        stream.write(json.dumps(unit._asdict()) + '\n')
+    stream.flush()
+
+
+def load_units(path):
+    """
+    Read a plan written by write_units().
+
+    Returns: list of WorkUnit in plan order
+    Raises: ValueError if the file cannot be read or a line is not a work unit
+    """
+    units = []
+    try:
+        with open(os.path.expanduser(path), 'r') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    units.append(WorkUnit(*(record[field] for field in WorkUnit._fields)))
+                except (KeyError, TypeError, ValueError):
+                    raise ValueError(f"{path}:{number} is not a work unit of `ocareport.py plan`")
+    except OSError as e:
+        raise ValueError(f"cannot read plan file {path}: {e.strerror}")
+    return units
+
+
+def _unit_calls(count, batch_size):
+    """Capacity report calls needed for `count` units of one AD."""
+    return -(-count // batch_size)
+
+
+def shard_units(units, index, count, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Return the units of shard `index` of `count` (1-based), keeping their plan positions.
+
+    Units of the same tenancy/region/AD stay on one shard, so their capacity
+    reports are still batched. ADs go, largest first, to the shard with the
+    fewest calls so far (ties to the lowest shard), which only depends on
+    the plan: every host computes the same split without talking to the others.
+    Returns: list of (position in the plan, WorkUnit)
+    """
+    groups = {}
+    for position, unit in enumerate(units):
+        key = (unit.profile, unit.region, unit.availability_domain)
+        groups.setdefault(key, []).append((position, unit))
+
+    loads = [0] * count
+    mine = []
+    by_size = sorted(groups.values(), key=lambda items: (-len(items), items[0][0]))
+    for items in by_size:
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        if items[0][1].fault_domain != UNLISTED:
+            loads[shard] += _unit_calls(len(items), batch_size)
+        if shard == index - 1:
+            mine.extend(items)
+    return sorted(mine)
+
+
+def iter_units(clients, tenancy_id, units, workers=DEFAULT_WORKERS, region_workers=DEFAULT_REGION_WORKERS,
+               batch_size=DEFAULT_BATCH_SIZE, limiter=None, deadline=None, on_error=None, hedger=None):
+    """
+    Query capacity for (position, WorkUnit) pairs of one tenancy, without topology listing.
+
+    `deadline`, `on_error` and `hedger` work as in modules.scanner.iter_capacity().
+    Yields: ((position,), CapacityResult); region-level units first, as
+    HARDWARE_NOT_SUPPORTED rows without any call, then the others in
+    completion order.
+    """
+    work = []
+    for position, unit in units:
+        query = ShapeQuery(unit.shape, unit.ocpus, unit.memory)
+        if unit.fault_domain == UNLISTED:
+            yield (position,), CapacityResult(unit.region, UNLISTED, UNLISTED, *query, 'HARDWARE_NOT_SUPPORTED')
+        else:
+            work.append(((position,), unit.region, unit.availability_domain, unit.fault_domain, query))
+    if work:
+        yield from iter_reports(clients, tenancy_id, work, workers, region_workers, batch_size, limiter,
+                                deadline, on_error, hedger)
+
+
+def _location(result, tenancy=None):
+    """Identity of a result row: tenancy, region, AD, FD, shape and config."""
+    return (tenancy, result.region, result.availability_domain, result.fault_domain,
+            result.shape, result.ocpus, result.memory)
+
+
+def merge_results(paths, units=None):
+    """
+    Combine the `-format jsonl` outputs of several shards.
+
+    When a location appears more than once (a shard was run again), its
+    latest row wins. With the plan's `units`, rows follow the plan order
+    and the units no output answers are returned; otherwise rows are sorted
+    by tenancy, region, AD, FD and shape/config.
+    Returns: (list of (order, CapacityResult), list of missing WorkUnit)
+    Raises: ValueError if a file cannot be read
+    """
+    latest = {}
+    for path in paths:
+        for result in load_results(path):
+            key = _location(result, result.tenancy)
+            if key not in latest or parse_utc(latest[key].checked_at) < parse_utc(result.checked_at):
+                latest[key] = result
+
+    if units is None:
+        return sorted((_sort_key(key), result) for key, result in latest.items()), []
+
+    # Shards tag rows with their tenancy only when the plan has several
+    several = len({unit.tenancy for unit in units}) > 1
+    rows, missing = [], []
+    for position, unit in enumerate(units):
+        key = (unit.tenancy if several else None, unit.region, unit.availability_domain, unit.fault_domain,
+               unit.shape, unit.ocpus, unit.memory)
+        result = latest.pop(key, None)
+        if result is None:
+            missing.append(unit)
+        else:
+            rows.append(((position,), result))
+    # Rows the plan does not know about (another plan's outputs) come last
+    rows.extend(sorted(((len(units),) + _sort_key(key), result) for key, result in latest.items()))
+    return rows, missing
+
+
+def _sort_key(key):
+    """Order of a location tuple, with no tenancy and fixed shapes (no ocpus/memory) first."""
+    tenancy, region, ad, fd, shape, ocpus, memory = key
+    return tenancy or '', region, ad, fd, shape, ocpus or 0.0, memory or 0.0
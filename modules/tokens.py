@@ -0,0 +1,194 @@
+# coding: utf-8
+"""On-disk cache of instance principal and delegation token signer state, reused across runs."""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+import oci
+from cryptography.hazmat.primitives import serialization
+
+from modules.cache import CACHE_VERSION, cache_dir, read_json, write_json_atomic
+
+# A cached token with less time than this left is not used: the signer is built afresh
+REFRESH_MARGIN = 300
+
+# Share of a token's lifetime after which a fresh one is fetched in the background
+REFRESH_AFTER = 0.5
+
+SIGNED_HEADERS = ["date", "(request-target)", "host"]
+
+
+def token_claims(token):
+    """Decode the claims of a security token (a JWT), without verifying it. Returns: dict"""
+    payload = token.split('.')[1]
+    return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+
+
+def signer_path(kind):
+    """Path of the cached signer state of an authentication method ('ip' or 'cs')."""
+    return os.path.join(cache_dir(), f'signer-{kind}.json')
+
+
+def _digest(delegation_token):
+    return hashlib.sha256(delegation_token.encode()).hexdigest() if delegation_token else None
+
+
+def read_signer_state(path, delegation_token=None, now=None):
+    """
+    Load cached signer state that can still be used.
+
+    The file is ignored unless it belongs to the current user and nobody
+    else can read or write it, its token has more than REFRESH_MARGIN seconds
+    left and, for CloudShell, it was issued for the same delegation token.
+    Returns: dict with token, private_key, tenancy_id, region; or None.
+    """
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    if status.st_mode & 0o077 or (hasattr(os, 'getuid') and status.st_uid != os.getuid()):
+        return None
+    state = read_json(path)
+    if not state or state.get('version') != CACHE_VERSION or state.get('delegation') != _digest(delegation_token):
+        return None
+    try:
+        expires = token_claims(state['token'])['exp']
+        private_key = serialization.load_pem_private_key(state['private_key'].encode(), password=None)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if expires - (time.time() if now is None else now) <= REFRESH_MARGIN:
+        return None
+    return dict(state, private_key=private_key)
+
+
+def write_signer_state(path, token, private_key, tenancy_id, region, delegation_token=None):
+    """Save signer state, readable by the current user only. Write errors are not fatal."""
+    pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    state = {
+        'version': CACHE_VERSION,
+        'token': token,
+        'private_key': pem.decode(),
+        'tenancy_id': tenancy_id,
+        'region': region,
+        'delegation': _digest(delegation_token),
+        'saved_at': time.time(),
+    }
+    try:
+        write_json_atomic(path, state)
+        os.chmod(path, 0o600)
+    except OSError:
+        pass
+
+
+class CachedTokenSigner(oci.auth.signers.SecurityTokenSigner):
+    """
+    Signs with a security token and session key saved by an earlier run, so
+    startup makes no metadata or token exchange calls.
+
+    `build()` returns a live signer (an X509FederationClientBasedSecurityTokenSigner)
+    and is only called when the token needs replacing: once REFRESH_AFTER of
+    its lifetime has passed, on a daemon thread while requests go on with the
+    current token, and inline when less than REFRESH_MARGIN seconds are left.
+    Every new token is saved for the next run. With a `delegation_token`
+    (CloudShell), requests carry it as the signer of the SDK does.
+    """
+
+    def __init__(self, token, private_key, tenancy_id, region, build, path, delegation_token=None, live=None):
+        self.tenancy_id = tenancy_id
+        self.region = region
+        self.build = build
+        self.path = path
+        self.delegation_token = delegation_token
+        self._live = live
+        self._refreshing = False
+        self._lock = threading.Lock()
+        headers = SIGNED_HEADERS + ['opc-obo-token'] if delegation_token else SIGNED_HEADERS
+        super().__init__(token, private_key, generic_headers=headers)
+        self._use(token, private_key)
+
+    @classmethod
+    def load(cls, kind, build, delegation_token=None):
+        """
+        Sign with the cached state of an authentication method, or with a newly
+        built signer (whose state is then saved) when there is none.
+
+        Returns: CachedTokenSigner
+        Raises: what build() raises
+        """
+        path = signer_path(kind)
+        state = read_signer_state(path, delegation_token)
+        if state:
+            return cls(state['token'], state['private_key'], state['tenancy_id'], state['region'], build, path,
+                       delegation_token)
+        live = build()
+        token, private_key = _live_state(live)
+        write_signer_state(path, token, private_key, live.tenancy_id, live.region, delegation_token)
+        return cls(token, private_key, live.tenancy_id, live.region, build, path, delegation_token, live)
+
+    def _use(self, token, private_key):
+        """Sign with a new token and key from now on."""
+        claims = token_claims(token)
+        self.expires = claims['exp']
+        self.refresh_at = claims['exp'] - (claims['exp'] - claims.get('iat', claims['exp'])) * (1 - REFRESH_AFTER)
+        self.api_key = oci.auth.signers.security_token_signer.SECURITY_TOKEN_FORMAT_STRING.format(token)
+        self.private_key = private_key
+        self._basic_signer.reset_signer(self.api_key, private_key)
+        self._body_signer.reset_signer(self.api_key, private_key)
+
+    def refresh_security_token(self, seen=None):
+        """
+        Fetch a new token and session key and save them; with `seen` (an
+        api_key), only if no other thread replaced that one meanwhile.
+
+        Raises: what build() raises
+        """
+        with self._lock:
+            if seen is not None and self.api_key != seen:
+                return
+            if self._live is None:
+                self._live = self.build()
+            else:
+                self._live.refresh_security_token()
+            token, private_key = _live_state(self._live)
+            self._use(token, private_key)
+        write_signer_state(self.path, token, private_key, self.tenancy_id, self.region, self.delegation_token)
+
+    def _refresh_in_background(self):
+        seen = self.api_key
+
+        def run():
+            try:
+                self.refresh_security_token(seen=seen)
+            except Exception:
+                # Requests go on with the current token; the inline refresh near expiry retries
+                pass
+            finally:
+                self._refreshing = False
+        threading.Thread(target=run, daemon=True).start()
+
+    def __call__(self, request, enforce_content_headers=True):
+        now = time.time()
+        if now >= self.expires - REFRESH_MARGIN:
+            self.refresh_security_token(seen=self.api_key)
+        elif now >= self.refresh_at and not self._refreshing:
+            with self._lock:
+                start, self._refreshing = not self._refreshing, True
+            if start:
+                self._refresh_in_background()
+        return super().__call__(request, enforce_content_headers)
+
+    def do_request_sign(self, request, enforce_content_headers=True):
+        if self.delegation_token:
+            request.headers['opc-obo-token'] = self.delegation_token
+        return super().do_request_sign(request, enforce_content_headers)
+
+
+def _live_state(signer):
+    """Returns: (token, private_key) a live signer currently signs with"""
+    client = signer.federation_client
+    return client.get_security_token(), client.session_key_supplier.get_key_pair()['private']
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""Watch mode: re-poll capacity with adaptive per-location intervals."""
+
+import heapq
+import time
+
+from modules.scanner import (
+    DEFAULT_WORKERS,
+    DEFAULT_REGION_WORKERS,
+    DEFAULT_BATCH_SIZE,
+    ShapeQuery,
+    iter_reports
+)
+from modules.options import DEFAULT_MAX_BACKOFF
+
+
+class PollSchedule:
+    """
+    Next poll time of every watched location.
+
+    A location whose status did not change waits twice as long before its next
+    poll, up to `max_backoff` times the base interval; a location that just
+    changed goes back to the base interval, so flapping capacity is followed
+    closely while stable locations cost few calls.
+    """
+
+    def __init__(self, interval, max_backoff=DEFAULT_MAX_BACKOFF):
+        self.interval = interval
+        self.max_interval = interval * max_backoff
+        self.status = {}
+        self.delay = {}
+        self.queue = []
+
+    def add(self, key, status, now):
+        """Start watching a location, first poll one base interval from now."""
+        self.status[key] = status
+        self.delay[key] = self.interval
+        heapq.heappush(self.queue, (now + self.interval, key))
+
+    def next_due(self):
+        """Time of the next scheduled poll, or None if nothing is watched."""
+        return self.queue[0][0] if self.queue else None
+
+    def due(self, now):
+        """Pop and return every location whose poll time has come."""
+        keys = []
+        while self.queue and self.queue[0][0] <= now:
+            keys.append(heapq.heappop(self.queue)[1])
+        return keys
+
+    def update(self, key, status, now):
+        """
+        Record a polled status and schedule the next poll.
+
+        Returns: the previous status if it changed, otherwise None.
+        """
+        previous = self.status.get(key)
+        if status == previous:
+            self.delay[key] = min(self.delay[key] * 2, self.max_interval)
+        else:
+            self.delay[key] = self.interval
+        self.status[key] = status
+        heapq.heappush(self.queue, (now + self.delay[key], key))
+        return previous if status != previous else None
+
+    def retry(self, keys, now):
+        """Reschedule locations whose poll failed at the base interval."""
+        for key in keys:
+            self.delay[key] = self.interval
+            heapq.heappush(self.queue, (now + self.interval, key))
+
+
+def watch_capacity(clients, tenancy_id, results, interval,
+                   max_backoff=DEFAULT_MAX_BACKOFF, workers=DEFAULT_WORKERS,
+                   region_workers=DEFAULT_REGION_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+                   limiter=None, on_error=None, rounds=None, clock=time.monotonic, sleep=time.sleep):
+    """
+    Re-poll the locations of an earlier scan and yield only status changes.
+
+    `results` is the list of (order, CapacityResult) of the initial scan; its
+    topology is reused, so only capacity reports are called. Due locations
+    of the same AD are polled in one batch. A failed round is passed to
+    `on_error` (or raised if not given) and retried at the base interval.
+    Runs until closed, or for `rounds` polling rounds.
+
+    Yields: (order, CapacityResult, previous_status) for each transition.
+    """
+    schedule = PollSchedule(interval, max_backoff)
+    locations = {}
+    now = clock()
+    for order, result in results:
+        locations[order] = result
+        schedule.add(order, result.status, now)
+
+    done_rounds = 0
+    while schedule.next_due() is not None and (rounds is None or done_rounds < rounds):
+        wait_time = schedule.next_due() - clock()
+        if wait_time > 0:
+            sleep(wait_time)
+
+        due = schedule.due(clock())
+        work = [
+            (order, r.region, r.availability_domain, r.fault_domain, ShapeQuery(r.shape, r.ocpus, r.memory))
+            for order, r in ((order, locations[order]) for order in due)
+        ]
+        polled = set()
+        try:
+            for order, result in iter_reports(clients, tenancy_id, work, workers, region_workers,
+                                              batch_size, limiter):
+                polled.add(order)
+                locations[order] = result
+                previous = schedule.update(order, result.status, clock())
+                if previous is not None:
+                    yield order, result, previous
+        except Exception as e:
+            schedule.retry([order for order in due if order not in polled], clock())
+            if on_error is None:
+                raise
+            on_error(e)
+        done_rounds += 1
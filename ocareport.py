@@ -7,166 +7,1060 @@ and fault domains using the Compute Capacity Report API.
 """
 
 import argparse
-import oci
-from rich import box
-from rich.console import Console
-from rich.table import Table
-
-from modules.utils import green, yellow, print_info, clear
-from modules.identity import (
-    init_authentication,
-    get_region_subscription_list,
-    get_availability_domains,
-    get_fault_domains
+import contextlib
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import sys
+import time
+
+# Only light modules are imported up front, so that --help, argument errors
+# and `query` answer without loading the OCI SDK or rich; the functions
+# that need those import them when they run
+from modules.utils import green, yellow, print_info, print_error, clear
+from modules.history import HISTORY_GROUPS, HistoryRecorder, connect, history_path, query_history
+from modules.options import (
+    DEFAULT_CACHE_TTL,
+    DEFAULT_MAX_BACKOFF,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_RATE,
+    DEFAULT_REGION_WORKERS,
+    DEFAULT_STALE_AFTER,
+    DEFAULT_TOPOLOGY_TTL,
+    DEFAULT_WORKERS,
+    METRICS_FORMATS,
+    OUTPUT_FORMATS,
+    is_flex_shape
 )
 
 VERSION = '1.1.0'
 
 
-def parse_arguments():
-    """Parse command line arguments."""
-    parser = argparse.ArgumentParser(
-        description='Check OCI compute shape availability across regions'
-    )
+def __getattr__(name):
+    # create_capacity_report used to be imported here; keep it reachable,
+    # and offer the library API from the same place
+    if name == 'create_capacity_report':
+        from modules.scanner import create_capacity_report
+        return create_capacity_report
+    if name == 'CapacityScanner':
+        from modules.api import CapacityScanner
+        return CapacityScanner
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    # Authentication options
+
+def add_auth_arguments(parser, several_profiles=False):
+    """Add the authentication options; with `several_profiles`, -profile takes a list."""
     parser.add_argument('-auth', default='', dest='auth_method',
                         choices=['cs', 'cf', 'ip', ''],
                         help="Authentication method: 'cs' (CloudShell), 'cf' (config file), 'ip' (instance principals)")
     parser.add_argument('-config_file', default='~/.oci/config', dest='config_file_path',
                         help='Path to OCI config file (default: ~/.oci/config)')
-    parser.add_argument('-profile', default='DEFAULT', dest='config_profile',
-                        help='Config file profile section (default: DEFAULT)')
+    if several_profiles:
+        parser.add_argument('-profile', nargs='+', default=['DEFAULT'], dest='config_profile',
+                            help="Config file profile sections, space or comma separated, or ALL for every "
+                                 "profile of the config file; several are scanned concurrently (default: DEFAULT)")
+    else:
+        parser.add_argument('-profile', default='DEFAULT', dest='config_profile',
+                            help='Config file profile section (default: DEFAULT)')
+    parser.add_argument('-trust-auth', action='store_true', dest='trust_auth',
+                        help='Skip the tenancy lookup that validates credentials (uses cached tenancy details)')
+    parser.add_argument('-parallel-auth', action='store_true', dest='parallel_auth',
+                        help='Probe all authentication methods concurrently')
+    parser.add_argument('-cache-auth', action='store_true', dest='cache_auth',
+                        help='Reuse the CloudShell/Instance Principals security token of an earlier run '
+                             'while it is valid (cached, readable by the current user only)')
 
-    # Query options
+
+def add_limit_arguments(parser):
+    """Add the concurrency and rate limit options."""
+    parser.add_argument('-workers', type=int, default=DEFAULT_WORKERS, dest='workers',
+                        help=f'Maximum number of concurrent API calls (default: {DEFAULT_WORKERS})')
+    parser.add_argument('-region-workers', type=int, default=DEFAULT_REGION_WORKERS, dest='region_workers',
+                        help=f'Maximum number of concurrent API calls per region (default: {DEFAULT_REGION_WORKERS})')
+    parser.add_argument('-rate', type=float, default=DEFAULT_RATE, dest='rate',
+                        help=f'Maximum API calls per second per region (default: {DEFAULT_RATE:g})')
+    parser.add_argument('-max-retries', type=int, default=DEFAULT_MAX_RETRIES, dest='max_retries',
+                        help=f'Retries of throttled (429) or failed (5xx) calls (default: {DEFAULT_MAX_RETRIES})')
+    parser.add_argument('-call-timeout', type=float, default=0, dest='call_timeout', metavar='SECONDS',
+                        help='Read timeout of each API call (default: the -deadline if set, else 60)')
+
+
+def check_limit_arguments(args):
+    """Validate the concurrency and rate limit options. Raises: ValueError"""
+    if args.workers < 1 or args.region_workers < 1:
+        raise ValueError('-workers and -region-workers must be at least 1')
+    if args.rate <= 0 or args.max_retries < 0:
+        raise ValueError('-rate must be positive and -max-retries cannot be negative')
+    if args.call_timeout < 0:
+        raise ValueError('-call-timeout cannot be negative')
+
+
+def client_timeout(args):
+    """
+    Return the SDK client kwargs for -call-timeout; without it a -deadline
+    bounds every call, and without either the SDK defaults apply.
+    """
+    seconds = args.call_timeout or getattr(args, 'deadline', 0)
+    return {'timeout': (min(10.0, seconds), seconds)} if seconds else {}
+
+
+def add_topology_arguments(parser):
+    """Add the topology cache options."""
+    parser.add_argument('-refresh-topology', action='store_true', dest='refresh_topology',
+                        help='Ignore the cached regions/ADs/FDs/shape catalogs and list them again')
+    parser.add_argument('-topology-ttl', type=float, default=DEFAULT_TOPOLOGY_TTL / 3600, dest='topology_ttl',
+                        help=f'Hours before cached regions/ADs/FDs are listed again (default: {DEFAULT_TOPOLOGY_TTL // 3600})')
+
+
+def add_query_arguments(parser, shape_help='(required)'):
+    """Add the options that choose what to scan: regions, shapes and flex configs."""
     parser.add_argument('-region', default='', dest='region',
                         help="Region to analyze: specific region name, 'all' for all regions, or empty for home region")
-    parser.add_argument('-shape', default='', dest='shape', required=True,
-                        help='Compute shape name to check (required)')
-    parser.add_argument('-ocpus', type=float, default=1, dest='ocpu',
-                        help='OCPU count for flex shapes (default: 1)')
-    parser.add_argument('-memory', type=float, default=1, dest='memory',
-                        help='Memory in GB for flex shapes (default: 1)')
+    parser.add_argument('-shape', nargs='+', dest='shape', required=shape_help == '(required)',
+                        help='Compute shape names to check, space or comma separated, '
+                             f'or @file with one shape per line {shape_help}')
+    parser.add_argument('-ocpus', nargs='+', default=['1'], dest='ocpu',
+                        help='OCPU counts for flex shapes: values, comma lists or start:stop[:step] ranges (default: 1)')
+    parser.add_argument('-memory', nargs='+', default=['1'], dest='memory',
+                        help='Memory in GB for flex shapes: values, comma lists or start:stop[:step] ranges (default: 1)')
+    parser.add_argument('-priority', nargs='+', default=[], dest='priority',
+                        help='Regions to probe first, in order (space or comma separated)')
+    parser.add_argument('-catalog', action='store_true', dest='catalog',
+                        help='List the shapes each region offers first: skip regions without the shapes '
+                             'and reject unknown shape names before scanning')
 
-    return parser.parse_args()
 
+def expand_query_arguments(args):
+    """Expand the -profile, -shape, -ocpus, -memory and -priority lists. Raises: ValueError"""
+    args.profiles = expand_profiles(args.config_profile, args.config_file_path)
+    args.config_profile = args.profiles[0]
+    check_profiles(args)
+    args.shape = expand_shapes(args.shape)
+    args.ocpu = expand_numbers(args.ocpu)
+    args.memory = expand_numbers(args.memory)
+    args.priority = [name.strip() for value in args.priority for name in value.split(',') if name.strip()]
 
-def create_capacity_report(core_client, compartment_id, availability_domain,
-                           fault_domain, shape, is_flex=False, ocpu=1.0, memory=1.0):
-    """
-    Query the Compute Capacity Report API for shape availability.
 
-    Returns: availability_status string ('AVAILABLE', 'HARDWARE_NOT_SUPPORTED', 'OUT_OF_HOST_CAPACITY')
+def check_profiles(args):
+    """Validate the authentication of several profiles. Raises: ValueError"""
+    if len(args.profiles) > 1 and args.auth_method not in ('', 'cf'):
+        raise ValueError('several profiles need config file authentication (-auth cf)')
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Check OCI compute shape availability across regions'
+    )
+
+    add_auth_arguments(parser, several_profiles=True)
+
+    # Query options
+    add_query_arguments(parser, shape_help='(required unless -units)')
+
+    # Scan options
+    add_limit_arguments(parser)
+
+    parser.add_argument('-first', type=int, default=0, dest='first',
+                        help='Stop as soon as this many AVAILABLE locations are found')
+
+    parser.add_argument('-probe', action='store_true', dest='probe',
+                        help='Find the largest available config of flex shapes in each fault domain, '
+                             'searching the -ocpus and -memory values')
+
+    parser.add_argument('-since', default='', dest='since', metavar='FILE',
+                        help='Re-check only what changes from an earlier -format jsonl run: fresh AVAILABLE and '
+                             'HARDWARE_NOT_SUPPORTED rows are carried forward with their age')
+    parser.add_argument('-stale-after', type=float, default=DEFAULT_STALE_AFTER / 60, dest='stale_after',
+                        metavar='MINUTES',
+                        help=f'With -since, re-check rows older than this (default: {DEFAULT_STALE_AFTER // 60})')
+
+    parser.add_argument('-units', default='', dest='units_file', metavar='FILE',
+                        help='Run the work units of a plan written by `ocareport.py plan` instead of -shape/-region')
+    parser.add_argument('-shard', default='1/1', dest='shard', metavar='I/N',
+                        help='With -units, run only slice I of N; every host computes the same split (default: 1/1)')
+
+    parser.add_argument('-deadline', type=float, default=0, dest='deadline', metavar='SECONDS',
+                        help='Stop the scan SECONDS after the start of the run: unanswered locations are reported '
+                             'as TIMEOUT and every completed row is still written')
+
+    parser.add_argument('-hedge', type=float, default=0, dest='hedge', metavar='PERCENT',
+                        help="Send a duplicate of capacity report calls still running past their region's p95 "
+                             'latency, up to PERCENT%% extra calls; the first answer wins (default: 0, off)')
+
+    parser.add_argument('-dry-run', action='store_true', dest='dry_run',
+                        help='Resolve the topology and estimate the API calls and run time of the scan, '
+                             'with cheaper alternatives, without sending any capacity report')
+
+    parser.add_argument('-watch', type=float, default=0, dest='watch', metavar='SECONDS',
+                        help='Keep polling every SECONDS and print only status changes')
+    parser.add_argument('-watch-max-backoff', type=int, default=DEFAULT_MAX_BACKOFF, dest='watch_max_backoff',
+                        help=f'In watch mode, poll unchanged locations at most every N intervals (default: {DEFAULT_MAX_BACKOFF})')
+
+    # Output options
+    parser.add_argument('-format', default='table', dest='output_format', choices=OUTPUT_FORMATS,
+                        help="Output format: 'table' (live table), 'jsonl' or 'csv' (rows streamed to stdout)")
+
+    # Instrumentation options
+    parser.add_argument('-timings', action='store_true', dest='timings',
+                        help='Print where the time went: stages, API latency per operation, slowest regions')
+    parser.add_argument('-metrics', default='', dest='metrics_file', metavar='FILE',
+                        help='Write per-region, per-operation API call metrics to FILE')
+    parser.add_argument('-metrics-format', default='json', dest='metrics_format', choices=METRICS_FORMATS,
+                        help="Format of the -metrics file: 'json' or 'prometheus' (default: json)")
+
+    # History options
+    parser.add_argument('-history', default='', dest='history_file', metavar='FILE',
+                        help='SQLite file the results are appended to (default: history.sqlite in the cache directory)')
+    parser.add_argument('-no-history', action='store_true', dest='no_history',
+                        help='Do not record the results in the history file')
+
+    # Cache options
+    add_topology_arguments(parser)
+
+    args = parser.parse_args()
+    try:
+        args.units = None
+        args.several_tenancies = False
+        if args.units_file:
+            load_shard(args)
+        elif args.shard != '1/1':
+            raise ValueError('-shard needs a plan (-units FILE)')
+        elif not args.shape:
+            raise ValueError('-shape is required, or -units with a plan written by `ocareport.py plan`')
+        else:
+            expand_query_arguments(args)
+        if len(args.profiles) > 1 and args.watch:
+            raise ValueError('-watch works with a single profile')
+        if args.first < 0:
+            raise ValueError('-first must be a positive number')
+        check_limit_arguments(args)
+        if args.watch < 0 or args.watch_max_backoff < 1:
+            raise ValueError('-watch and -watch-max-backoff must be positive numbers')
+        if args.first and args.watch:
+            raise ValueError('-first and -watch cannot be combined')
+        if args.deadline < 0:
+            raise ValueError('-deadline cannot be negative')
+        if args.deadline and args.watch:
+            raise ValueError('-deadline and -watch cannot be combined')
+        if not 0 <= args.hedge <= 100:
+            raise ValueError('-hedge must be between 0 and 100 (percent of extra calls)')
+        if args.probe and (args.first or args.watch):
+            raise ValueError('-probe cannot be combined with -first or -watch')
+        if args.probe and not all(is_flex_shape(shape) for shape in args.shape):
+            raise ValueError('-probe only works with flex shapes')
+        if args.stale_after < 0:
+            raise ValueError('-stale-after cannot be negative')
+        if args.dry_run and (args.units_file or args.probe or args.since or args.watch):
+            raise ValueError('-dry-run estimates regular scans: -units, -probe, -since and -watch are not estimated')
+        if args.dry_run and args.output_format == 'csv':
+            raise ValueError("-dry-run writes a table or, with -format jsonl, one JSON line per strategy")
+        args.previous = None
+        if args.since:
+            if args.probe:
+                raise ValueError('-since cannot be combined with -probe')
+            from modules.incremental import load_results
+            args.previous = load_results(args.since)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def load_shard(args):
     """
-    shape_config = None
-    if is_flex:
-        shape_config = oci.core.models.CapacityReportInstanceShapeConfig(
-            ocpus=ocpu,
-            memory_in_gbs=memory
-        )
+    Read the -units plan and keep the units of this -shard; the profiles to
+    log in with come from the plan. Raises: ValueError
+    """
+    from modules.shard import load_units, parse_shard, shard_units
 
-    report_details = oci.core.models.CreateComputeCapacityReportDetails(
-        compartment_id=compartment_id,
-        availability_domain=availability_domain,
-        shape_availabilities=[
-            oci.core.models.CreateCapacityReportShapeAvailabilityDetails(
-                instance_shape=shape,
-                fault_domain=fault_domain,
-                instance_shape_config=shape_config
-            )
-        ]
+    if args.shape or args.region or args.priority or args.catalog or args.probe or args.since or args.watch:
+        raise ValueError('-units runs a plan as written: -shape, -region, -priority, -catalog, -probe, -since '
+                         'and -watch belong to `ocareport.py plan` or a regular scan')
+    index, count = parse_shard(args.shard)
+    plan = load_units(args.units_file)
+    args.units = shard_units(plan, index, count)
+    # Rows are tagged with their tenancy whenever the plan spans several, so shards merge alike
+    args.several_tenancies = len({unit.tenancy for unit in plan}) > 1
+    args.profiles = list(dict.fromkeys(unit.profile for _, unit in args.units)) or [args.config_profile[0]]
+    args.config_profile = args.profiles[0]
+    args.shape = list(dict.fromkeys(unit.shape for _, unit in args.units))
+    check_profiles(args)
+
+
+def parse_plan_arguments(argv):
+    """Parse the arguments of the `plan` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog='ocareport.py plan',
+        description='Write the work units of a scan (one region/AD/FD/shape/config per line) for sharded runs'
     )
+    add_auth_arguments(parser, several_profiles=True)
+    add_query_arguments(parser)
+    add_limit_arguments(parser)
+    add_topology_arguments(parser)
+    # login() is shared with scans, which also know these
+    parser.set_defaults(probe=False, previous=None, units=None)
+    args = parser.parse_args(argv)
+    try:
+        expand_query_arguments(args)
+        check_limit_arguments(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def plan_command(argv):
+    """Write the work units of a scan to stdout; the banner goes to stderr."""
+    import oci
+    from modules.metrics import Metrics
+    from modules.shard import plan_scan, write_units
+
+    args = parse_plan_arguments(argv)
+    metrics = Metrics()
+    with contextlib.redirect_stdout(sys.stderr):
+        sessions, queries = login(args, metrics)
+        try:
+            plans = for_each_session(lambda session: plan_scan(
+                session.scanner, session.profile, session.regions, queries, session.catalogs
+            ), sessions)
+        except oci.exceptions.ServiceError as e:
+            print_error('Topology error:', e.message)
+            raise SystemExit(1)
+        finally:
+            for session in sessions:
+                session.scanner.save()
+    units = [unit for plan in plans for unit in plan]
+    write_units(units, sys.stdout)
+
+    ads = {(unit.profile, unit.region, unit.availability_domain) for unit in units}
+    with contextlib.redirect_stdout(sys.stderr):
+        print_info(green, 'Plan', 'work units', f'{len(units)} in {len(ads)} availability domains')
+
 
-    report = core_client.create_compute_capacity_report(
-        create_compute_capacity_report_details=report_details
+def parse_merge_arguments(argv):
+    """Parse the arguments of the `merge` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog='ocareport.py merge',
+        description='Combine the -format jsonl outputs of sharded runs into one report'
     )
+    parser.add_argument('files', nargs='+', metavar='FILE', help='-format jsonl outputs of the shards')
+    parser.add_argument('-units', default='', dest='units_file', metavar='FILE',
+                        help='The plan the shards ran: rows follow its order and missing units are reported')
+    parser.add_argument('-format', default='table', dest='output_format', choices=OUTPUT_FORMATS,
+                        help="Output format: 'table', 'jsonl' or 'csv' (default: table)")
+    return parser.parse_args(argv)
 
-    return report.data.shape_availabilities[0].availability_status
 
+def merge_command(argv):
+    """Print the merged results of sharded runs, without calling OCI."""
+    from rich.console import Console
+    from modules.output import create_writer
+    from modules.scanner import ERROR, TIMEOUT, ShapeQuery
+    from modules.shard import load_units, merge_results
 
-def main():
-    """Main entry point."""
-    clear()
+    args = parse_merge_arguments(argv)
+    try:
+        units = load_units(args.units_file) if args.units_file else None
+        rows, missing = merge_results(args.files, units)
+    except ValueError as e:
+        print_error(str(e))
+        raise SystemExit(1)
+
+    streaming = args.output_format != 'table'
+    console = Console(stderr=streaming)
+    queries = list(dict.fromkeys(ShapeQuery(r.shape, r.ocpus, r.memory) for _, r in rows))
+    writer = create_writer(args.output_format, console, sys.stdout, queries,
+                           tenancies=any(r.tenancy for _, r in rows), ages=True)
+    writer.carried_as = f"merged from {len(args.files)} file{'s' if len(args.files) > 1 else ''}"
+    for order, result in rows:
+        writer.write(order, result)
+    writer.close()
+
+    for unit in missing[:3]:
+        console.print(f"[red]Missing:[/red] {unit.region} {unit.availability_domain} {unit.fault_domain} "
+                      f"{unit.shape}", highlight=False)
+    if missing:
+        console.print(f"[red]{len(missing)} planned locations have no row[/red] - run their shards again")
+    # Incomplete results are a failure for scripts, as in a scan
+    if missing or writer.counts[TIMEOUT] or writer.counts[ERROR]:
+        raise SystemExit(1)
+
+
+def parse_query_arguments(argv):
+    """Parse the arguments of the `query` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog='ocareport.py query',
+        description='Summarize recorded capacity results from the history file'
+    )
+    parser.add_argument('-shape', required=True, dest='shape', help='Compute shape name (required)')
+    parser.add_argument('-region', default=None, dest='region', help='Only this region')
+    parser.add_argument('-days', type=float, default=7, dest='days',
+                        help='Look back this many days (default: 7, 0 for all history)')
+    parser.add_argument('-ocpus', type=float, default=None, dest='ocpu', help='Only this flex OCPU count')
+    parser.add_argument('-memory', type=float, default=None, dest='memory', help='Only this flex memory size (GB)')
+    parser.add_argument('-by', default='region', dest='group_by', choices=list(HISTORY_GROUPS),
+                        help="Group by 'region', 'ad', 'fd', 'config' or 'day' (default: region)")
+    parser.add_argument('-history', default='', dest='history_file', metavar='FILE',
+                        help='SQLite history file (default: history.sqlite in the cache directory)')
+    parser.add_argument('-format', default='table', dest='output_format', choices=['table', 'jsonl'],
+                        help="Output format: 'table' or 'jsonl'")
+    args = parser.parse_args(argv)
+    if args.days < 0:
+        parser.error('-days cannot be negative')
+    return args
+
+
+def query_command(argv):
+    """Answer a `query` subcommand from the history file, without calling OCI."""
+    args = parse_query_arguments(argv)
+    path = args.history_file or history_path()
+    if not os.path.exists(path):
+        print_error(f'No history file at {path}', 'Run a scan first, or point -history at the file')
+        raise SystemExit(1)
+
+    start = time.perf_counter()
+    since = time.time() - args.days * 86400 if args.days else None
+    with contextlib.closing(connect(path)) as connection:
+        rows = query_history(connection, args.shape, region=args.region, since=since, group_by=args.group_by,
+                             ocpus=args.ocpu, memory=args.memory)
+    elapsed = time.perf_counter() - start
+
+    if args.output_format == 'jsonl':
+        for row in rows:
+            print(json.dumps(row))
+        return
+
+    from rich import box
+    from rich.console import Console
+    from rich.table import Table
+
+    period = f'last {args.days:g} days' if args.days else 'all history'
+    table = Table(title=f"Shape: {args.shape} | {period}", box=box.MARKDOWN)
+    table.add_column(args.group_by.upper(), justify='left')
+    for column in ('SCANS', 'CHECKS', 'AVAILABLE', 'AVAILABILITY'):
+        table.add_column(column, justify='right')
+    table.add_column('LAST AVAILABLE (UTC)', justify='left', no_wrap=True)
+    for row in rows:
+        last = row['last_available'][:16].replace('T', ' ') if row['last_available'] else '-'
+        table.add_row(row[args.group_by], str(row['scans']), str(row['checks']), str(row['available']),
+                      f"{row['availability']:.0%}", last,
+                      style='green' if row['available'] else 'red')
     console = Console()
-    args = parse_arguments()
+    console.print(table)
+    console.print(f"{sum(row['checks'] for row in rows)} checks in {elapsed * 1000:.1f} ms", style='bold')
+
+
+def parse_serve_arguments(argv):
+    """Parse the arguments of the `serve` subcommand."""
+    parser = argparse.ArgumentParser(
+        prog='ocareport.py serve',
+        description='Serve capacity queries over a local HTTP/JSON API, reusing one login and cached results'
+    )
+    add_auth_arguments(parser)
+    parser.add_argument('-host', default='127.0.0.1', dest='host', help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-port', type=int, default=8080, dest='port', help='Port to listen on (default: 8080)')
+    parser.add_argument('-cache-ttl', type=float, default=DEFAULT_CACHE_TTL, dest='cache_ttl',
+                        help=f'Seconds a scan result is served from cache (default: {DEFAULT_CACHE_TTL:g})')
+    parser.add_argument('-verbose', action='store_true', dest='verbose', help='Log every request')
+    add_limit_arguments(parser)
+    add_topology_arguments(parser)
+    args = parser.parse_args(argv)
+    try:
+        check_limit_arguments(args)
+        if args.cache_ttl < 0:
+            raise ValueError('-cache-ttl cannot be negative')
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def create_service(args, metrics):
+    """
+    Log in once and build the capacity service and its HTTP server.
+
+    Returns: CapacityServer
+    """
+    from modules.service import CapacityServer, CapacityService
+
+    scanner = authenticate(args, metrics)[0].scanner
+    regions = scanner.regions('all')
+    scanner.save()
+    service = CapacityService(scanner.clients, scanner.tenancy_id, regions, scanner.topology, scanner.limiter,
+                              ttl=args.cache_ttl, workers=args.workers, region_workers=args.region_workers)
+    server = CapacityServer(service, args.host, args.port, verbose=args.verbose)
+
+    host, port = server.server_address[:2]
+    print_info(green, 'Regions', 'subscribed', len(regions))
+    print_info(green, 'Serving', 'address', f'http://{host}:{port}/capacity')
+    print_info(green, 'Serving', 'cache TTL', f'{args.cache_ttl:g}s')
+    print(green(f"{'*'*94}\n"))
+    return server
+
+
+def serve_command(argv):
+    """Run the capacity service until interrupted."""
+    from modules.metrics import Metrics
+
+    args = parse_serve_arguments(argv)
+    server = create_service(args, Metrics())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.topology.save()
+
+
+def expand_profiles(values, config_file_path):
+    """
+    Expand -profile values into a list of profile names.
+
+    Accepts space or comma separated names; ALL stands for every profile of
+    the config file.
+    """
+    profiles = []
+    for value in values:
+        for name in filter(None, (part.strip() for part in value.split(','))):
+            if name == 'ALL':
+                from modules.identity import config_profiles
+                names = config_profiles(config_file_path)
+            else:
+                names = [name]
+            profiles.extend(profile for profile in names if profile not in profiles)
+
+    if not profiles:
+        raise ValueError('no profile found')
+    return profiles
+
+
+def expand_shapes(values):
+    """
+    Expand -shape values into a list of shape names.
+
+    Accepts space or comma separated names and @file references
+    (one shape per line, blank lines and # comments ignored).
+    """
+    shapes = []
+    for value in values:
+        if value.startswith('@'):
+            try:
+                with open(os.path.expanduser(value[1:]), 'r') as f:
+                    lines = [line.split('#', 1)[0].strip() for line in f]
+            except OSError as e:
+                raise ValueError(f"cannot read shape file {value[1:]}: {e.strerror}")
+            names = [line for line in lines if line]
+        else:
+            names = [name.strip() for name in value.split(',') if name.strip()]
+        shapes.extend(name for name in names if name not in shapes)
+
+    if not shapes:
+        raise ValueError('no shape specified')
+    return shapes
+
+
+def expand_numbers(values):
+    """
+    Expand -ocpus/-memory values into a sorted list of numbers.
+
+    Accepts space or comma separated numbers and inclusive start:stop[:step]
+    ranges (default step: 1), e.g. '1,2,4' or '8:64:8'.
+    """
+    numbers = set()
+    for value in values:
+        for item in filter(None, (part.strip() for part in value.split(','))):
+            try:
+                bounds = [float(part) for part in item.split(':')]
+            except ValueError:
+                raise ValueError(f"invalid number or range: '{item}'")
+
+            if len(bounds) == 1:
+                numbers.add(bounds[0])
+                continue
+            if len(bounds) > 3 or (len(bounds) == 3 and bounds[2] <= 0) or bounds[1] < bounds[0]:
+                raise ValueError(f"invalid range: '{item}' (expected start:stop[:step])")
+
+            start, stop = bounds[0], bounds[1]
+            step = bounds[2] if len(bounds) == 3 else 1.0
+            count = int((stop - start) / step + 1e-9)
+            numbers.update(round(start + i * step, 6) for i in range(count + 1))
+
+    if not numbers or min(numbers) <= 0:
+        raise ValueError('OCPU and memory values must be positive')
+    return sorted(numbers)
+
+
+# One tenancy of a run: the profile it logged in with, its CapacityScanner, and the
+# regions, catalogs, -since plan and -units work set by login()
+Session = namedtuple('Session', ['profile', 'scanner', 'regions', 'catalogs', 'plan', 'units'])
+
+
+def for_each_session(function, sessions):
+    """Call function(session) for every session, concurrently when there are several. Returns: list"""
+    if len(sessions) == 1:
+        return [function(sessions[0])]
+    with ThreadPoolExecutor(max_workers=len(sessions)) as pool:
+        return list(pool.map(function, sessions))
+
+
+def authenticate(args, metrics, deadline=None):
+    """
+    Print the banner header, authenticate every -profile and set up a scanner for each.
+
+    Returns: list of Session (without regions and catalogs)
+    """
+    from modules.api import CapacityScanner
+    from modules.identity import authenticate_profiles, init_authentication
+    from modules.metrics import read_latencies
+    from modules.ratelimit import RateLimiter
 
-    # Print banner
     print(green(f"\n{'*'*94}"))
     print_info(green, 'Script', 'version', VERSION)
 
-    # Initialize authentication
-    config, signer, tenancy, auth_name, details, tenancy_id = init_authentication(
-        args.auth_method,
-        args.config_file_path,
-        args.config_profile
-    )
+    # Initialize authentication; several profiles are logged in concurrently
+    profiles = getattr(args, 'profiles', [args.config_profile])
+    with metrics.stage('auth'):
+        if len(profiles) > 1:
+            logins = authenticate_profiles(args.config_file_path, profiles, trust=args.trust_auth)
+        else:
+            logins = [init_authentication(
+                args.auth_method,
+                args.config_file_path,
+                args.config_profile,
+                trust=args.trust_auth,
+                parallel=args.parallel_auth,
+                cache_signer=args.cache_auth
+            )]
 
     # Clear any auth progress messages
     print("\r" + " " * 60 + "\r", end='', flush=True)
 
-    print_info(green, 'Login', 'success', auth_name)
-    print_info(green, 'Login', 'profile', details)
-    print_info(green, 'Tenancy', tenancy.name, f'home region: {tenancy.home_region_key}')
+    # One hedge budget for the whole run, whatever the number of tenancies
+    hedger = None
+    if getattr(args, 'hedge', 0):
+        from modules.hedge import Hedger
+        hedger = Hedger(args.hedge / 100, read_latencies())
+
+    sessions = []
+    for login in logins:
+        _, _, tenancy, auth_name, details, _ = login
+        # Profiles logged in together all use config file auth, named in `details`
+        profile = details if len(profiles) > 1 else args.config_profile
+        print_info(green, 'Login', 'success', auth_name)
+        print_info(green, 'Login', 'profile', details)
+        print_info(green, 'Tenancy', tenancy.name, f'home region: {tenancy.home_region_key}')
+
+        # Clients are built once per region and the topology is cached on disk
+        # per tenancy; one limiter per tenancy paces every call of the run, so
+        # throttling in a region slows that region of that tenancy down
+        limiter = RateLimiter(rate=args.rate, max_concurrency=args.region_workers, max_retries=args.max_retries,
+                              deadline=deadline)
+        scanner = CapacityScanner.from_login(
+            login, metrics, topology_ttl=args.topology_ttl * 3600, refresh_topology=args.refresh_topology,
+            limiter=limiter, workers=args.workers, region_workers=args.region_workers, hedger=hedger,
+            **client_timeout(args)
+        )
+        sessions.append(Session(profile, scanner, None, None, None, None))
+    return sessions
+
 
-    # Initialize identity client
-    identity_client = oci.identity.IdentityClient(config=config, signer=signer)
+def select_regions(args, sessions):
+    """Resolve the -region of every session and print it. Returns: list of region lists"""
+    import oci
+
+    try:
+        regions = for_each_session(lambda session: session.scanner.regions(args.region, args.priority), sessions)
+    except ValueError as e:
+        print_error(str(e))
+        raise SystemExit(1)
+    except oci.exceptions.ServiceError as e:
+        print_error("Region error:", str(e))
+        raise SystemExit(1)
+    print_info(green, 'Region', 'analyzed', 'all subscribed regions' if args.region.lower() == 'all'
+               else args.region or regions[0][0].region_name)
+    return regions
+
+
+def login(args, metrics, deadline=None):
+    """
+    Print the banner, authenticate and resolve the regions to analyze in every tenancy.
+
+    Returns: (list of Session, queries)
+    """
+    from modules.catalog import unknown_shapes
+    from modules.output import format_number
+    from modules.scanner import build_queries
+
+    sessions = authenticate(args, metrics, deadline)
+    if args.units is not None:
+        return login_units(args, sessions)
 
     # Get regions to analyze
-    regions = get_region_subscription_list(
-        identity_client,
-        tenancy_id,
-        args.region
-    )
+    with metrics.stage('regions'):
+        regions = select_regions(args, sessions)
+    sessions = [session._replace(regions=names) for session, names in zip(sessions, regions)]
+
+    # Shape catalogs, so regions that cannot host the shapes are skipped
+    if args.catalog:
+        # A region whose catalog call fails or misses the deadline is scanned in full
+        failures = []
+        with metrics.stage('catalog'):
+            catalogs = for_each_session(lambda session: session.scanner.catalogs(
+                session.regions, deadline, failures.append), sessions)
+        sessions = [session._replace(catalogs=catalog) for session, catalog in zip(sessions, catalogs)]
+        for message, count in Counter(getattr(e, 'message', None) or str(e) for e in failures).most_common(3):
+            print_info(yellow, 'Catalog', 'failed', f"{count} call{'s' if count > 1 else ''} - {message}")
+        everywhere = {region: shapes for session in sessions
+                      for region, shapes in ((f'{session.scanner.name}/{name}', names)
+                                             for name, names in session.catalogs.items())}
+        unknown = unknown_shapes(args.shape, everywhere)
+        if unknown:
+            for session in sessions:
+                session.scanner.save()
+            for shape, suggestions in unknown:
+                hint = f" - did you mean {', '.join(suggestions)}?" if suggestions else ''
+                print_error(f"Shape '{shape}' is not offered in any scanned region{hint}")
+            raise SystemExit(1)
+        offering = sum(1 for names in everywhere.values()
+                       if names is not None and any(shape in names for shape in args.shape))
+        print_info(green, 'Catalog', 'regions', f'{offering} of {len(everywhere)} offer the shapes')
+        unknown = sum(1 for names in everywhere.values() if names is None)
+        if unknown:
+            print_info(yellow, 'Catalog', 'unknown', f'{unknown} regions, scanned in full')
 
     # Print shape info
-    print_info(green, 'Shape', 'analyzed', args.shape)
-    if 'Flex' in args.shape or 'flex' in args.shape:
-        print_info(green, 'OCPUs', 'amount', f'{args.ocpu} cores')
-        print_info(green, 'Memory', 'amount', f'{args.memory} GB')
+    for shape in args.shape:
+        print_info(green, 'Shape', 'analyzed', shape)
+    if args.probe:
+        # Probing searches the -ocpus/-memory values instead of scanning every combination
+        queries = build_queries(args.shape, args.ocpu[:1], args.memory[:1])
+        print_info(green, 'OCPUs', 'searched', f"{format_number(args.ocpu[0])} to {format_number(args.ocpu[-1])} cores")
+        print_info(green, 'Memory', 'searched', f"{format_number(args.memory[0])} to {format_number(args.memory[-1])} GB")
+    else:
+        queries = build_queries(args.shape, args.ocpu, args.memory)
+        if any(is_flex_shape(shape) for shape in args.shape):
+            print_info(green, 'OCPUs', 'amount', f"{', '.join(map(format_number, args.ocpu))} cores")
+            print_info(green, 'Memory', 'amount', f"{', '.join(map(format_number, args.memory))} GB")
+
+    # Rows of the -since file that settle a location are reused instead of asked again
+    if args.previous is not None:
+        from modules.incremental import plan_rescan
+        several = len(sessions) > 1 or args.several_tenancies
+        sessions = [session._replace(plan=plan_rescan(
+            args.previous, session.regions, queries, args.stale_after * 60,
+            tenancy=session.scanner.name if several else None
+        )) for session in sessions]
+        plans = [session.plan for session in sessions]
+        print_info(green, 'Since', 'carried', f"{sum(len(plan.carried) for plan in plans)} rows from {args.since}")
+        print_info(green, 'Since', 're-checked', f"{sum(len(plan.requery) for plan in plans)} locations")
+        print_info(green, 'Since', 'scanned', f"{sum(len(plan.missing) for plan in plans)} regions not covered by the file")
 
     print(green(f"{'*'*94}\n"))
 
-    # Create results table
-    table = Table(
-        title=f"Shape: {args.shape} | OCPU: {args.ocpu} | Memory: {args.memory} GB",
-        box=box.MARKDOWN
-    )
-    table.add_column("REGION", justify="left")
-    table.add_column("AVAILABILITY DOMAIN", justify="left")
-    table.add_column("FAULT DOMAIN", justify="left")
-    table.add_column("SHAPE", justify="left")
-    table.add_column("STATUS", justify="left")
+    return sessions, queries
 
-    is_flex = 'Flex' in args.shape or 'flex' in args.shape
 
-    # Query each region/AD/FD combination
-    for region in regions:
-        config['region'] = region.region_name
-        identity_client = oci.identity.IdentityClient(config=config, signer=signer)
-        core_client = oci.core.ComputeClient(config=config, signer=signer)
+def login_units(args, sessions):
+    """
+    Hand the -units of this shard to the session of their profile; units
+    of profiles that failed to log in are left out.
+
+    Returns: (list of Session, queries)
+    """
+    from modules.scanner import ShapeQuery
 
-        ads = get_availability_domains(identity_client, tenancy_id)
+    sessions = [session._replace(units=[(position, unit) for position, unit in args.units
+                                        if unit.profile == session.profile])
+                for session in sessions]
+    index, count = args.shard.split('/')
+    regions = {unit.region for _, unit in args.units}
+    print_info(green, 'Shard', 'plan', args.units_file)
+    print_info(green, 'Shard', f'{index} of {count}', f'{len(args.units)} work units in {len(regions)} regions')
+    print(green(f"{'*'*94}\n"))
+    queries = list(dict.fromkeys(ShapeQuery(unit.shape, unit.ocpus, unit.memory) for _, unit in args.units))
+    return sessions, queries
 
-        for ad in ads:
-            fds = get_fault_domains(identity_client, tenancy_id, ad)
 
-            for fd in fds:
-                try:
-                    status = create_capacity_report(
-                        core_client, tenancy_id, ad, fd,
-                        args.shape, is_flex, args.ocpu, args.memory
-                    )
+def scan_session(args, session, queries, deadline=None, on_error=None):
+    """
+    Start the scan of one tenancy; failed calls go to `on_error` and give ERROR rows.
+
+    Returns: iterator of (order, CapacityResult)
+    """
+    if session.units is not None:
+        return session.scanner.iter_units(session.units, deadline, on_error)
+    if args.probe:
+        return session.scanner.iter_probe(args.shape, args.ocpu, args.memory, session.regions, session.catalogs,
+                                          deadline, on_error)
+    return session.scanner.iter_scan(queries, session.regions, session.catalogs, session.plan, deadline, on_error)
+
+
+def watch(args, console, writer, clients, tenancy_id, results, limiter):
+    """Re-poll the scanned locations until interrupted, printing only status changes."""
+    from modules.watch import watch_capacity
+
+    console.print(f"Watching {len(results)} locations every {args.watch:g}s, press Ctrl+C to stop", style='bold')
+
+    def report_error(e):
+        console.print(f"[red]Poll failed:[/red] {getattr(e, 'message', e)}")
+
+    try:
+        for order, result, previous in watch_capacity(
+            clients, tenancy_id, results, args.watch, max_backoff=args.watch_max_backoff,
+            workers=args.workers, region_workers=args.region_workers, limiter=limiter,
+            on_error=report_error
+        ):
+            writer.write_transition(order, result, previous)
+    except KeyboardInterrupt:
+        pass
+
+
+def history_availability(args, days=30):
+    """
+    Share of the recorded checks of the -shape values that were AVAILABLE,
+    per region, over the last `days`.
+
+    Returns: {region_name: 0..1}, empty without history
+    """
+    path = args.history_file or history_path()
+    if not os.path.exists(path):
+        return {}
+    checks, available = Counter(), Counter()
+    try:
+        with contextlib.closing(connect(path)) as connection:
+            for shape in args.shape:
+                for row in query_history(connection, shape, since=time.time() - days * 86400):
+                    checks[row['region']] += row['checks']
+                    available[row['region']] += row['available']
+    except sqlite3.Error:
+        return {}
+    return {region: available[region] / count for region, count in checks.items()}
+
+
+def dry_run(args, console, metrics, sessions, queries):
+    """
+    Print the API calls and run time of the scan and of its alternatives,
+    without sending any capacity report.
+
+    The topology comes from the cache or is listed and cached now, so the
+    estimates are those of a run within the topology TTL. Latencies are the
+    ones recorded by earlier runs.
+    """
+    from rich import box
+    from rich.table import Table
+    from modules.estimate import (
+        CAPACITY_REPORT,
+        DEFAULT_LATENCY,
+        LIST_AVAILABILITY_DOMAINS,
+        LIST_FAULT_DOMAINS,
+        combine,
+        estimate_scan,
+        yield_order
+    )
+    from modules.metrics import read_latencies
+    from modules.shard import list_locations
+
+    latencies = read_latencies()
+    availability = history_availability(args)
+    shapes = set(args.shape)
 
-                    style = 'green' if status == 'AVAILABLE' else 'red'
-                    table.add_row(region.region_name, ad, fd, args.shape, status, style=style)
+    def estimate(session):
+        scanner = session.scanner
+        catalogs = session.catalogs
+        # As in a scan, regions whose catalog lacks the shapes are not listed
+        listed = [region for region in session.regions
+                  if catalogs is None or catalogs.get(region.region_name) is None
+                  or shapes & catalogs[region.region_name]]
+        locations = list_locations(scanner.clients, scanner.tenancy_id, listed, scanner.workers,
+                                   scanner.region_workers, scanner.topology, scanner.limiter)
+        scanner.save()
+        if catalogs is None and scanner.topology is not None:
+            catalogs = {region.region_name: scanner.topology.shapes(region.region_name)
+                        for region in session.regions}
+            catalogs = {name: set(names) for name, names in catalogs.items() if names is not None}
+        estimates = estimate_scan(
+            session.regions, queries, locations, latencies, catalogs, args.catalog, args.first, availability,
+            list_topology=scanner.topology is None or args.refresh_topology,
+            workers=args.workers, region_workers=args.region_workers, rate=args.rate
+        )
+        return locations, estimates
+
+    with metrics.stage('topology'):
+        results = for_each_session(estimate, sessions)
+    estimates = combine([estimates for _, estimates in results])
+    locations = [ads for region_locations, _ in results for ads in region_locations.values()]
+    regions = {region.region_name for session in sessions for region in session.regions}
 
-                except oci.exceptions.ServiceError as e:
-                    console.print(f"[red]Error:[/red] {args.shape} - {e.message}")
-                    console.print("Check shape names: https://docs.oracle.com/en-us/iaas/Content/Compute/References/computeshapes.htm")
-                    raise SystemExit(1)
+    if args.output_format == 'jsonl':
+        for e in estimates:
+            print(json.dumps({'strategy': e.strategy, 'calls': dict(e.calls), 'total_calls': sum(e.calls.values()),
+                              'seconds': round(e.seconds, 2), 'note': e.note}), flush=True)
+        return
 
+    table = Table(title=f"Dry run: {len(regions)} regions, {sum(len(ads) for ads in locations)} ADs, "
+                        f"{sum(len(fds) for ads in locations for _, fds in ads)} FDs, {len(queries)} shape configs",
+                  box=box.MARKDOWN)
+    table.add_column('STRATEGY', justify='left', no_wrap=True)
+    for column in ('LISTING', 'REPORTS', 'CALLS', 'TIME (s)'):
+        table.add_column(column, justify='right')
+    table.add_column('NOTE', justify='left')
+    for e in estimates:
+        total = sum(e.calls.values())
+        table.add_row(e.strategy, str(total - e.calls[CAPACITY_REPORT]), str(e.calls[CAPACITY_REPORT]), str(total),
+                      f'{e.seconds:.1f}', e.note)
     console.print(table)
 
+    listing = sum(len(values) for (_, operation), values in metrics.latencies.items()
+                  if operation in (LIST_AVAILABILITY_DOMAINS, LIST_FAULT_DOMAINS))
+    console.print(f"Topology: {listing} listing calls made now" + (', cached for the next run' if listing else ''))
+    recorded = len({region for region, operation in latencies if region in regions and operation == CAPACITY_REPORT})
+    console.print(f"Latency: recorded for {recorded} of {len(regions)} regions, "
+                  f"{DEFAULT_LATENCY * 1000:.0f} ms assumed for the others")
+    # With -first, only the -first strategies answer the same question
+    cheapest = min([e for e in estimates if e.strategy.startswith('-first')] or estimates,
+                   key=lambda e: (sum(e.calls.values()), e.seconds))
+    console.print(f"Cheapest: {cheapest.strategy}, {sum(cheapest.calls.values())} calls in about "
+                  f"{cheapest.seconds:.1f}s")
+    if availability:
+        order = [name for name in yield_order([region for session in sessions for region in session.regions],
+                                              availability) if name in availability]
+        console.print(f"High-yield order: -priority {' '.join(list(dict.fromkeys(order))[:5])}")
+
+
+def report_metrics(args, console, metrics, limiters):
+    """Print the -timings breakdown, write the -metrics file and record the latencies for -dry-run."""
+    from modules.metrics import create_timings_tables, record_latencies
+
+    for limiter in limiters:
+        metrics.retries.update(limiter.retries)
+    record_latencies(metrics)
+    if args.timings:
+        console.print()
+        for table in create_timings_tables(metrics):
+            console.print(table)
+    if args.metrics_file:
+        try:
+            metrics.write(args.metrics_file, args.metrics_format)
+        except OSError as e:
+            console.print(f"[red]Cannot write metrics:[/red] {e}")
+
+
+def main():
+    """Main entry point."""
+    if sys.argv[1:2] == ['query']:
+        return query_command(sys.argv[2:])
+    if sys.argv[1:2] == ['serve']:
+        return serve_command(sys.argv[2:])
+    if sys.argv[1:2] == ['plan']:
+        return plan_command(sys.argv[2:])
+    if sys.argv[1:2] == ['merge']:
+        return merge_command(sys.argv[2:])
+    args = parse_arguments()
+    # The -deadline counts from here, so login time is part of the budget
+    deadline = time.monotonic() + args.deadline if args.deadline else None
+
+    import oci
+    from rich.console import Console
+    from modules.metrics import Metrics
+    from modules.output import create_writer
+    from modules.scanner import ERROR, TIMEOUT, UNANSWERED, UNLISTED, merge_scans, take_available
+
+    # Machine-readable formats keep stdout for the rows only
+    streaming = args.output_format != 'table'
+    console = Console(stderr=streaming)
+    if not streaming:
+        clear()
+
+    # Stage times and every API call are recorded; reported with -timings/-metrics
+    metrics = Metrics()
+    with contextlib.redirect_stdout(sys.stderr) if streaming else contextlib.nullcontext():
+        sessions, queries = login(args, metrics, deadline)
+    # Shards of a plan spanning several tenancies tag their rows even when they log in to one
+    several = len(sessions) > 1 or args.several_tenancies
+    if args.dry_run:
+        try:
+            dry_run(args, console, metrics, sessions, queries)
+        except oci.exceptions.ServiceError as e:
+            console.print(f"[red]Error:[/red] {e.message}")
+            raise SystemExit(1)
+        finally:
+            report_metrics(args, console, metrics, [session.scanner.limiter for session in sessions])
+        return
+
+    # Rows are written as soon as each capacity report answers
+    writer = create_writer(args.output_format, console, sys.stdout, queries,
+                           watch=bool(args.watch), probe=args.probe, tenancies=several,
+                           ages=args.previous is not None)
+    limiters = [session.scanner.limiter for session in sessions]
+    hedger = sessions[0].scanner.hedger
+    # A failed call costs its own locations (ERROR rows), never the rows already collected
+    errors = []
+    scans = [scan_session(args, session, queries, deadline, errors.append) for session in sessions]
+    if several:
+        # Tenancies are scanned side by side; rows are tagged and sorted by tenancy first
+        results = (((index,) + order, result._replace(tenancy=sessions[index].scanner.name))
+                   for index, order, result in merge_scans(scans))
+    else:
+        results = scans[0]
+    if args.first:
+        results = take_available(results, args.first)
+    # Rows are kept in memory and appended to the history in one transaction per tenancy at the end
+    histories = [] if args.no_history else [HistoryRecorder(args.history_file or history_path(), session.scanner.tenancy_id)
+                                            for session in sessions]
+
+    scanned = []
+    error = None
+    try:
+        try:
+            with metrics.stage('scan'):
+                for order, result in results:
+                    writer.write(order, result)
+                    # Carried and unanswered rows were not checked by this run
+                    if histories and result.checked_at is None and result.status not in UNANSWERED:
+                        histories[order[0] if several else 0].add(result)
+                    # Regions without the shape have no location to poll
+                    if args.watch and result.fault_domain != UNLISTED:
+                        scanned.append((order, result))
+        except oci.exceptions.ServiceError as e:
+            error = e
+        finally:
+            for session in sessions:
+                session.scanner.save()
+            writer.close()
+            for history in histories:
+                try:
+                    history.flush()
+                except (OSError, sqlite3.Error) as e:
+                    console.print(f"[red]Cannot record history:[/red] {e}")
+            for session, limiter in zip(sessions, limiters):
+                if limiter.summary():
+                    prefix = f'{session.scanner.name}: ' if several else ''
+                    console.print(prefix + limiter.summary(), style='yellow')
+            if hedger is not None and hedger.summary():
+                console.print(hedger.summary())
+
+        if error:
+            errors.append(error)
+        for message, count in Counter(getattr(e, 'message', None) or str(e) for e in errors).most_common(3):
+            console.print(f"[red]Error:[/red] {count} failed call{'s' if count > 1 else ''} - {message}")
+        if any(getattr(e, 'code', None) == 'InvalidParameter' for e in errors):
+            console.print("Check shape names: https://docs.oracle.com/en-us/iaas/Content/Compute/References/computeshapes.htm")
+        if writer.counts[TIMEOUT]:
+            console.print(f"[yellow]Deadline:[/yellow] {writer.counts[TIMEOUT]} locations unanswered "
+                          f"after {args.deadline:g}s")
+        # Partial results are still a failure for scripts
+        if error or writer.counts[TIMEOUT] or writer.counts[ERROR]:
+            raise SystemExit(1)
+
+        # Clients and topology stay alive; only the capacity reports are polled again
+        if args.watch:
+            with metrics.stage('watch'):
+                scanner = sessions[0].scanner
+                watch(args, console, writer, scanner.clients, scanner.tenancy_id, scanned, scanner.limiter)
+    finally:
+        report_metrics(args, console, metrics, limiters)
+
 
 if __name__ == '__main__':
     main()
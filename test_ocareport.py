@@ -1,11 +1,29 @@
 """Tests for ocareport.py CLI tool."""
+import base64
+import datetime
+import io
+import json
+import os
+import subprocess
 import sys
+import threading
+import time
+import urllib.error
+import urllib.request
 from unittest import mock
 
+import oci
 import pytest
 
 import ocareport
-from modules import identity
+from modules import (api, cache, catalog, clients, estimate, hedge, history, identity, incremental, metrics, output,
+                     probe, ratelimit, scanner, service, shard, tokens, watch)
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path, monkeypatch):
+    """Keep every test's on-disk caches in a temporary directory."""
+    monkeypatch.setenv('OCAREPORT_CACHE_DIR', str(tmp_path / 'cache'))
 
 
 class TestParseArguments:
@@ -21,7 +39,7 @@ class TestParseArguments:
         """Test shape argument is parsed correctly."""
         with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'VM.Standard.E5.Flex']):
             args = ocareport.parse_arguments()
-            assert args.shape == 'VM.Standard.E5.Flex'
+            assert args.shape == ['VM.Standard.E5.Flex']
 
     def test_default_values(self):
         """Test default argument values."""
@@ -31,8 +49,18 @@ class TestParseArguments:
             assert args.config_file_path == '~/.oci/config'
             assert args.config_profile == 'DEFAULT'
             assert args.region == ''
-            assert args.ocpu == 1
-            assert args.memory == 1
+            assert args.ocpu == [1.0]
+            assert args.memory == [1.0]
+
+    def test_metrics_arguments(self):
+        """Test -timings, -metrics and -metrics-format flags."""
+        argv = ['ocareport.py', '-shape', 'TestShape', '-timings', '-metrics', 'run.prom',
+                '-metrics-format', 'prometheus']
+        with mock.patch.object(sys, 'argv', argv):
+            args = ocareport.parse_arguments()
+            assert args.timings is True
+            assert args.metrics_file == 'run.prom'
+            assert args.metrics_format == 'prometheus'
 
     def test_auth_method_config_file(self):
         """Test -auth cf flag."""
@@ -80,8 +108,8 @@ class TestParseArguments:
         """Test -ocpus and -memory set OCPU and memory for flex shapes."""
         with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'VM.Standard.E5.Flex', '-ocpus', '24', '-memory', '512']):
             args = ocareport.parse_arguments()
-            assert args.ocpu == 24.0
-            assert args.memory == 512.0
+            assert args.ocpu == [24.0]
+            assert args.memory == [512.0]
 
     def test_all_options_combined(self):
         """Test all options can be used together."""
@@ -95,9 +123,37 @@ class TestParseArguments:
             assert args.config_file_path == '/custom/config'
             assert args.config_profile == 'PROD'
             assert args.region == 'us-ashburn-1'
-            assert args.shape == 'VM.Standard.E5.Flex'
-            assert args.ocpu == 8.0
-            assert args.memory == 128.0
+            assert args.shape == ['VM.Standard.E5.Flex']
+            assert args.ocpu == [8.0]
+            assert args.memory == [128.0]
+
+    def test_multiple_shapes(self):
+        """Test -shape accepts space and comma separated lists."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'BM.GPU.H100.8,VM.GPU.A10.1', 'VM.GPU3.1']):
+            args = ocareport.parse_arguments()
+            assert args.shape == ['BM.GPU.H100.8', 'VM.GPU.A10.1', 'VM.GPU3.1']
+
+    def test_shape_file(self, tmp_path):
+        """Test -shape @file reads one shape per line."""
+        shape_file = tmp_path / 'shapes.txt'
+        shape_file.write_text('# GPUs\nBM.GPU.H100.8\n\nVM.GPU.A10.1  # inference\n')
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', f'@{shape_file}']):
+            args = ocareport.parse_arguments()
+            assert args.shape == ['BM.GPU.H100.8', 'VM.GPU.A10.1']
+
+    def test_ocpu_and_memory_ranges(self):
+        """Test -ocpus/-memory accept lists and inclusive ranges."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'VM.Standard.E5.Flex',
+                                             '-ocpus', '1,2', '8:16:4', '-memory', '16', '32']):
+            args = ocareport.parse_arguments()
+            assert args.ocpu == [1.0, 2.0, 8.0, 12.0, 16.0]
+            assert args.memory == [16.0, 32.0]
+
+    def test_invalid_range(self):
+        """Test malformed ranges are rejected."""
+        with pytest.raises(SystemExit):
+            with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-ocpus', '16:8']):
+                ocareport.parse_arguments()
 
 
 class TestGetAvailabilityDomains:
@@ -111,9 +167,8 @@ class TestGetAvailabilityDomains:
         mock_ad2 = mock.MagicMock()
         mock_ad2.name = 'AD-2'
 
-        with mock.patch('oci.pagination.list_call_get_all_results') as mock_paginate:
-            mock_paginate.return_value.data = [mock_ad1, mock_ad2]
-            result = identity.get_availability_domains(mock_client, 'test-compartment')
+        mock_client.list_availability_domains.return_value = mock.MagicMock(data=[mock_ad1, mock_ad2], next_page=None)
+        result = identity.get_availability_domains(mock_client, 'test-compartment')
 
         assert result == ['AD-1', 'AD-2']
 
@@ -129,9 +184,8 @@ class TestGetFaultDomains:
         mock_fd2 = mock.MagicMock()
         mock_fd2.name = 'FD-2'
 
-        with mock.patch('oci.pagination.list_call_get_all_results') as mock_paginate:
-            mock_paginate.return_value.data = [mock_fd1, mock_fd2]
-            result = identity.get_fault_domains(mock_client, 'test-compartment', 'AD-1')
+        mock_client.list_fault_domains.return_value = mock.MagicMock(data=[mock_fd1, mock_fd2], next_page=None)
+        result = identity.get_fault_domains(mock_client, 'test-compartment', 'AD-1')
 
         assert result == ['FD-1', 'FD-2']
 
@@ -189,14 +243,24 @@ class TestGetRegionSubscriptionList:
         assert len(result) == 1
         assert result[0].region_name == 'eu-frankfurt-1'
 
+    def test_select_regions_rejects_unsubscribed(self):
+        """Test an existing but unsubscribed region raises instead of ending the run."""
+        mock_client = mock.MagicMock()
+        mock_region = mock.MagicMock()
+        mock_region.name = 'eu-frankfurt-1'
+        mock_client.list_regions.return_value.data = [mock_region]
+
+        with pytest.raises(ValueError, match='not subscribed'):
+            identity.select_regions(mock_client, [make_region('us-ashburn-1', True)], 'eu-frankfurt-1')
+
 
 class TestAuthentication:
     """Tests for authentication functions."""
 
-    @mock.patch('modules.identity.oci.identity.IdentityClient')
-    @mock.patch('modules.identity.oci.signer.Signer')
-    @mock.patch('modules.identity.oci.config.validate_config')
-    @mock.patch('modules.identity.oci.config.from_file')
+    @mock.patch('oci.identity.IdentityClient')
+    @mock.patch('oci.signer.Signer')
+    @mock.patch('oci.config.validate_config')
+    @mock.patch('oci.config.from_file')
     def test_config_file_auth(self, mock_from_file, mock_validate, mock_signer, mock_identity):
         """Test config file authentication path."""
         mock_from_file.return_value = {
@@ -218,8 +282,8 @@ class TestAuthentication:
         assert auth_name == 'config_file'
         assert tenancy_id == 'test-tenancy-id'
 
-    @mock.patch('modules.identity.oci.identity.IdentityClient')
-    @mock.patch('modules.identity.oci.auth.signers.InstancePrincipalsSecurityTokenSigner')
+    @mock.patch('oci.identity.IdentityClient')
+    @mock.patch('oci.auth.signers.InstancePrincipalsSecurityTokenSigner')
     def test_instance_principals_auth(self, mock_ip_signer, mock_identity):
         """Test instance principals authentication path."""
         mock_ip_signer.return_value.region = 'us-ashburn-1'
@@ -236,6 +300,249 @@ class TestAuthentication:
         assert tenancy_id == 'test-tenancy-id'
 
 
+class TestAuthenticationFastPath:
+    """Tests for cached authentication method selection."""
+
+    @staticmethod
+    def _success(method):
+        tenancy = oci.identity.models.Tenancy(id='tenancy-id', name='tenancy', home_region_key='IAD')
+        return ({'tenancy': 'tenancy-id'}, mock.MagicMock(), tenancy, method, 'details', 'tenancy-id')
+
+    @staticmethod
+    def _failure(auth_errors, *args, **kwargs):
+        return None, None, None, None, None, None
+
+    def test_last_successful_method_tried_first(self):
+        """Test the cached method is attempted before the default order."""
+        cache.write_auth_hint('~/.oci/config', 'DEFAULT', 'ip', self._success('ip')[2])
+        calls = []
+
+        def record(name, result):
+            def auth(auth_errors, *args, **kwargs):
+                calls.append(name)
+                return result
+            return auth
+
+        with mock.patch('modules.identity.authenticate_cloud_shell', record('cs', self._failure(None))), \
+                mock.patch('modules.identity.authenticate_config_file', record('cf', self._failure(None))), \
+                mock.patch('modules.identity.authenticate_instance_principals', record('ip', self._success('ip'))):
+            result = identity.init_authentication('', '~/.oci/config', 'DEFAULT')
+
+        assert calls == ['ip']
+        assert result[3] == 'ip'
+
+    def test_success_is_remembered(self):
+        """Test the working method and tenancy are cached per config file/profile."""
+        with mock.patch('modules.identity.authenticate_cloud_shell', side_effect=self._failure), \
+                mock.patch('modules.identity.authenticate_config_file', return_value=self._success('config_file')):
+            identity.init_authentication('', '~/.oci/config', 'PROD')
+
+        hint = cache.read_auth_hint('~/.oci/config', 'PROD')
+        assert hint['method'] == 'cf'
+        assert hint['tenancy_name'] == 'tenancy'
+        assert cache.read_auth_hint('~/.oci/config', 'DEFAULT') is None
+
+    def test_quiet_failure_raises(self, capsys):
+        """Test quiet authentication raises with every method's error instead of printing and prompting."""
+        def failure(name):
+            def auth(auth_errors, *args, **kwargs):
+                auth_errors[name] = 'no credentials'
+                return self._failure(auth_errors)
+            return auth
+
+        with mock.patch('modules.identity.authenticate_cloud_shell', failure('CloudShell')), \
+                mock.patch('modules.identity.authenticate_config_file', failure('Config_File')), \
+                mock.patch('modules.identity.authenticate_instance_principals', failure('Instance_Principals')), \
+                mock.patch('builtins.input') as prompt:
+            with pytest.raises(identity.AuthenticationError) as raised:
+                identity.init_authentication('', '~/.oci/config', 'DEFAULT', quiet=True)
+
+        assert set(raised.value.errors) == {'CloudShell', 'Config_File', 'Instance_Principals'}
+        prompt.assert_not_called()
+        assert capsys.readouterr().out == ''
+
+    def test_parallel_probes_keep_preference_order(self):
+        """Test parallel probing still returns the first working method in order."""
+        with mock.patch('modules.identity.authenticate_cloud_shell', side_effect=self._failure), \
+                mock.patch('modules.identity.authenticate_config_file', return_value=self._success('config_file')), \
+                mock.patch('modules.identity.authenticate_instance_principals',
+                           return_value=self._success('instance_principals')):
+            result = identity.init_authentication('', '~/.oci/config', 'DEFAULT', parallel=True)
+
+        assert result[3] == 'config_file'
+
+    def test_parallel_losing_probe_does_not_hold_exit(self):
+        """Test a probe still running when another method wins is on a daemon thread, so exit does not wait."""
+        release = threading.Event()
+        probes = []
+
+        def slow(auth_errors, *args, **kwargs):
+            probes.append(threading.current_thread())
+            release.wait(5)
+            return self._failure(auth_errors)
+
+        with mock.patch('modules.identity.authenticate_cloud_shell', side_effect=self._failure), \
+                mock.patch('modules.identity.authenticate_config_file', return_value=self._success('config_file')), \
+                mock.patch('modules.identity.authenticate_instance_principals', slow):
+            start = time.monotonic()
+            result = identity.init_authentication('', '~/.oci/config', 'DEFAULT', parallel=True)
+            elapsed = time.monotonic() - start
+        release.set()
+
+        assert result[3] == 'config_file'
+        assert elapsed < 2
+        assert probes and probes[0].daemon
+
+    @mock.patch('oci.identity.IdentityClient')
+    @mock.patch('oci.signer.Signer')
+    @mock.patch('oci.config.validate_config')
+    @mock.patch('oci.config.from_file')
+    def test_trust_skips_get_tenancy(self, mock_from_file, mock_validate, mock_signer, mock_identity):
+        """Test trusted authentication makes no tenancy call and uses cached details."""
+        mock_from_file.return_value = {
+            'tenancy': 'tenancy-id', 'user': 'user', 'fingerprint': 'aa:bb', 'key_file': '/path/to/key'
+        }
+        cache.write_auth_hint('~/.oci/config', 'DEFAULT', 'cf', self._success('cf')[2])
+
+        result = identity.init_authentication('cf', '~/.oci/config', 'DEFAULT', trust=True)
+
+        mock_identity.return_value.get_tenancy.assert_not_called()
+        assert result[2].name == 'tenancy'
+        assert result[2].home_region_key == 'IAD'
+
+    def test_auth_arguments(self):
+        """Test -trust-auth and -parallel-auth are parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-trust-auth', '-parallel-auth']):
+            args = ocareport.parse_arguments()
+            assert args.trust_auth is True
+            assert args.parallel_auth is True
+
+
+class TestSignerCache:
+    """Tests for the on-disk instance principal / delegation token signer cache."""
+
+    KEY = None
+
+    @classmethod
+    def _key(cls):
+        if cls.KEY is None:
+            from cryptography.hazmat.primitives.asymmetric import rsa
+            cls.KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        return cls.KEY
+
+    @staticmethod
+    def _token(issued, lifetime=1200, subject='instance'):
+        def part(data):
+            return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+        return '.'.join([part({'alg': 'RS256'}), part({'sub': subject, 'iat': issued, 'exp': issued + lifetime}),
+                         'signature'])
+
+    def _live(self, token):
+        live = mock.MagicMock(tenancy_id='tenancy-id', region='us-ashburn-1')
+        live.federation_client.get_security_token.return_value = token
+        live.federation_client.session_key_supplier.get_key_pair.return_value = {'private': self._key()}
+        return live
+
+    @staticmethod
+    def _sign(signer):
+        from oci._vendor import requests
+        request = requests.Request('GET', 'https://identity.us-ashburn-1.oci.oraclecloud.com/20160918/tenancies/x')
+        return signer(request.prepare())
+
+    def test_state_round_trip(self):
+        """Test saved state is read back only while valid, private and for the same delegation token."""
+        path = tokens.signer_path('cs')
+        token = self._token(int(time.time()))
+        tokens.write_signer_state(path, token, self._key(), 'tenancy-id', 'us-ashburn-1', 'delegation')
+
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        state = tokens.read_signer_state(path, 'delegation')
+        assert state['token'] == token
+        assert state['region'] == 'us-ashburn-1'
+        assert state['private_key'].private_numbers() == self._key().private_numbers()
+        assert tokens.read_signer_state(path, 'another delegation') is None
+        assert tokens.read_signer_state(path, 'delegation', now=time.time() + 1200 - tokens.REFRESH_MARGIN) is None
+
+        os.chmod(path, 0o644)
+        assert tokens.read_signer_state(path, 'delegation') is None
+
+    def test_load_reuses_cached_token(self):
+        """Test the signer is built once, then later logins sign with the saved token."""
+        token = self._token(int(time.time()))
+        build = mock.Mock(return_value=self._live(token))
+
+        first = tokens.CachedTokenSigner.load('ip', build)
+        second = tokens.CachedTokenSigner.load('ip', build)
+
+        assert build.call_count == 1
+        assert (second.tenancy_id, second.region) == ('tenancy-id', 'us-ashburn-1')
+        assert f'keyId="ST${token}"' in self._sign(second).headers['authorization']
+        assert first.expires == second.expires
+
+    def test_delegation_token_header(self):
+        """Test CloudShell requests carry and sign the delegation token."""
+        build = mock.Mock(return_value=self._live(self._token(int(time.time()))))
+
+        signed = self._sign(tokens.CachedTokenSigner.load('cs', build, 'delegation'))
+
+        assert signed.headers['opc-obo-token'] == 'delegation'
+        assert 'opc-obo-token' in signed.headers['authorization']
+
+    def test_refresh_in_background(self):
+        """Test a token past half its life is replaced on a thread while requests go on, and saved."""
+        now = int(time.time())
+        old, new = self._token(now - 800), self._token(now, subject='refreshed')
+        tokens.write_signer_state(tokens.signer_path('ip'), old, self._key(), 'tenancy-id', 'us-ashburn-1')
+        release = threading.Event()
+
+        def build():
+            release.wait(5)
+            return self._live(new)
+
+        signer = tokens.CachedTokenSigner.load('ip', build)
+        assert f'keyId="ST${old}"' in self._sign(signer).headers['authorization']
+        release.set()
+        for _ in range(100):
+            if signer.expires == now + 1200:
+                break
+            time.sleep(0.01)
+
+        assert f'keyId="ST${new}"' in self._sign(signer).headers['authorization']
+        assert tokens.read_signer_state(tokens.signer_path('ip'))['token'] == new
+
+    def test_refresh_inline_near_expiry(self):
+        """Test a token about to expire is replaced before the request is signed."""
+        now = int(time.time())
+        old, new = self._token(now - 1200 + tokens.REFRESH_MARGIN + 60), self._token(now, subject='refreshed')
+        build = mock.Mock(return_value=self._live(new))
+        signer = tokens.CachedTokenSigner(old, self._key(), 'tenancy-id', 'us-ashburn-1', build,
+                                          tokens.signer_path('ip'))
+        signer.expires = now + 60
+
+        assert f'keyId="ST${new}"' in self._sign(signer).headers['authorization']
+        build.assert_called_once_with()
+
+    @mock.patch('oci.auth.signers.InstancePrincipalsSecurityTokenSigner')
+    def test_instance_principals_cache_signer(self, mock_ip_signer):
+        """Test a second instance principals login with cache_signer makes no metadata or token call."""
+        live = self._live(self._token(int(time.time())))
+        mock_ip_signer.return_value = live
+
+        results = [identity.authenticate_instance_principals({}, validate=False, cache_signer=True)
+                   for _ in range(2)]
+
+        assert mock_ip_signer.call_count == 1
+        assert results[1][0] == {'region': 'us-ashburn-1', 'tenancy': 'tenancy-id'}
+        assert isinstance(results[1][1], tokens.CachedTokenSigner)
+
+    def test_cache_auth_argument(self):
+        """Test -cache-auth is parsed and off by default."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape']):
+            assert ocareport.parse_arguments().cache_auth is False
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-cache-auth']):
+            assert ocareport.parse_arguments().cache_auth is True
+
+
 class TestCreateCapacityReport:
     """Tests for create_capacity_report function."""
 
@@ -285,6 +592,1508 @@ class TestCreateCapacityReport:
         assert shape_config.memory_in_gbs == 512.0
 
 
+def make_region(name, is_home=False):
+    """Build a region subscription stand-in."""
+    region = mock.MagicMock()
+    region.region_name = name
+    region.is_home_region = is_home
+    return region
+
+
+class TestScanCapacity:
+    """Tests for the concurrent scan engine."""
+
+    def _scan(self, report_delay=None, **kwargs):
+        regions = [make_region('us-ashburn-1', True), make_region('eu-frankfurt-1')]
+
+        def fake_reports(core_client, compartment_id, ad, entries):
+            if report_delay:
+                time.sleep(report_delay(ad))
+            return ['AVAILABLE' if fd == 'FD-1' else 'OUT_OF_HOST_CAPACITY' for fd, _ in entries]
+
+        with mock.patch('modules.scanner.get_availability_domains', return_value=['AD-1', 'AD-2']), \
+                mock.patch('modules.scanner.get_fault_domains', return_value=['FD-1', 'FD-2', 'FD-3']), \
+                mock.patch('modules.scanner.create_capacity_reports', side_effect=fake_reports) as reports:
+            results = scanner.scan_capacity(mock.MagicMock(), 'tenancy', regions,
+                                            [scanner.ShapeQuery('TestShape', 1, 1)], **kwargs)
+            self.report_calls = reports.call_count
+            return results
+
+    def test_covers_every_fault_domain(self):
+        """Test one row per region/AD/FD combination."""
+        results = self._scan()
+
+        assert len(results) == 2 * 2 * 3
+        assert results[0] == scanner.CapacityResult('us-ashburn-1', 'AD-1', 'FD-1', 'TestShape',
+                                                    None, None, 'AVAILABLE')
+
+    def test_deterministic_order(self):
+        """Test rows come back in region/AD/FD order regardless of completion order."""
+        results = self._scan(report_delay=lambda ad: 0.01 if ad == 'AD-1' else 0,
+                             workers=8, region_workers=4)
+
+        keys = [(r.region, r.availability_domain, r.fault_domain) for r in results]
+        expected = [(region, ad, fd)
+                    for region in ('us-ashburn-1', 'eu-frankfurt-1')
+                    for ad in ('AD-1', 'AD-2')
+                    for fd in ('FD-1', 'FD-2', 'FD-3')]
+        assert keys == expected
+
+    def test_service_error_propagates(self):
+        """Test a service error aborts the scan."""
+        error = oci.exceptions.ServiceError(400, 'InvalidParameter', {}, 'bad shape')
+        with mock.patch('modules.scanner.get_availability_domains', return_value=['AD-1']), \
+                mock.patch('modules.scanner.get_fault_domains', return_value=['FD-1']), \
+                mock.patch('modules.scanner.create_capacity_reports', side_effect=error):
+            with pytest.raises(oci.exceptions.ServiceError):
+                scanner.scan_capacity(mock.MagicMock(), 'tenancy', [make_region('us-ashburn-1')],
+                                      [scanner.ShapeQuery('BadShape', 1, 1)])
+
+    def test_failed_calls_become_error_rows(self):
+        """Test with on_error, failed listings and reports cost only their own locations."""
+        error = oci.exceptions.ServiceError(500, 'InternalServerError', {}, 'boom')
+        errors = []
+
+        def fault_domains(identity_client, tenancy_id, ad):
+            if ad == 'AD-2':
+                raise error
+            return ['FD-1', 'FD-2']
+
+        def reports(core_client, compartment_id, ad, entries):
+            if core_client == 'eu-frankfurt-1':
+                raise error
+            return ['AVAILABLE'] * len(entries)
+
+        pool = mock.MagicMock()
+        pool.compute.side_effect = lambda region: region
+        with mock.patch('modules.scanner.get_availability_domains', return_value=['AD-1', 'AD-2']), \
+                mock.patch('modules.scanner.get_fault_domains', side_effect=fault_domains), \
+                mock.patch('modules.scanner.create_capacity_reports', side_effect=reports):
+            results = scanner.scan_capacity(pool, 'tenancy', [make_region('us-ashburn-1'), make_region('eu-frankfurt-1')],
+                                            [scanner.ShapeQuery('TestShape', 1, 1)], on_error=errors.append)
+
+        assert [(r.region, r.availability_domain, r.fault_domain, r.status) for r in results] == [
+            ('us-ashburn-1', 'AD-1', 'FD-1', 'AVAILABLE'),
+            ('us-ashburn-1', 'AD-1', 'FD-2', 'AVAILABLE'),
+            ('us-ashburn-1', 'AD-2', scanner.UNLISTED, 'ERROR'),
+            ('eu-frankfurt-1', 'AD-1', 'FD-1', 'ERROR'),
+            ('eu-frankfurt-1', 'AD-1', 'FD-2', 'ERROR'),
+            ('eu-frankfurt-1', 'AD-2', scanner.UNLISTED, 'ERROR'),
+        ]
+        assert errors == [error] * 3
+
+    def test_deadline_reports_timeouts(self):
+        """Test the scan stops at the deadline with TIMEOUT rows for unanswered locations."""
+        start = time.monotonic()
+        results = self._scan(report_delay=lambda ad: 2 if ad == 'AD-2' else 0, deadline=start + 0.3)
+
+        assert time.monotonic() - start < 1.5
+        assert len(results) == 2 * 2 * 3
+        assert {r.status for r in results if r.availability_domain == 'AD-2'} == {'TIMEOUT'}
+        assert 'TIMEOUT' not in {r.status for r in results if r.availability_domain == 'AD-1'}
+
+    def test_one_report_call_per_ad(self):
+        """Test all fault domains of an AD share one capacity report call."""
+        self._scan()
+        assert self.report_calls == 2 * 2
+
+    def test_batches_split_by_size(self):
+        """Test large AD batches are split into chunks."""
+        self._scan(batch_size=2)
+        assert self.report_calls == 2 * 2 * 2
+
+    def test_workers_arguments(self):
+        """Test -workers and -region-workers are parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape',
+                                             '-workers', '32', '-region-workers', '2']):
+            args = ocareport.parse_arguments()
+            assert args.workers == 32
+            assert args.region_workers == 2
+
+    def test_workers_below_one_rejected(self, capsys):
+        """Test -workers 0 and -region-workers 0 are argument errors, not failures after login."""
+        for option in ('-workers', '-region-workers'):
+            with pytest.raises(SystemExit):
+                with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', option, '0']):
+                    ocareport.parse_arguments()
+            assert 'must be at least 1' in capsys.readouterr().err
+        with pytest.raises(ValueError):
+            api.CapacityScanner(mock.MagicMock(), 'tenancy', region_workers=0)
+
+
+class TestFirstAvailable:
+    """Tests for early exit and region priority."""
+
+    def test_stops_after_count_and_cancels_scan(self):
+        """Test the scan is closed once enough AVAILABLE rows were seen."""
+        rows = [((i,), scanner.CapacityResult('r', 'AD', f'FD-{i}', 'S', None, None, status))
+                for i, status in enumerate(['OUT_OF_HOST_CAPACITY', 'AVAILABLE', 'AVAILABLE', 'AVAILABLE'])]
+        closed = []
+
+        def scan():
+            try:
+                yield from rows
+            finally:
+                closed.append(True)
+
+        taken = list(scanner.take_available(scan(), 2))
+
+        assert [result.fault_domain for _, result in taken] == ['FD-0', 'FD-1', 'FD-2']
+        assert closed == [True]
+
+    def test_queued_calls_cancelled(self):
+        """Test regions still queued are never queried after the early exit."""
+        regions = [make_region(f'region-{i}') for i in range(6)]
+        with mock.patch('modules.scanner.get_availability_domains', return_value=['AD-1']), \
+                mock.patch('modules.scanner.get_fault_domains', return_value=['FD-1']), \
+                mock.patch('modules.scanner.create_capacity_reports',
+                           side_effect=lambda c, t, ad, entries: ['AVAILABLE'] * len(entries)) as reports:
+            results = scanner.iter_capacity(mock.MagicMock(), 'tenancy', regions,
+                                            [scanner.ShapeQuery('TestShape', 1, 1)], workers=1)
+            taken = list(scanner.take_available(results, 1))
+
+        assert len(taken) == 1
+        assert reports.call_count < len(regions)
+
+    def test_priority_regions_first(self):
+        """Test prioritized regions move to the front, others keep their order."""
+        regions = [make_region(name) for name in ('us-ashburn-1', 'eu-frankfurt-1', 'ap-tokyo-1', 'uk-london-1')]
+
+        ordered = scanner.prioritize_regions(regions, ['ap-tokyo-1', 'eu-frankfurt-1'])
+
+        assert [r.region_name for r in ordered] == ['ap-tokyo-1', 'eu-frankfurt-1', 'us-ashburn-1', 'uk-london-1']
+
+    def test_first_and_priority_arguments(self):
+        """Test -first and -priority are parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-first', '1',
+                                             '-priority', 'eu-frankfurt-1,us-ashburn-1', 'ap-tokyo-1']):
+            args = ocareport.parse_arguments()
+            assert args.first == 1
+            assert args.priority == ['eu-frankfurt-1', 'us-ashburn-1', 'ap-tokyo-1']
+
+
+class TestProbe:
+    """Tests for flex shape max-config probing."""
+
+    @pytest.mark.parametrize('limit', [0, 1, 5, 31, 63])
+    def test_bound_search_finds_last_available(self, limit):
+        """Test the search finds the largest available value under a monotonic oracle."""
+        values = list(range(1, 65))
+        searches = {'fd': probe.BoundSearch(values, low=0)}
+
+        rounds = probe.probe_rounds(searches, lambda asked: [value <= values[limit] for _, value in asked],
+                                    batch_size=6)
+
+        assert searches['fd'].best == values[limit]
+        assert rounds <= 3
+
+    def test_gallop_without_upper_bound(self):
+        """Test the first round gallops up from the lower bound and includes the top value."""
+        search = probe.BoundSearch(list(range(64)), low=0)
+        assert search.candidates(6) == [1, 2, 4, 8, 16, 63]
+
+    def test_split_with_upper_bound(self):
+        """Test rounds with both bounds split the interval evenly."""
+        search = probe.BoundSearch(list(range(64)), low=16, high=32)
+        assert search.candidates(3) == [20, 24, 28]
+
+    def test_rounds_share_requests(self):
+        """Test every open search gets a share of the batch and each round is one request."""
+        values = list(range(1, 33))
+        searches = {fd: probe.BoundSearch(values, low=0) for fd in ('FD-1', 'FD-2', 'FD-3')}
+        limits = {'FD-1': 3, 'FD-2': 17, 'FD-3': 32}
+        requests = []
+
+        def ask(asked):
+            requests.append(len(asked))
+            return [value <= limits[fd] for fd, value in asked]
+
+        probe.probe_rounds(searches, ask, batch_size=12)
+
+        assert {fd: search.best for fd, search in searches.items()} == limits
+        assert max(requests) <= 12
+        assert len(requests) <= 3
+
+    @mock.patch('modules.probe.create_capacity_reports')
+    @mock.patch('modules.probe.iter_capacity')
+    def test_probe_capacity(self, mock_iter, mock_reports):
+        """Test unavailable FDs keep their base answer and available ones get their largest config."""
+        base = [
+            ((0, 0, 0, 0), scanner.CapacityResult('r1', 'AD-1', 'FD-1', 'VM.Flex', 1.0, 16.0, 'AVAILABLE')),
+            ((0, 0, 1, 0), scanner.CapacityResult('r1', 'AD-1', 'FD-2', 'VM.Flex', 1.0, 16.0, 'OUT_OF_HOST_CAPACITY')),
+        ]
+        mock_iter.return_value = iter(base)
+
+        def reports(compute, tenancy_id, ad, entries):
+            return ['AVAILABLE' if q.ocpus <= 8 and q.memory <= 256 else 'OUT_OF_HOST_CAPACITY'
+                    for fd, q in entries]
+        mock_reports.side_effect = reports
+
+        results = dict(probe.probe_capacity(
+            mock.MagicMock(), 'tenancy', [make_region('r1')], ['VM.Flex'],
+            [float(n) for n in range(1, 17)], [float(n) for n in range(16, 513, 16)]
+        ))
+
+        assert (results[(0, 0, 0, 0)].ocpus, results[(0, 0, 0, 0)].memory) == (8.0, 256.0)
+        assert results[(0, 0, 1, 0)] == base[1][1]
+        assert mock_iter.call_args[0][3] == [scanner.ShapeQuery('VM.Flex', 1.0, 16.0)]
+
+    def test_probe_requires_flex_shapes(self):
+        """Test -probe rejects fixed shapes and -first."""
+        for argv in (['-shape', 'BM.GPU.H100.8', '-probe'], ['-shape', 'VM.Standard.E4.Flex', '-probe', '-first', '1']):
+            with mock.patch.object(sys, 'argv', ['ocareport.py'] + argv):
+                with pytest.raises(SystemExit):
+                    ocareport.parse_arguments()
+
+
+class TestWatch:
+    """Tests for watch mode."""
+
+    def test_unchanged_locations_back_off(self):
+        """Test stable locations double their interval and changes reset it."""
+        schedule = watch.PollSchedule(10, max_backoff=4)
+        schedule.add('loc', 'OUT_OF_HOST_CAPACITY', now=0)
+        assert schedule.due(9) == []
+        assert schedule.due(10) == ['loc']
+
+        assert schedule.update('loc', 'OUT_OF_HOST_CAPACITY', now=10) is None
+        assert schedule.next_due() == 30
+        schedule.due(30)
+        schedule.update('loc', 'OUT_OF_HOST_CAPACITY', now=30)
+        assert schedule.next_due() == 70
+        schedule.due(70)
+        schedule.update('loc', 'OUT_OF_HOST_CAPACITY', now=70)
+        assert schedule.next_due() == 110
+
+        schedule.due(110)
+        assert schedule.update('loc', 'AVAILABLE', now=110) == 'OUT_OF_HOST_CAPACITY'
+        assert schedule.next_due() == 120
+
+    def test_yields_only_transitions(self):
+        """Test watch polls capacity only and reports status changes."""
+        initial = [((0, 0, i, 0), scanner.CapacityResult('us-ashburn-1', 'AD-1', f'FD-{i}', 'TestShape',
+                                                         None, None, 'OUT_OF_HOST_CAPACITY'))
+                   for i in range(3)]
+        answers = iter([['OUT_OF_HOST_CAPACITY', 'AVAILABLE', 'OUT_OF_HOST_CAPACITY']])
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        with mock.patch('modules.scanner.create_capacity_reports',
+                        side_effect=lambda c, t, ad, entries: next(answers)) as reports, \
+                mock.patch('modules.scanner.get_availability_domains') as list_ads:
+            changes = list(watch.watch_capacity(mock.MagicMock(), 'tenancy', initial, 5, rounds=1,
+                                                clock=lambda: now[0], sleep=sleep))
+
+        assert [(r.fault_domain, previous, r.status) for _, r, previous in changes] == \
+            [('FD-1', 'OUT_OF_HOST_CAPACITY', 'AVAILABLE')]
+        assert reports.call_count == 1
+        assert now[0] == 5
+        list_ads.assert_not_called()
+
+    def test_failed_round_is_retried(self):
+        """Test a failed poll is reported and does not stop watching."""
+        initial = [((0,), scanner.CapacityResult('r', 'AD-1', 'FD-1', 'S', None, None, 'AVAILABLE'))]
+        error = oci.exceptions.ServiceError(404, 'NotAuthorizedOrNotFound', {}, 'gone')
+        errors = []
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        with mock.patch('modules.scanner.create_capacity_reports', side_effect=error) as reports:
+            list(watch.watch_capacity(mock.MagicMock(), 'tenancy', initial, 1, rounds=2,
+                                      on_error=errors.append, clock=lambda: now[0], sleep=sleep))
+
+        assert reports.call_count == 2
+        assert errors == [error, error]
+
+    def test_watch_arguments(self):
+        """Test -watch is parsed and rejected together with -first."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-watch', '30']):
+            assert ocareport.parse_arguments().watch == 30.0
+        with pytest.raises(SystemExit):
+            with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-watch', '30', '-first', '1']):
+                ocareport.parse_arguments()
+
+
+class TestRateLimiter:
+    """Tests for per-region rate limiting and throttling backoff."""
+
+    @staticmethod
+    def _limiter(**kwargs):
+        sleeps = []
+        limiter = ratelimit.RateLimiter(sleep=sleeps.append, **kwargs)
+        return limiter, sleeps
+
+    def test_retries_throttled_calls(self):
+        """Test 429 responses are retried and counted."""
+        limiter, sleeps = self._limiter(rate=1000)
+        throttle = oci.exceptions.ServiceError(429, 'TooManyRequests', {}, 'slow down')
+        func = mock.MagicMock(side_effect=[throttle, throttle, 'ok'])
+
+        assert limiter.call('us-ashburn-1', func) == 'ok'
+        assert func.call_count == 3
+        assert limiter.throttled['us-ashburn-1'] == 2
+        assert limiter.retries['us-ashburn-1'] == 2
+        assert len(sleeps) == 2 and sleeps[1] > 0
+        assert 'us-ashburn-1: 2x429' in limiter.summary()
+
+    def test_gives_up_after_max_retries(self):
+        """Test the error is raised once retries are exhausted."""
+        limiter, _ = self._limiter(rate=1000, max_retries=1)
+        error = oci.exceptions.ServiceError(503, 'ServiceUnavailable', {}, 'down')
+
+        with pytest.raises(oci.exceptions.ServiceError):
+            limiter.call('us-ashburn-1', mock.MagicMock(side_effect=error))
+        assert limiter.server_errors['us-ashburn-1'] == 2
+
+    def test_no_retry_past_deadline(self):
+        """Test a retry that would end after the deadline is not attempted."""
+        limiter, sleeps = self._limiter(rate=1000, deadline=0, clock=lambda: 1.0)
+        func = mock.MagicMock(side_effect=oci.exceptions.ServiceError(503, 'ServiceUnavailable', {}, 'down'))
+
+        with pytest.raises(oci.exceptions.ServiceError):
+            limiter.call('us-ashburn-1', func)
+        assert func.call_count == 1
+        assert sleeps == []
+
+    def test_identity_calls_reach_the_limiter(self):
+        """Test throttled AD listings and region subscriptions are retried and counted by the limiter, not the SDK."""
+        limiter, _ = self._limiter(rate=1000)
+        throttle = oci.exceptions.ServiceError(429, 'TooManyRequests', {}, 'slow down')
+        ad = mock.MagicMock()
+        ad.name = 'AD-1'
+        identity_client = mock.MagicMock()
+        identity_client.list_availability_domains.side_effect = [throttle, mock.MagicMock(data=[ad], next_page=None)]
+        identity_client.list_region_subscriptions.side_effect = [throttle, mock.MagicMock(data=['subscription'])]
+
+        assert limiter.call('us-ashburn-1', identity.get_availability_domains, identity_client, 'tenancy') == ['AD-1']
+        assert identity.list_region_subscriptions(identity_client, 'tenancy', quiet=True, limiter=limiter,
+                                                  region_name='us-ashburn-1') == ['subscription']
+        assert identity_client.list_availability_domains.call_count == 2
+        assert limiter.throttled['us-ashburn-1'] == 2
+
+    def test_client_errors_not_retried(self):
+        """Test 4xx errors other than 429 fail immediately."""
+        limiter, _ = self._limiter()
+        func = mock.MagicMock(side_effect=oci.exceptions.ServiceError(400, 'InvalidParameter', {}, 'bad'))
+
+        with pytest.raises(oci.exceptions.ServiceError):
+            limiter.call('us-ashburn-1', func)
+        assert func.call_count == 1
+        assert limiter.summary() is None
+
+    def test_concurrency_halves_on_throttle_and_grows_back(self):
+        """Test the AIMD concurrency limit of a region."""
+        limiter, _ = self._limiter(rate=1000, max_concurrency=8)
+        throttle = oci.exceptions.ServiceError(429, 'TooManyRequests', {}, 'slow down')
+        limiter.call('eu-frankfurt-1', mock.MagicMock(side_effect=[throttle, throttle, 'ok']))
+
+        region = limiter.region('eu-frankfurt-1')
+        assert region.limit == pytest.approx(2.5)
+        for _ in range(50):
+            limiter.call('eu-frankfurt-1', lambda: None)
+        assert region.limit > 4
+        assert limiter.region('us-ashburn-1').limit == 8
+
+    def test_token_bucket_paces_calls(self):
+        """Test calls beyond the burst wait for tokens."""
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        limiter = ratelimit.RateLimiter(rate=2, burst=2, clock=lambda: now[0], sleep=sleep)
+        for _ in range(6):
+            limiter.call('us-ashburn-1', lambda: None)
+
+        assert now[0] == pytest.approx(2.0)
+
+    def test_deadline_arguments(self):
+        """Test -deadline/-call-timeout set client timeouts and -deadline is rejected with -watch."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-deadline', '30']):
+            args = ocareport.parse_arguments()
+            assert ocareport.client_timeout(args) == {'timeout': (10.0, 30.0)}
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-call-timeout', '5']):
+            assert ocareport.client_timeout(ocareport.parse_arguments()) == {'timeout': (5.0, 5.0)}
+        for extra in (['-deadline', '30', '-watch', '60'], ['-call-timeout', '-1']):
+            with pytest.raises(SystemExit):
+                with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape'] + extra):
+                    ocareport.parse_arguments()
+
+    def test_rate_arguments(self):
+        """Test -rate and -max-retries are parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-rate', '5', '-max-retries', '2']):
+            args = ocareport.parse_arguments()
+            assert args.rate == 5.0
+            assert args.max_retries == 2
+
+
+class TestHedger:
+    """Tests for hedged capacity report calls."""
+
+    RECORDED = {('r', estimate.CAPACITY_REPORT): {'p50': 0.01, 'p95': 0.05, 'calls': 100}}
+
+    def test_late_call_is_outrun_by_its_hedge(self):
+        """Test a call past the region's p95 gets a duplicate whose earlier answer is returned."""
+        attempts = []
+
+        def report():
+            attempts.append(None)
+            if len(attempts) == 1:
+                time.sleep(0.5)
+                return 'late'
+            return 'hedged'
+
+        hedger = hedge.Hedger(0.1, self.RECORDED)
+        assert hedger.call(ratelimit.RateLimiter(), 'r', report) == 'hedged'
+        assert (hedger.calls, hedger.hedged, hedger.won) == (1, 1, 1)
+        assert 'Hedging: 1 of 1 capacity report calls hedged' in hedger.summary()
+
+    def test_budget_caps_hedges(self):
+        """Test hedges stay within the budget share of the calls and fast or unknown regions are not hedged."""
+        def report():
+            time.sleep(0.06)
+            return 'ok'
+
+        hedger = hedge.Hedger(0.5, self.RECORDED)
+        limiter = ratelimit.RateLimiter(rate=1000)
+        results = [hedger.call(limiter, 'r', report) for _ in range(4)]
+        assert results == ['ok'] * 4
+        assert hedger.hedged == 2
+
+        hedger = hedge.Hedger(1.0, self.RECORDED)
+        hedger.call(limiter, 'r', lambda: 'fast')
+        hedger.call(limiter, 'elsewhere', report)
+        assert hedger.hedged == 0 and hedger.summary() is None
+
+    def test_run_p95_replaces_recorded_one(self):
+        """Test the region's own p95 is used once it has enough answered calls."""
+        hedger = hedge.Hedger(0.1, self.RECORDED)
+        assert hedger.threshold('r') == 0.05
+        hedger.samples['r'] = [1.0] * hedge.MIN_SAMPLES
+        assert hedger.threshold('r') == 1.0
+        assert hedger.threshold('elsewhere') is None
+
+    def test_failed_call_answered_by_its_hedge(self):
+        """Test a hedged call that fails still returns the duplicate's answer, and both failing raises."""
+        attempts = []
+
+        def report():
+            attempts.append(None)
+            if len(attempts) == 1:
+                time.sleep(0.1)
+                raise ValueError('first')
+            time.sleep(0.2)
+            return 'hedged'
+
+        hedger = hedge.Hedger(1.0, self.RECORDED)
+        assert hedger.call(ratelimit.RateLimiter(), 'r', report) == 'hedged'
+
+        def failing():
+            time.sleep(0.1)
+            raise ValueError('failed')
+        with pytest.raises(ValueError):
+            hedger.call(ratelimit.RateLimiter(), 'r', failing)
+
+    def test_hedge_arguments(self):
+        """Test -hedge is a percentage."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-hedge', '5']):
+            assert ocareport.parse_arguments().hedge == 5
+        for value in ('-1', '101'):
+            with pytest.raises(SystemExit):
+                with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-hedge', value]):
+                    ocareport.parse_arguments()
+
+
+class TestBuildQueries:
+    """Tests for shape/config expansion."""
+
+    def test_flex_shapes_get_every_config(self):
+        """Test flex shapes expand to the OCPU x memory grid and fixed shapes to one query."""
+        queries = scanner.build_queries(['VM.Standard.E5.Flex', 'BM.GPU.H100.8'], [1, 2], [16])
+
+        assert queries == [
+            scanner.ShapeQuery('VM.Standard.E5.Flex', 1.0, 16.0),
+            scanner.ShapeQuery('VM.Standard.E5.Flex', 2.0, 16.0),
+            scanner.ShapeQuery('BM.GPU.H100.8', None, None),
+        ]
+
+    def test_shapes_share_one_batch_per_ad(self):
+        """Test every shape/config of an AD is packed into the same request."""
+        queries = scanner.build_queries(['A.Flex', 'B'], [1, 2], [8])
+        with mock.patch('modules.scanner.get_availability_domains', return_value=['AD-1']), \
+                mock.patch('modules.scanner.get_fault_domains', return_value=['FD-1', 'FD-2']), \
+                mock.patch('modules.scanner.create_capacity_reports',
+                           side_effect=lambda c, t, ad, entries: ['AVAILABLE'] * len(entries)) as reports:
+            results = scanner.scan_capacity(mock.MagicMock(), 'tenancy', [make_region('us-ashburn-1')], queries)
+
+        assert reports.call_count == 1
+        assert len(results) == 2 * 3
+
+
+class TestCreateCapacityReports:
+    """Tests for batched capacity report calls."""
+
+    @staticmethod
+    def _availability(fd, shape, status, ocpus=None, memory=None):
+        entry = oci.core.models.CapacityReportShapeAvailability(
+            fault_domain=fd, instance_shape=shape, availability_status=status
+        )
+        if ocpus is not None:
+            entry.instance_shape_config = oci.core.models.CapacityReportInstanceShapeConfig(
+                ocpus=ocpus, memory_in_gbs=memory
+            )
+        return entry
+
+    def test_single_request_for_all_entries(self):
+        """Test every entry is packed into one request."""
+        mock_client = mock.MagicMock()
+        mock_client.create_compute_capacity_report.return_value.data.shape_availabilities = [
+            self._availability('FD-1', 'TestShape', 'AVAILABLE'),
+            self._availability('FD-2', 'TestShape', 'AVAILABLE'),
+        ]
+        entries = [('FD-1', scanner.ShapeQuery('TestShape', None, None)),
+                   ('FD-2', scanner.ShapeQuery('TestShape', None, None))]
+
+        scanner.create_capacity_reports(mock_client, 'compartment-id', 'AD-1', entries)
+
+        report_details = mock_client.create_compute_capacity_report.call_args[1]['create_compute_capacity_report_details']
+        assert mock_client.create_compute_capacity_report.call_count == 1
+        assert [d.fault_domain for d in report_details.shape_availabilities] == ['FD-1', 'FD-2']
+
+    def test_maps_answers_by_key(self):
+        """Test answers returned out of order are mapped back to their entries."""
+        mock_client = mock.MagicMock()
+        mock_client.create_compute_capacity_report.return_value.data.shape_availabilities = [
+            self._availability('FD-2', 'Shape.Flex', 'OUT_OF_HOST_CAPACITY', 2.0, 16.0),
+            self._availability('FD-1', 'Shape.Flex', 'AVAILABLE', 4.0, 32.0),
+            self._availability('FD-1', 'Shape.Flex', 'HARDWARE_NOT_SUPPORTED', 2.0, 16.0),
+        ]
+        entries = [('FD-1', scanner.ShapeQuery('Shape.Flex', 2.0, 16.0)),
+                   ('FD-1', scanner.ShapeQuery('Shape.Flex', 4.0, 32.0)),
+                   ('FD-2', scanner.ShapeQuery('Shape.Flex', 2.0, 16.0))]
+
+        statuses = scanner.create_capacity_reports(mock_client, 'compartment-id', 'AD-1', entries)
+
+        assert statuses == ['HARDWARE_NOT_SUPPORTED', 'AVAILABLE', 'OUT_OF_HOST_CAPACITY']
+
+
+class TestClientPool:
+    """Tests for the per-region client pool."""
+
+    @mock.patch('modules.clients.oci.core.ComputeClient')
+    @mock.patch('modules.clients.oci.identity.IdentityClient')
+    def test_clients_built_once_per_region(self, mock_identity, mock_compute):
+        """Test each client is built once per region and reused."""
+        pool = clients.ClientPool({'region': 'us-ashburn-1', 'tenancy': 't'}, 'signer')
+
+        assert pool.compute('eu-frankfurt-1') is pool.compute('eu-frankfurt-1')
+        pool.compute('us-ashburn-1')
+        pool.identity()
+
+        assert mock_compute.call_count == 2
+        assert mock_identity.call_args[1]['config']['region'] == 'us-ashburn-1'
+        assert mock_compute.call_args_list[0][1]['config']['region'] == 'eu-frankfurt-1'
+
+    def test_region_configs_are_isolated(self):
+        """Test per-region configs are read-only and leave the base config untouched."""
+        base = {'region': 'us-ashburn-1', 'tenancy': 't'}
+        pool = clients.ClientPool(base, 'signer')
+
+        region_config = pool.config('eu-frankfurt-1')
+        with pytest.raises(TypeError):
+            region_config['region'] = 'ap-tokyo-1'
+        assert base['region'] == 'us-ashburn-1'
+        assert region_config['region'] == 'eu-frankfurt-1'
+
+    @mock.patch('modules.clients.oci.core.ComputeClient')
+    def test_endpoint_template(self, mock_compute, monkeypatch):
+        """Test $OCAREPORT_ENDPOINT_TEMPLATE points each region's clients at its own endpoint."""
+        monkeypatch.setenv('OCAREPORT_ENDPOINT_TEMPLATE', 'http://127.0.0.1:8080/{region}')
+        pool = clients.ClientPool({'region': 'us-ashburn-1', 'tenancy': 't'}, 'signer')
+
+        pool.compute('eu-frankfurt-1')
+
+        assert mock_compute.call_args[1]['service_endpoint'] == 'http://127.0.0.1:8080/eu-frankfurt-1'
+        monkeypatch.delenv('OCAREPORT_ENDPOINT_TEMPLATE')
+        assert clients.endpoint_kwargs('eu-frankfurt-1') == {}
+
+    def test_list_all_pages(self):
+        """Test every page is fetched once, with no retry strategy added, and a failure is raised at once."""
+        list_func = mock.MagicMock(side_effect=[mock.MagicMock(data=[1, 2], next_page='p2'),
+                                                mock.MagicMock(data=[3], next_page=None)])
+        assert clients.list_all_pages(list_func, 'tenancy') == [1, 2, 3]
+        assert list_func.call_args_list == [mock.call('tenancy'), mock.call('tenancy', page='p2')]
+
+        throttled = oci.exceptions.ServiceError(429, 'TooManyRequests', {}, 'slow down')
+        list_func = mock.MagicMock(side_effect=throttled)
+        with pytest.raises(oci.exceptions.ServiceError):
+            clients.list_all_pages(list_func, 'tenancy')
+        assert list_func.call_count == 1
+
+    def test_daemon_thread_pool(self):
+        """Test the scan pool runs calls on at most max_workers daemon threads and cancels queued ones."""
+        pool = scanner.DaemonThreadPool(2)
+        release = threading.Event()
+        threads = set()
+
+        def call(value):
+            threads.add(threading.current_thread())
+            release.wait(5)
+            return value
+
+        futures = [pool.submit(call, value) for value in range(4)]
+        time.sleep(0.05)
+        assert futures[3].cancel()
+        release.set()
+        assert [future.result(5) for future in futures[:3]] == [0, 1, 2]
+        assert len(threads) == 2 and all(thread.daemon for thread in threads)
+        pool.shutdown()
+        with pytest.raises(RuntimeError):
+            pool.submit(call, 5)
+
+
+class TestMetrics:
+    """Tests for API call instrumentation."""
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        values = [float(n) for n in range(1, 101)]
+        assert metrics.percentile(values, 0.5) == 50.0
+        assert metrics.percentile(values, 0.95) == 95.0
+        assert metrics.percentile([3.0], 0.95) == 3.0
+        assert metrics.percentile([], 0.5) == 0.0
+
+    def test_operation_name(self):
+        """Test operations are named by method and path, without endpoint or OCIDs."""
+        assert metrics.operation_name(
+            'GET', 'https://identity.eu-frankfurt-1.oci.oraclecloud.com/20160918/faultDomains?compartmentId=x'
+        ) == 'GET faultDomains'
+        assert metrics.operation_name(
+            'GET', 'http://127.0.0.1:8080/us-ashburn-1/20160918/tenancies/ocid1.tenancy.oc1..aaa/regionSubscriptions'
+        ) == 'GET tenancies/regionSubscriptions'
+
+    def test_summaries(self):
+        """Test per-operation and per-region summaries."""
+        m = metrics.Metrics()
+        m.record('eu-frankfurt-1', 'POST computeCapacityReports', 0.1, 200, sent=100, received=300)
+        m.record('eu-frankfurt-1', 'POST computeCapacityReports', 0.3, 429)
+        m.record('ap-tokyo-1', 'GET faultDomains', 0.2, 200, received=50)
+        m.retries['eu-frankfurt-1'] += 1
+
+        reports = m.by_operation()['POST computeCapacityReports']
+        assert reports['calls'] == 2
+        assert reports['errors'] == 1
+        assert reports['max'] == 0.3
+        assert reports['bytes_sent'] == 100
+        regions = m.by_region()
+        assert regions['eu-frankfurt-1']['retries'] == 1
+        assert regions['ap-tokyo-1']['bytes_received'] == 50
+
+    def test_stage_times_add_up(self):
+        """Test repeated stages accumulate their time."""
+        clock = iter([0.0, 1.0, 5.0, 7.5])
+        m = metrics.Metrics(clock=lambda: next(clock))
+        with m.stage('scan'):
+            pass
+        with m.stage('scan'):
+            pass
+        assert m.stages == {'scan': 3.5}
+
+    def test_response_hook(self):
+        """Test the response hook records latency, status and bytes of a call."""
+        m = metrics.Metrics()
+        response = mock.MagicMock(status_code=200, headers={'Content-Length': '42'})
+        response.request.method = 'POST'
+        response.request.url = 'https://iaas.ap-tokyo-1.oraclecloud.com/20160918/computeCapacityReports'
+        response.request.body = b'{"a": 1}'
+        response.elapsed.total_seconds.return_value = 0.25
+
+        m.response_hook('ap-tokyo-1')(response)
+
+        summary = m.to_dict()['calls'][0]
+        assert summary['region'] == 'ap-tokyo-1'
+        assert summary['operation'] == 'POST computeCapacityReports'
+        assert summary['p50'] == 0.25
+        assert summary['bytes_sent'] == 8
+        assert summary['bytes_received'] == 42
+
+    def test_prometheus_format(self):
+        """Test the Prometheus text output."""
+        m = metrics.Metrics()
+        m.record('ap-tokyo-1', 'GET faultDomains', 0.2, 200)
+        m.stages['auth'] = 1.5
+
+        text = m.to_prometheus()
+
+        assert 'ocareport_stage_seconds{stage="auth"} 1.500000' in text
+        assert ('ocareport_api_calls_total{region="ap-tokyo-1",operation="GET faultDomains",status="200"} 1'
+                in text)
+        assert ('ocareport_api_latency_seconds{region="ap-tokyo-1",operation="GET faultDomains",quantile="0.95"} '
+                '0.200000' in text)
+        assert '# TYPE ocareport_api_latency_seconds summary' in text
+
+    def test_latencies_recorded_across_runs(self, tmp_path):
+        """Test each run's p50/p95 blend into the recorded latencies and a corrupt file is ignored."""
+        path = str(tmp_path / 'latency.json')
+        first = metrics.Metrics()
+        first.record('ap-tokyo-1', 'POST computeCapacityReports', 1.0, 200)
+        metrics.record_latencies(first, path)
+        second = metrics.Metrics()
+        second.record('ap-tokyo-1', 'POST computeCapacityReports', 2.0, 200)
+        metrics.record_latencies(second, path, weight=0.5)
+
+        entry = metrics.read_latencies(path)[('ap-tokyo-1', 'POST computeCapacityReports')]
+        assert entry == {'p50': 1.5, 'p95': 1.5, 'calls': 2}
+        with open(path, 'w') as f:
+            f.write('{')
+        assert metrics.read_latencies(path) == {}
+
+    @mock.patch('modules.clients.oci.core.ComputeClient')
+    def test_client_pool_attaches_hook(self, mock_compute):
+        """Test pooled clients get the metrics response hook."""
+        mock_compute.return_value.base_client.session.hooks = {'response': []}
+        pool = clients.ClientPool({'region': 'us-ashburn-1'}, 'signer', metrics=metrics.Metrics())
+
+        client = pool.compute('ap-tokyo-1')
+
+        assert len(client.base_client.session.hooks['response']) == 1
+
+
+class TestTopologyCache:
+    """Tests for the on-disk topology cache."""
+
+    @staticmethod
+    def _subscription(name, is_home=False):
+        return oci.identity.models.RegionSubscription(
+            region_key=name[:3].upper(), region_name=name, status='READY', is_home_region=is_home
+        )
+
+    def test_round_trip(self, tmp_path):
+        """Test topology written by one run is read back by the next."""
+        path = str(tmp_path / 'topology.json')
+        topology = cache.TopologyCache('tenancy', path=path)
+        topology.set_regions([self._subscription('us-ashburn-1', True)])
+        topology.set_availability_domains('us-ashburn-1', ['AD-1'])
+        topology.set_fault_domains('us-ashburn-1', 'AD-1', ['FD-1', 'FD-2'])
+        topology.save()
+
+        reloaded = cache.TopologyCache('tenancy', path=path)
+        assert reloaded.regions()[0].region_name == 'us-ashburn-1'
+        assert reloaded.regions()[0].is_home_region is True
+        assert reloaded.availability_domains('us-ashburn-1') == ['AD-1']
+        assert reloaded.fault_domains('us-ashburn-1', 'AD-1') == ['FD-1', 'FD-2']
+
+    def test_missing_and_stale_entries(self, tmp_path):
+        """Test missing, expired, refreshed and other-tenancy entries are misses."""
+        path = str(tmp_path / 'topology.json')
+        topology = cache.TopologyCache('tenancy', path=path)
+        assert topology.regions() is None
+        topology.set_availability_domains('us-ashburn-1', ['AD-1'])
+        topology.save()
+
+        assert cache.TopologyCache('tenancy', ttl=0, path=path).availability_domains('us-ashburn-1') is None
+        assert cache.TopologyCache('tenancy', refresh=True, path=path).availability_domains('us-ashburn-1') is None
+        assert cache.TopologyCache('other', path=path).availability_domains('us-ashburn-1') is None
+
+    def test_atomic_write_leaves_no_temp_files(self, tmp_path):
+        """Test the cache file is replaced without leftovers."""
+        path = tmp_path / 'topology.json'
+        cache.write_json_atomic(str(path), {'a': 1})
+        cache.write_json_atomic(str(path), {'a': 2})
+
+        assert cache.read_json(str(path)) == {'a': 2}
+        assert [p.name for p in tmp_path.iterdir()] == ['topology.json']
+
+    def test_region_list_uses_cache(self, tmp_path):
+        """Test cached subscriptions skip list_region_subscriptions."""
+        topology = cache.TopologyCache('tenancy', path=str(tmp_path / 'topology.json'))
+        topology.set_regions([self._subscription('us-ashburn-1', True)])
+        mock_client = mock.MagicMock()
+
+        result = identity.get_region_subscription_list(mock_client, 'tenancy', '', topology)
+
+        assert result[0].region_name == 'us-ashburn-1'
+        mock_client.list_region_subscriptions.assert_not_called()
+
+    def test_scan_uses_cached_ads_and_fds(self, tmp_path):
+        """Test a cached topology skips AD and FD listing."""
+        topology = cache.TopologyCache('tenancy', path=str(tmp_path / 'topology.json'))
+        topology.set_availability_domains('us-ashburn-1', ['AD-1'])
+        topology.set_fault_domains('us-ashburn-1', 'AD-1', ['FD-1', 'FD-2'])
+
+        with mock.patch('modules.scanner.get_availability_domains') as list_ads, \
+                mock.patch('modules.scanner.get_fault_domains') as list_fds, \
+                mock.patch('modules.scanner.create_capacity_reports',
+                           side_effect=lambda c, t, ad, entries: ['AVAILABLE'] * len(entries)):
+            results = scanner.scan_capacity(mock.MagicMock(), 'tenancy', [make_region('us-ashburn-1')],
+                                            [scanner.ShapeQuery('TestShape', 1, 1)], topology=topology)
+
+        assert [r.fault_domain for r in results] == ['FD-1', 'FD-2']
+        list_ads.assert_not_called()
+        list_fds.assert_not_called()
+
+    def test_refresh_topology_argument(self):
+        """Test -refresh-topology and -topology-ttl are parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape',
+                                             '-refresh-topology', '-topology-ttl', '2']):
+            args = ocareport.parse_arguments()
+            assert args.refresh_topology is True
+            assert args.topology_ttl == 2.0
+
+
+class TestCatalog:
+    """Tests for the shape catalog pre-pass."""
+
+    @staticmethod
+    def _shape(name):
+        shape = mock.MagicMock()
+        shape.shape = name
+        return shape
+
+    def test_get_shapes_deduplicates(self):
+        """Test the catalog lists each shape name once, sorted."""
+        compute = mock.MagicMock()
+        compute.list_shapes.return_value = mock.MagicMock(
+            data=[self._shape('VM.B'), self._shape('VM.A'), self._shape('VM.B')], next_page=None)
+        assert catalog.get_shapes(compute, 'tenancy') == ['VM.A', 'VM.B']
+
+    def test_load_catalogs_uses_cache(self, tmp_path):
+        """Test cached catalogs skip list_shapes and fetched ones are stored."""
+        topology = cache.TopologyCache('tenancy', path=str(tmp_path / 'topology.json'))
+        topology.set_shapes('us-ashburn-1', ['VM.A'])
+        regions = [make_region('us-ashburn-1', True), make_region('eu-frankfurt-1')]
+
+        with mock.patch('modules.catalog.get_shapes', return_value=['VM.B']) as get_shapes:
+            catalogs = catalog.load_catalogs(mock.MagicMock(), 'tenancy', regions, topology=topology)
+
+        assert catalogs == {'us-ashburn-1': {'VM.A'}, 'eu-frankfurt-1': {'VM.B'}}
+        assert get_shapes.call_count == 1
+        assert topology.shapes('eu-frankfurt-1') == ['VM.B']
+
+    def test_load_catalogs_deadline_leaves_catalog_unknown(self):
+        """Test a catalog call still running at the deadline leaves its region unknown."""
+        release = threading.Event()
+        regions = [make_region('us-ashburn-1'), make_region('eu-frankfurt-1')]
+
+        def get_shapes(client, tenancy_id):
+            if client == 'eu-frankfurt-1':
+                release.wait(5)
+            return ['VM.A']
+
+        clients = mock.MagicMock()
+        clients.compute.side_effect = lambda name: name
+        start = time.monotonic()
+        with mock.patch('modules.catalog.get_shapes', side_effect=get_shapes):
+            catalogs = catalog.load_catalogs(clients, 'tenancy', regions, deadline=time.monotonic() + 0.3)
+        release.set()
+
+        assert catalogs == {'us-ashburn-1': {'VM.A'}, 'eu-frankfurt-1': None}
+        assert time.monotonic() - start < 2
+        assert catalog.unknown_shapes(['Nothing'], catalogs) == []
+
+    def test_unknown_shapes_suggest_close_names(self):
+        """Test shapes no region offers are reported with close matches."""
+        catalogs = {'us-ashburn-1': {'VM.Standard.E4.Flex', 'BM.GPU.H100.8'}, 'eu-frankfurt-1': set()}
+
+        unknown = catalog.unknown_shapes(['VM.Standard.E4.Flex', 'vm.standard.e4.flx', 'Nothing'], catalogs)
+
+        assert unknown == [('vm.standard.e4.flx', ['VM.Standard.E4.Flex']), ('Nothing', [])]
+
+    def test_scan_skips_regions_without_shapes(self):
+        """Test regions not offering a shape get one unlisted row and no API calls for it."""
+        regions = [make_region('us-ashburn-1', True), make_region('eu-frankfurt-1')]
+        catalogs = {'us-ashburn-1': {'Shape.A', 'Shape.B'}, 'eu-frankfurt-1': {'Shape.A'}}
+        queries = [scanner.ShapeQuery('Shape.B', 1, 1)]
+
+        with mock.patch('modules.scanner.get_availability_domains', return_value=['AD-1']) as list_ads, \
+                mock.patch('modules.scanner.get_fault_domains', return_value=['FD-1']), \
+                mock.patch('modules.scanner.create_capacity_reports',
+                           side_effect=lambda c, t, ad, entries: ['AVAILABLE'] * len(entries)) as reports:
+            results = scanner.scan_capacity(mock.MagicMock(), 'tenancy', regions, queries, catalogs=catalogs)
+
+        assert results == [
+            scanner.CapacityResult('us-ashburn-1', 'AD-1', 'FD-1', 'Shape.B', None, None, 'AVAILABLE'),
+            scanner.CapacityResult('eu-frankfurt-1', scanner.UNLISTED, scanner.UNLISTED, 'Shape.B',
+                                   None, None, 'HARDWARE_NOT_SUPPORTED'),
+        ]
+        assert list_ads.call_count == 1
+        assert reports.call_count == 1
+
+    def test_catalog_argument(self):
+        """Test -catalog is parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-catalog']):
+            assert ocareport.parse_arguments().catalog is True
+
+
+class TestHistory:
+    """Tests for the SQLite result history and the query subcommand."""
+
+    @staticmethod
+    def _record(path, statuses, at):
+        """Record one scan of us-ashburn-1 FDs with the given statuses at time `at`."""
+        recorder = history.HistoryRecorder(path, 'tenancy', clock=lambda: at)
+        for i, status in enumerate(statuses, 1):
+            recorder.add(scanner.CapacityResult('us-ashburn-1', 'AD-1', f'FD-{i}', 'BM.GPU.H100.8',
+                                                None, None, status))
+        return recorder.flush()
+
+    def test_scan_written_in_one_transaction(self, tmp_path):
+        """Test rows are buffered until flush() and then written as one scan."""
+        path = str(tmp_path / 'history.sqlite')
+        recorder = history.HistoryRecorder(path, 'tenancy')
+        recorder.add(scanner.CapacityResult('us-ashburn-1', 'AD-1', 'FD-1', 'VM.Standard.E4.Flex',
+                                            1.0, 16.0, 'AVAILABLE'))
+        assert not (tmp_path / 'history.sqlite').exists()
+
+        assert recorder.flush() == 1
+        assert recorder.flush() == 0
+        with history.connect(path) as connection:
+            assert connection.execute('SELECT COUNT(*) FROM scans').fetchone() == (1,)
+            assert connection.execute('SELECT region, ocpus, memory, status FROM results').fetchall() == [
+                ('us-ashburn-1', 1.0, 16.0, 'AVAILABLE')]
+
+    def test_availability_over_time_range(self, tmp_path):
+        """Test the query counts AVAILABLE checks per group within the time range."""
+        path = str(tmp_path / 'history.sqlite')
+        day = 86400
+        self._record(path, ['AVAILABLE', 'OUT_OF_HOST_CAPACITY'], at=10 * day)
+        self._record(path, ['AVAILABLE', 'AVAILABLE'], at=20 * day)
+        self._record(path, ['OUT_OF_HOST_CAPACITY', 'OUT_OF_HOST_CAPACITY'], at=21 * day)
+
+        with history.connect(path) as connection:
+            recent = history.query_history(connection, 'BM.GPU.H100.8', region='us-ashburn-1', since=15 * day)
+            by_fd = history.query_history(connection, 'BM.GPU.H100.8', group_by='fd')
+            other = history.query_history(connection, 'VM.Standard.E4.Flex')
+
+        assert recent == [{'region': 'us-ashburn-1', 'scans': 2, 'checks': 4, 'available': 2,
+                           'availability': 0.5, 'first_available': '1970-01-21T00:00:00+00:00',
+                           'last_available': '1970-01-21T00:00:00+00:00'}]
+        assert [(row['fd'], row['available']) for row in by_fd] == [('AD-1 FD-1', 2), ('AD-1 FD-2', 1)]
+        assert other == []
+
+    def test_region_filter_ignores_case(self, tmp_path):
+        """Test a region given in another case matches its recorded checks."""
+        path = str(tmp_path / 'history.sqlite')
+        self._record(path, ['AVAILABLE', 'OUT_OF_HOST_CAPACITY'], at=86400)
+
+        with history.connect(path) as connection:
+            rows = history.query_history(connection, 'BM.GPU.H100.8', region='US-Ashburn-1')
+
+        assert [(row['region'], row['checks']) for row in rows] == [('us-ashburn-1', 2)]
+
+    def test_query_uses_index(self, tmp_path):
+        """Test shape/region/time lookups are answered from the covering index."""
+        with history.connect(str(tmp_path / 'history.sqlite')) as connection:
+            plan = connection.execute(
+                "EXPLAIN QUERY PLAN SELECT COUNT(*), SUM(status = 'AVAILABLE'), COUNT(DISTINCT scan_id) "
+                "FROM results WHERE shape = ? AND region = ? AND checked_at >= ?", ('s', 'r', 0)
+            ).fetchall()
+        assert 'COVERING INDEX results_shape_region_time' in ' '.join(str(row[-1]) for row in plan)
+
+    def test_query_subcommand(self, tmp_path, capsys):
+        """Test `ocareport.py query` prints the summary as JSON lines."""
+        path = str(tmp_path / 'history.sqlite')
+        self._record(path, ['AVAILABLE', 'OUT_OF_HOST_CAPACITY'], at=time.time())
+        argv = ['ocareport.py', 'query', '-shape', 'BM.GPU.H100.8', '-region', 'us-ashburn-1',
+                '-history', path, '-format', 'jsonl']
+
+        with mock.patch.object(sys, 'argv', argv):
+            ocareport.main()
+
+        row = json.loads(capsys.readouterr().out)
+        assert (row['region'], row['checks'], row['available']) == ('us-ashburn-1', 2, 1)
+
+    def test_query_without_history_file(self, tmp_path):
+        """Test the query subcommand stops when nothing was recorded yet."""
+        argv = ['ocareport.py', 'query', '-shape', 'X', '-history', str(tmp_path / 'missing.sqlite')]
+        with mock.patch.object(sys, 'argv', argv), pytest.raises(SystemExit):
+            ocareport.main()
+
+    def test_history_arguments(self):
+        """Test -history and -no-history are parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-history', 'h.sqlite',
+                                             '-no-history']):
+            args = ocareport.parse_arguments()
+            assert args.history_file == 'h.sqlite'
+            assert args.no_history is True
+
+
+class TestIncremental:
+    """Tests for -since incremental re-scans."""
+
+    NOW = 1_700_000_000.0
+    REGIONS = [mock.MagicMock(region_name='us-ashburn-1'), mock.MagicMock(region_name='us-phoenix-1')]
+    QUERIES = [scanner.ShapeQuery('BM.GPU.H100.8', None, None)]
+
+    @classmethod
+    def _row(cls, fd, status, age, region='us-ashburn-1', ad='AD-1'):
+        checked_at = datetime.datetime.fromtimestamp(cls.NOW - age, datetime.timezone.utc).isoformat()
+        return scanner.CapacityResult(region, ad, fd, 'BM.GPU.H100.8', None, None, status, None, checked_at)
+
+    def test_load_results(self, tmp_path):
+        """Test a jsonl run is read back, and other files are rejected with their line."""
+        path = tmp_path / 'results.jsonl'
+        record = output.result_record(self._row('FD-1', 'AVAILABLE', 0)._replace(checked_at=None))
+        path.write_text(json.dumps(record) + '\n\n')
+
+        results = incremental.load_results(str(path))
+
+        assert len(results) == 1
+        assert results[0][:7] == ('us-ashburn-1', 'AD-1', 'FD-1', 'BM.GPU.H100.8', None, None, 'AVAILABLE')
+        assert results[0].checked_at == record['checked_at']
+        path.write_text(json.dumps(record) + '\n{"region": "us-ashburn-1"}\n')
+        with pytest.raises(ValueError, match='results.jsonl:2'):
+            incremental.load_results(str(path))
+        with pytest.raises(ValueError, match='cannot read'):
+            incremental.load_results(str(tmp_path / 'missing.jsonl'))
+
+    def test_plan_carries_settled_rows(self):
+        """Test fresh AVAILABLE/HARDWARE_NOT_SUPPORTED rows are carried and the rest re-checked."""
+        previous = [
+            self._row('FD-1', 'OUT_OF_HOST_CAPACITY', 7200),
+            self._row('FD-1', 'AVAILABLE', 60),
+            self._row('FD-2', 'OUT_OF_HOST_CAPACITY', 60),
+            self._row('FD-3', 'AVAILABLE', 7200),
+            self._row('FD-1', 'HARDWARE_NOT_SUPPORTED', 60, region='us-phoenix-1'),
+            self._row('FD-1', 'AVAILABLE', 60, region='eu-frankfurt-1'),
+        ]
+
+        plan = incremental.plan_rescan(previous, self.REGIONS, self.QUERIES, 3600, now=self.NOW)
+
+        assert [(result.region, result.fault_domain) for _, result in plan.carried] == [
+            ('us-ashburn-1', 'FD-1'), ('us-phoenix-1', 'FD-1')]
+        assert [item[1:4] for item in plan.requery] == [('us-ashburn-1', 'AD-1', 'FD-2'),
+                                                        ('us-ashburn-1', 'AD-1', 'FD-3')]
+        assert plan.missing == {}
+
+    def test_plan_scans_uncovered_regions(self):
+        """Test regions/queries without rows, and stale catalog rows, are scanned in full."""
+        previous = [
+            self._row('FD-1', 'AVAILABLE', 60),
+            self._row(scanner.UNLISTED, 'HARDWARE_NOT_SUPPORTED', 7200, region='us-phoenix-1', ad=scanner.UNLISTED),
+        ]
+        queries = self.QUERIES + [scanner.ShapeQuery('VM.Standard.E4.Flex', 1.0, 16.0)]
+
+        plan = incremental.plan_rescan(previous, self.REGIONS, queries, 3600, now=self.NOW)
+
+        assert len(plan.carried) == 1
+        assert plan.missing == {'us-ashburn-1': [queries[1]], 'us-phoenix-1': queries}
+
+    def test_plan_filters_tenancy(self):
+        """Test rows of other tenancies are ignored when a tenancy is given."""
+        previous = [self._row('FD-1', 'AVAILABLE', 60)._replace(tenancy='prod')]
+
+        assert incremental.plan_rescan(previous, self.REGIONS, self.QUERIES, now=self.NOW, tenancy='dev').carried == []
+        assert len(incremental.plan_rescan(previous, self.REGIONS, self.QUERIES, now=self.NOW,
+                                           tenancy='prod').carried) == 1
+
+    def test_carried_rows_marked_with_age(self):
+        """Test carried rows keep their check time, get an age and are counted apart."""
+        carried = self._row('FD-1', 'AVAILABLE', 0)._replace(
+            checked_at=datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0).isoformat())
+        record = output.result_record(carried)
+        console = mock.MagicMock()
+        writer = output.create_writer('jsonl', console, io.StringIO(), [])
+        writer.write((0,), carried)
+        writer.write((1,), carried._replace(checked_at=None))
+
+        assert record['checked_at'] == carried.checked_at
+        assert 0 <= record['age_s'] < 5
+        assert writer.summary().startswith('1 locations checked')
+        assert ', 1 carried forward' in writer.summary()
+        assert [output.format_age(s) for s in (59, 3720, 90000)] == ['0m', '1h02m', '1d01h']
+
+    def test_since_arguments(self, tmp_path):
+        """Test -since loads its file and rejects -probe and unreadable files."""
+        path = tmp_path / 'results.jsonl'
+        path.write_text('')
+        argv = ['ocareport.py', '-shape', 'VM.Standard.E4.Flex', '-since', str(path), '-stale-after', '30']
+        with mock.patch.object(sys, 'argv', argv):
+            args = ocareport.parse_arguments()
+        assert args.previous == [] and args.stale_after == 30
+
+        for extra in (['-probe'], ['-since', str(tmp_path / 'missing.jsonl')]):
+            with mock.patch.object(sys, 'argv', argv + extra), pytest.raises(SystemExit):
+                ocareport.parse_arguments()
+
+
+class TestShard:
+    """Tests for planned, sharded scans and the merge of their outputs."""
+
+    @staticmethod
+    def _units(regions=2, ads=3, fds=3, queries=2):
+        locations = {f'region-{r}': [(f'AD-{a}', [f'FD-{f}' for f in range(fds)]) for a in range(ads)]
+                     for r in range(regions)}
+        return shard.plan_units('DEFAULT', 'tenancy', [make_region(name) for name in locations],
+                                [scanner.ShapeQuery(f'Shape{q}', None, None) for q in range(queries)], locations)
+
+    def test_parse_shard(self):
+        """Test i/N specs are parsed and out-of-range or malformed ones rejected."""
+        assert shard.parse_shard('2/4') == (2, 4)
+        for value in ('0/4', '5/4', '2', 'a/b'):
+            with pytest.raises(ValueError):
+                shard.parse_shard(value)
+
+    def test_shards_split_the_plan_by_ad(self):
+        """Test every unit lands in exactly one shard, ADs are never split and the split is balanced."""
+        units = self._units()
+        shards = [shard.shard_units(units, index, 4) for index in range(1, 5)]
+
+        positions = sorted(position for items in shards for position, _ in items)
+        assert positions == list(range(len(units)))
+        owners = {}
+        for index, items in enumerate(shards):
+            for _, unit in items:
+                assert owners.setdefault((unit.region, unit.availability_domain), index) == index
+        assert [len(items) for items in shards] == [12, 12, 6, 6]
+        assert shard.shard_units(units, 3, 4) == shards[2]
+
+    def test_catalog_units_answer_without_calls(self):
+        """Test shapes a region does not offer are planned as one region-level unit and answered locally."""
+        locations = {'region-0': [('AD-1', ['FD-1'])]}
+        units = shard.plan_units('DEFAULT', 'tenancy', [make_region('region-0')],
+                                 [scanner.ShapeQuery('GPU', None, None)], locations, catalogs={'region-0': set()})
+
+        assert [(u.availability_domain, u.fault_domain) for u in units] == [(scanner.UNLISTED, scanner.UNLISTED)]
+        with mock.patch('modules.scanner.create_capacity_reports') as reports:
+            rows = list(shard.iter_units(mock.MagicMock(), 'tenancy', list(enumerate(units))))
+        assert [result.status for _, result in rows] == ['HARDWARE_NOT_SUPPORTED']
+        reports.assert_not_called()
+
+    def test_units_roundtrip(self, tmp_path):
+        """Test a written plan reads back unchanged and a bad line is reported with its number."""
+        units = self._units(regions=1, ads=1, fds=2, queries=1)
+        path = tmp_path / 'units.jsonl'
+        with open(path, 'w') as f:
+            shard.write_units(units, f)
+        assert shard.load_units(str(path)) == units
+
+        path.write_text('{"region": "x"}\n')
+        with pytest.raises(ValueError, match=':1 '):
+            shard.load_units(str(path))
+
+    def test_merge_keeps_latest_and_reports_missing(self, tmp_path):
+        """Test a re-run shard's rows win, rows follow the plan and unanswered units are returned."""
+        units = self._units(regions=1, ads=1, fds=3, queries=1)
+
+        def write(name, statuses, checked_at):
+            path = tmp_path / name
+            path.write_text(''.join(json.dumps(dict(output.result_record(scanner.CapacityResult(
+                unit.region, unit.availability_domain, unit.fault_domain, unit.shape, None, None, status)),
+                checked_at=checked_at)) + '\n' for unit, status in statuses))
+            return str(path)
+
+        first = write('a.jsonl', [(units[1], 'TIMEOUT'), (units[0], 'AVAILABLE')], '2026-01-01T00:00:00+00:00')
+        again = write('b.jsonl', [(units[1], 'OUT_OF_HOST_CAPACITY')], '2026-01-01T01:00:00+00:00')
+        rows, missing = shard.merge_results([first, again], units)
+
+        assert [(order, result.status) for order, result in rows] == [((0,), 'AVAILABLE'),
+                                                                      ((1,), 'OUT_OF_HOST_CAPACITY')]
+        assert missing == [units[2]]
+
+    def test_units_arguments(self, tmp_path):
+        """Test -units takes the profiles and shapes from the plan and rejects scan options."""
+        path = tmp_path / 'units.jsonl'
+        with open(path, 'w') as f:
+            shard.write_units(self._units(), f)
+
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-units', str(path), '-shard', '2/3']):
+            args = ocareport.parse_arguments()
+        assert args.profiles == ['DEFAULT']
+        assert args.shape == ['Shape0', 'Shape1']
+        assert args.units == shard.shard_units(shard.load_units(str(path)), 2, 3)
+        for extra in (['-shape', 'X'], ['-shard', '2/3', '-shard', '4/3'], ['-region', 'all']):
+            with pytest.raises(SystemExit):
+                with mock.patch.object(sys, 'argv', ['ocareport.py', '-units', str(path)] + extra):
+                    ocareport.parse_arguments()
+        with pytest.raises(SystemExit):
+            with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'X', '-shard', '1/2']):
+                ocareport.parse_arguments()
+
+
+class TestEstimate:
+    """Tests for the dry-run call and run time estimates."""
+
+    LOCATIONS = {'region-a': [('AD-1', ['FD-1', 'FD-2', 'FD-3']), ('AD-2', ['FD-1', 'FD-2', 'FD-3'])],
+                 'region-b': [('AD-1', ['FD-1', 'FD-2', 'FD-3'])]}
+
+    @staticmethod
+    def _queries(count):
+        return [scanner.ShapeQuery('VM.Standard.E4.Flex', float(ocpus), 1.0) for ocpus in range(1, count + 1)]
+
+    def test_calls_follow_batching_and_catalogs(self):
+        """Test reports are counted per AD batch and unoffered shapes cost only the catalog call."""
+        queries = self._queries(4)
+        calls = estimate.region_calls(queries, self.LOCATIONS['region-a'], batch_size=10)
+        assert calls == {estimate.CAPACITY_REPORT: 4}
+
+        calls = estimate.region_calls(queries, self.LOCATIONS['region-a'], list_topology=True)
+        assert calls == {estimate.CAPACITY_REPORT: 2, estimate.LIST_AVAILABILITY_DOMAINS: 1,
+                         estimate.LIST_FAULT_DOMAINS: 2}
+        calls = estimate.region_calls(queries, self.LOCATIONS['region-a'], offered=set(), list_topology=True,
+                                      list_catalog=True)
+        assert calls == {estimate.LIST_SHAPES: 1}
+
+    def test_run_time_uses_recorded_latency(self):
+        """Test a region's reports run region_workers at a time at its recorded latency, else the default."""
+        latencies = {('region-a', estimate.CAPACITY_REPORT): {'p50': 2.0, 'p95': 3.0, 'calls': 10}}
+        assert estimate.call_latency(latencies, 'region-a', estimate.CAPACITY_REPORT) == 2.0
+        assert estimate.call_latency(latencies, 'region-b', estimate.CAPACITY_REPORT) == 2.0
+        assert estimate.call_latency({}, 'region-b', estimate.LIST_SHAPES) == estimate.DEFAULT_LATENCY
+
+        per_region = {'region-a': {estimate.CAPACITY_REPORT: 8}}
+        assert estimate.scan_seconds(per_region, latencies, region_workers=4) == 4.0
+        # The shared workers, not the region, are the bottleneck
+        assert estimate.scan_seconds(per_region, latencies, workers=2, region_workers=4) == 8.0
+        # So is the rate limit of a region
+        assert estimate.scan_seconds({'region-b': {estimate.CAPACITY_REPORT: 30}}, {}, region_workers=30,
+                                     rate=10) == 2.0
+
+    def test_strategies_and_high_yield_order(self):
+        """Test the -catalog alternative and -first in yield order are priced against the scan as given."""
+        regions = [make_region('region-a'), make_region('region-b')]
+        estimates = estimate.estimate_scan(regions, self._queries(1), self.LOCATIONS,
+                                           catalogs={'region-a': {'BM.GPU.H100.8'}}, first=2,
+                                           availability={'region-a': 0.0, 'region-b': 1.0})
+
+        by_name = {e.strategy: e for e in estimates}
+        assert list(by_name) == ['scan', '-catalog', '-first 2', '-first 2, by yield']
+        assert by_name['scan'].calls == {estimate.CAPACITY_REPORT: 3}
+        assert by_name['-catalog'].calls == {estimate.LIST_SHAPES: 1, estimate.CAPACITY_REPORT: 1}
+        assert by_name['-first 2'].calls == {estimate.CAPACITY_REPORT: 3}
+        assert by_name['-first 2, by yield'].calls == {estimate.CAPACITY_REPORT: 1}
+        assert estimate.yield_order(regions, {'region-b': 0.5}) == ['region-b', 'region-a']
+
+        both = estimate.combine([estimates, estimates])
+        assert both[0].calls == {estimate.CAPACITY_REPORT: 6}
+        assert both[0].seconds == estimates[0].seconds
+
+    def test_dry_run_arguments(self):
+        """Test -dry-run is rejected with modes it does not estimate and with -format csv."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-dry-run']):
+            assert ocareport.parse_arguments().dry_run
+        for extra in (['-probe'], ['-watch', '60'], ['-format', 'csv']):
+            with pytest.raises(SystemExit):
+                with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'VM.Standard.E4.Flex', '-dry-run']
+                                       + extra):
+                    ocareport.parse_arguments()
+
+
+class TestService:
+    """Tests for the capacity service cache and request parsing."""
+
+    def test_cache_hit_and_expiry(self):
+        """Test values are served from cache within the TTL and recomputed after it."""
+        now = [0.0]
+        cache = service.CoalescingCache(ttl=10, clock=lambda: now[0])
+        compute = mock.MagicMock(side_effect=[1, 2])
+
+        assert cache.get('key', compute) == (1, 'miss', 0.0)
+        now[0] = 4.0
+        assert cache.get('key', compute) == (1, 'hit', 4.0)
+        now[0] = 11.0
+        assert cache.get('key', compute) == (2, 'miss', 0.0)
+
+    def test_concurrent_requests_coalesce(self):
+        """Test callers arriving during a computation share its result."""
+        cache = service.CoalescingCache(ttl=10)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        answers = []
+        threads = [threading.Thread(target=lambda: answers.append(cache.get('key', compute)))]
+        threads[0].start()
+        started.wait(5)
+        threads += [threading.Thread(target=lambda: answers.append(cache.get('key', compute))) for _ in range(3)]
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert len(calls) == 1
+        assert sorted(source for _, source, _ in answers) == ['coalesced'] * 3 + ['miss']
+
+    def test_failures_not_cached(self):
+        """Test a failed computation is retried by the next caller."""
+        cache = service.CoalescingCache(ttl=10)
+        with pytest.raises(RuntimeError):
+            cache.get('key', mock.MagicMock(side_effect=RuntimeError('boom')))
+        assert cache.get('key', lambda: 'ok')[:2] == ('ok', 'miss')
+
+    def test_parse_capacity_request(self):
+        """Test shapes and configs are parsed from the query string."""
+        assert service.parse_capacity_request('shape=A,B&ocpus=2&ocpus=4&memory=32&region=all') == (
+            ['A', 'B'], [2.0, 4.0], [32.0], 'all')
+        assert service.parse_capacity_request('shape=A') == (['A'], [1.0], [1.0], '')
+        for query in ('', 'shape=A&ocpus=x', 'shape=A&memory=0'):
+            with pytest.raises(ValueError):
+                service.parse_capacity_request(query)
+
+    def test_same_request_key_for_reordered_shapes(self):
+        """Test requests listing the same shapes in another order share a cached scan."""
+        capacity = service.CapacityService(mock.MagicMock(), 'tenancy', [make_region('us-ashburn-1', True)])
+        with mock.patch('modules.service.scan_capacity', return_value=[]) as scan:
+            capacity.capacity(['B', 'A'], [1], [1])
+            second = capacity.capacity(['A', 'B'], [1], [1])
+
+        assert scan.call_count == 1
+        assert second['source'] == 'hit'
+        with pytest.raises(ValueError):
+            capacity.capacity(['A'], [1], [1], region='xx-nowhere-1')
+
+    def test_region_case_insensitive(self):
+        """Test region names are matched regardless of case, as on the command line."""
+        capacity = service.CapacityService(mock.MagicMock(), 'tenancy', [make_region('us-ashburn-1', True)])
+        assert [r.region_name for r in capacity.select_regions('US-ASHBURN-1')] == ['us-ashburn-1']
+        assert len(capacity.select_regions('ALL')) == 1
+
+    def test_transport_failure_answers_502(self):
+        """Test a connection failure during the scan is answered with a JSON 502, not a dropped connection."""
+        capacity = service.CapacityService(mock.MagicMock(), 'tenancy', [make_region('us-ashburn-1', True)])
+        server = service.CapacityServer(capacity, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://{}:{}/capacity?shape=A'.format(*server.server_address[:2])
+        failure = oci.exceptions.RequestException(ConnectionError('connection reset'))
+        try:
+            with mock.patch('modules.service.scan_capacity', side_effect=failure):
+                with pytest.raises(urllib.error.HTTPError) as raised:
+                    urllib.request.urlopen(url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert raised.value.code == 502
+        assert json.load(raised.value)['code'] == 'RequestException'
+        assert capacity.stats['errors'] == 1
+
+
+class TestTenancies:
+    """Tests for scanning several profiles/tenancies in one run."""
+
+    def test_config_profiles(self, tmp_path):
+        """Test every profile of a config file is listed, DEFAULT only if it has a tenancy."""
+        path = tmp_path / 'config'
+        path.write_text('[DEFAULT]\nregion=us-ashburn-1\n[PROD]\ntenancy=a\n[DEV]\ntenancy=b\n')
+        assert identity.config_profiles(str(path)) == ['PROD', 'DEV']
+
+        path.write_text('[DEFAULT]\ntenancy=x\n[PROD]\ntenancy=a\n')
+        assert identity.config_profiles(str(path)) == ['DEFAULT', 'PROD']
+        with pytest.raises(ValueError):
+            identity.config_profiles(str(tmp_path / 'missing'))
+
+    def test_profile_arguments(self, tmp_path):
+        """Test -profile takes lists and ALL, and keeps the first profile as config_profile."""
+        path = tmp_path / 'config'
+        path.write_text('[PROD]\ntenancy=a\n[DEV]\ntenancy=b\n[TEST]\ntenancy=c\n')
+        argv = ['ocareport.py', '-shape', 'TestShape', '-config_file', str(path), '-profile']
+
+        with mock.patch.object(sys, 'argv', argv + ['DEV,PROD', 'ALL']):
+            args = ocareport.parse_arguments()
+        assert args.profiles == ['DEV', 'PROD', 'TEST']
+        assert args.config_profile == 'DEV'
+
+        for extra in (['-auth', 'ip'], ['-watch', '60']):
+            with mock.patch.object(sys, 'argv', argv + ['DEV', 'PROD'] + extra), pytest.raises(SystemExit):
+                ocareport.parse_arguments()
+
+    def test_merge_scans(self):
+        """Test rows of several scans are all passed on, tagged with their scan index."""
+        first = iter([((0,), 'a'), ((1,), 'b')])
+        second = iter([((0,), 'c')])
+
+        rows = sorted(scanner.merge_scans([first, second]))
+
+        assert rows == [(0, (0,), 'a'), (0, (1,), 'b'), (1, (0,), 'c')]
+
+    def test_merge_scans_raises_first_error(self):
+        """Test an error of one scan stops the merge and reaches the caller."""
+        def failing():
+            yield (0,), 'a'
+            raise oci.exceptions.ServiceError(400, 'InvalidParameter', {}, 'bad shape')
+
+        with pytest.raises(oci.exceptions.ServiceError):
+            list(scanner.merge_scans([failing(), iter([])]))
+
+
+class TestOutputWriters:
+    """Tests for streaming output writers."""
+
+    RESULTS = [
+        ((0, 0, 1, 0), scanner.CapacityResult('us-ashburn-1', 'AD-1', 'FD-2', 'TestShape', None, None,
+                                              'OUT_OF_HOST_CAPACITY')),
+        ((0, 0, 0, 0), scanner.CapacityResult('us-ashburn-1', 'AD-1', 'FD-1', 'TestShape', None, None,
+                                              'AVAILABLE')),
+    ]
+
+    def test_jsonl_rows_flushed_as_they_arrive(self):
+        """Test each row is written as one JSON line before the scan ends."""
+        stream = io.StringIO()
+        writer = output.create_writer('jsonl', mock.MagicMock(), stream, [])
+
+        writer.write(*self.RESULTS[0])
+        first = json.loads(stream.getvalue())
+        writer.write(*self.RESULTS[1])
+
+        assert first['fault_domain'] == 'FD-2'
+        assert first['status'] == 'OUT_OF_HOST_CAPACITY'
+        assert 'checked_at' in first
+        assert len(stream.getvalue().splitlines()) == 2
+
+    def test_csv_header_and_rows(self):
+        """Test CSV output has a header and one line per row."""
+        stream = io.StringIO()
+        writer = output.create_writer('csv', mock.MagicMock(), stream, [])
+        for order, result in self.RESULTS:
+            writer.write(order, result)
+
+        lines = stream.getvalue().splitlines()
+        assert lines[0] == ','.join(output.RESULT_FIELDS)
+        assert lines[1].startswith('us-ashburn-1,AD-1,FD-2,TestShape')
+
+    def test_summary_counts_statuses(self):
+        """Test the summary footer counts rows per status."""
+        console = mock.MagicMock()
+        writer = output.create_writer('jsonl', console, io.StringIO(), [])
+        for order, result in self.RESULTS:
+            writer.write(order, result)
+        writer.close()
+
+        footer = console.print.call_args[0][0]
+        assert footer.startswith('2 locations checked')
+        assert 'AVAILABLE: 1' in footer
+
+    def test_table_rows_sorted_by_location(self):
+        """Test the live table renders rows in region/AD/FD order."""
+        from rich.console import Console
+        console = Console(file=io.StringIO(), width=200)
+        query = scanner.ShapeQuery('TestShape', None, None)
+        writer = output.create_writer('table', console, None, [query])
+        for order, result in self.RESULTS:
+            writer.write(order, result)
+        writer.close()
+
+        text = console.file.getvalue()
+        assert text.index('FD-1') < text.index('FD-2')
+
+    def test_format_argument(self):
+        """Test -format is parsed."""
+        with mock.patch.object(sys, 'argv', ['ocareport.py', '-shape', 'TestShape', '-format', 'jsonl']):
+            args = ocareport.parse_arguments()
+            assert args.output_format == 'jsonl'
+
+
 class TestMain:
     """Tests for main function."""
 
@@ -294,6 +2103,368 @@ class TestMain:
         assert callable(ocareport.main)
 
 
+class TestStartup:
+    """Startup cost of the CLI, measured in fresh interpreters."""
+
+    # Extra wall time allowed over a bare interpreter; the full SDK import alone is well above it
+    BUDGET = 0.25
+
+    @staticmethod
+    def run_python(*arguments):
+        return subprocess.run([sys.executable] + list(arguments), capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(ocareport.__file__)))
+
+    def test_argument_parsing_skips_sdk_and_rich(self):
+        """Test parsing arguments and printing help load neither the OCI SDK nor rich."""
+        process = self.run_python('-c', (
+            "import sys; sys.argv = ['ocareport.py', '-shape', 'VM.Standard.E5.Flex', '-ocpus', '1:4'];"
+            "import ocareport; ocareport.parse_arguments(); ocareport.parse_query_arguments(['-shape', 'X']);"
+            "print(sorted({name.split('.')[0] for name in sys.modules} & {'oci', 'rich'}))"
+        ))
+
+        assert process.returncode == 0, process.stderr
+        assert process.stdout.strip() == '[]'
+
+    def test_profile_all_skips_sdk(self, tmp_path):
+        """Test expanding -profile ALL from the config file does not load the OCI SDK."""
+        config = tmp_path / 'config'
+        config.write_text('[DEFAULT]\ntenancy=ocid1.tenancy..a\n[PROD]\ntenancy=ocid1.tenancy..b\n')
+        process = self.run_python('-c', (
+            f"import sys; sys.argv = ['ocareport.py', '-shape', 'X', '-profile', 'ALL', '-config_file', {str(config)!r}];"
+            "import ocareport; print(ocareport.parse_arguments().profiles, 'oci' in sys.modules)"
+        ))
+
+        assert process.returncode == 0, process.stderr
+        assert process.stdout.strip() == "['DEFAULT', 'PROD'] False"
+
+    def test_create_capacity_report_still_importable(self):
+        """Test the lazily imported function is still reachable from the script module."""
+        assert ocareport.create_capacity_report is scanner.create_capacity_report
+
+    def test_help_within_budget(self):
+        """Test --help stays within the startup budget over a bare interpreter."""
+        def fastest(*arguments):
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                assert self.run_python(*arguments).returncode == 0
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        assert fastest('ocareport.py', '--help') - fastest('-c', 'pass') < self.BUDGET
+
+
+class TestFakeEndpoint:
+    """End-to-end scans through the real SDK against the local fake OCI endpoint."""
+
+    @pytest.fixture
+    def fake(self, tmp_path, monkeypatch):
+        from benchmarks import bench_scan, fake_oci
+        with fake_oci.FakeOCI(regions=2, ads=2, fds=2) as server:
+            monkeypatch.setenv('OCAREPORT_ENDPOINT_TEMPLATE', server.endpoint_template)
+            server.config_path = bench_scan.write_config(str(tmp_path), server)
+            yield server
+
+    def run(self, fake, capsys, *extra):
+        argv = ['ocareport.py', '-auth', 'cf', '-config_file', fake.config_path, '-region', 'all',
+                '-format', 'jsonl', '-shape', 'VM.Standard.E4.Flex'] + list(extra)
+        with mock.patch.object(sys, 'argv', argv):
+            ocareport.main()
+        captured = capsys.readouterr()
+        self.err = captured.err
+        return [json.loads(line) for line in captured.out.splitlines()]
+
+    def test_full_sweep(self, fake, capsys):
+        """Test a -region all sweep returns every location and lists the topology once."""
+        rows = self.run(fake, capsys)
+
+        assert len(rows) == 8
+        assert {row['region'] for row in rows} == {'us-ashburn-1', 'us-phoenix-1'}
+        assert {row['status'] for row in rows} <= {'AVAILABLE', 'OUT_OF_HOST_CAPACITY'}
+        stats = fake.stats()
+        assert stats['ListAvailabilityDomains'] == 2
+        assert stats['ListFaultDomains'] == 4
+        assert stats['CreateComputeCapacityReport'] == 4
+
+    def test_cached_topology_sweep(self, fake, capsys):
+        """Test a second sweep reuses the cached topology and gets the same answers."""
+        first = self.run(fake, capsys)
+        fake.reset_stats()
+        second = self.run(fake, capsys)
+
+        def statuses(rows):
+            return {(row['region'], row['availability_domain'], row['fault_domain']): row['status'] for row in rows}
+        assert statuses(second) == statuses(first)
+        assert 'ListFaultDomains' not in fake.stats()
+        assert fake.stats()['CreateComputeCapacityReport'] == 4
+
+    def test_probe_finds_free_capacity(self, fake, capsys):
+        """Test -probe reports the largest config that fits each FD's free capacity."""
+        rows = self.run(fake, capsys, '-probe', '-ocpus', '1:128', '-memory', '8:8192:8')
+
+        assert len(rows) == 8
+        for row in rows:
+            free = fake.topology.free_capacity(row['region'], row['availability_domain'],
+                                               row['fault_domain'], row['shape'])
+            if row['status'] == 'AVAILABLE':
+                assert row['ocpus'] == min(free[0], 128)
+                assert row['memory'] == free[1]
+            else:
+                assert free is None or free[1] < 8
+        assert fake.stats()['CreateComputeCapacityReport'] <= 4 * 6
+
+    def test_deadline_keeps_partial_results(self, fake, capsys):
+        """Test a slow region is reported as TIMEOUT while the other region's rows are kept."""
+        fake.slow_regions['us-phoenix-1'] = 3
+        start = time.monotonic()
+        with pytest.raises(SystemExit):
+            self.run(fake, capsys, '-deadline', '1')
+        elapsed = time.monotonic() - start
+        out, err = capsys.readouterr()
+        rows = [json.loads(line) for line in out.splitlines()]
+
+        assert elapsed < 2.5
+        assert {row['status'] for row in rows if row['region'] == 'us-phoenix-1'} == {'TIMEOUT'}
+        ashburn = [row for row in rows if row['region'] == 'us-ashburn-1']
+        assert len(ashburn) == 4
+        assert {row['status'] for row in ashburn} <= {'AVAILABLE', 'OUT_OF_HOST_CAPACITY'}
+        assert 'Deadline' in err
+
+    def test_deadline_ends_the_process(self, fake):
+        """Test the CLI exits at its deadline even with listings of a slow region still in flight."""
+        fake.slow_regions['us-phoenix-1'] = 5
+        argv = [sys.executable, 'ocareport.py', '-auth', 'cf', '-config_file', fake.config_path, '-region', 'all',
+                '-format', 'jsonl', '-shape', 'VM.Standard.E4.Flex', '-deadline', '1', '-no-history']
+        start = time.monotonic()
+        process = subprocess.run(argv, capture_output=True, text=True, timeout=60,
+                                 cwd=os.path.dirname(os.path.abspath(ocareport.__file__)))
+        elapsed = time.monotonic() - start
+        rows = [json.loads(line) for line in process.stdout.splitlines()]
+
+        assert process.returncode == 1, process.stderr
+        assert {row['status'] for row in rows if row['region'] == 'us-phoenix-1'} == {'TIMEOUT'}
+        assert elapsed < 4
+
+    def test_hedged_sweep(self, fake, capsys):
+        """Test -hedge duplicates reports past the recorded p95, keeps one row per location and reports it."""
+        recorded = metrics.Metrics()
+        for region in ('us-ashburn-1', 'us-phoenix-1'):
+            recorded.record(region, 'POST computeCapacityReports', 0.05, 200)
+        metrics.record_latencies(recorded)
+        fake.stall_rate, fake.stall = 1.0, 0.3
+
+        argv = ['ocareport.py', '-auth', 'cf', '-config_file', fake.config_path, '-region', 'all',
+                '-format', 'jsonl', '-shape', 'VM.Standard.E4.Flex', '-hedge', '100']
+        with mock.patch.object(sys, 'argv', argv):
+            ocareport.main()
+        out, err = capsys.readouterr()
+        rows = [json.loads(line) for line in out.splitlines()]
+
+        assert len({(row['region'], row['availability_domain'], row['fault_domain']) for row in rows}) == len(rows) == 8
+        assert 'Hedging: 4 of 4 capacity report calls hedged' in err
+
+    def test_library_scanner_reuses_login(self, fake, capsys):
+        """Test CapacityScanner scans twice on one login, listing regions and topology once, printing nothing."""
+        capacity = api.CapacityScanner.login(auth='cf', config_file=fake.config_path)
+        first = list(capacity.scan(['VM.Standard.E4.Flex'], region='all'))
+        second = list(capacity.scan(['VM.Standard.E4.Flex'], region='all', first=1))
+
+        assert len(first) == 8
+        assert all(isinstance(result, scanner.CapacityResult) for result in first)
+        assert [result.status for result in second].count('AVAILABLE') <= 1
+        stats = fake.stats()
+        assert stats['ListRegionSubscriptions'] == 1
+        assert stats['ListFaultDomains'] == 4
+        assert capsys.readouterr() == ('', '')
+        assert ocareport.CapacityScanner is api.CapacityScanner
+
+    def test_sharded_scan_matches_full_sweep(self, fake, capsys, tmp_path):
+        """Test plan, two shards and merge give every location once, listing the topology only in the plan."""
+        auth = ['-auth', 'cf', '-config_file', fake.config_path]
+        with mock.patch.object(sys, 'argv', ['ocareport.py', 'plan', '-region', 'all',
+                                             '-shape', 'VM.Standard.E4.Flex'] + auth):
+            ocareport.main()
+        units = tmp_path / 'units.jsonl'
+        units.write_text(capsys.readouterr().out)
+        fake.reset_stats()
+
+        outputs = []
+        for index in (1, 2):
+            argv = ['ocareport.py', '-units', str(units), '-shard', f'{index}/2', '-format', 'jsonl'] + auth
+            with mock.patch.object(sys, 'argv', argv):
+                ocareport.main()
+            outputs.append(tmp_path / f'shard-{index}.jsonl')
+            outputs[-1].write_text(capsys.readouterr().out)
+        assert fake.stats()['CreateComputeCapacityReport'] == 4
+        assert not [operation for operation in fake.stats() if operation.startswith('List')]
+
+        with mock.patch.object(sys, 'argv', ['ocareport.py', 'merge', '-units', str(units), '-format', 'jsonl']
+                               + [str(path) for path in outputs]):
+            ocareport.main()
+        rows = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert len(rows) == 8
+        assert len({(row['region'], row['availability_domain'], row['fault_domain']) for row in rows}) == 8
+
+        with pytest.raises(SystemExit):
+            with mock.patch.object(sys, 'argv', ['ocareport.py', 'merge', '-units', str(units), str(outputs[0])]):
+                ocareport.main()
+        assert 'planned locations have no row' in capsys.readouterr().out
+
+    def test_single_profile_shard_of_two_tenancy_plan(self, fake, capsys, tmp_path):
+        """Test a shard logging in to one profile of a two-tenancy plan tags its rows and merges without gaps."""
+        auth = ['-auth', 'cf', '-config_file', fake.config_path]
+        with mock.patch.object(sys, 'argv', ['ocareport.py', 'plan', '-region', 'all',
+                                             '-shape', 'VM.Standard.E4.Flex'] + auth):
+            ocareport.main()
+        path = tmp_path / 'units.jsonl'
+        path.write_text(capsys.readouterr().out)
+        # A second tenancy whose profile is missing from the config file, so it fails to log in
+        own = shard.load_units(str(path))
+        other = [unit._replace(profile='OTHER', tenancy='other') for unit in own]
+        with open(path, 'w') as f:
+            shard.write_units(own + other, f)
+        fake.reset_stats()
+
+        argv = ['ocareport.py', '-units', str(path), '-format', 'jsonl'] + auth
+        with mock.patch.object(sys, 'argv', argv):
+            ocareport.main()
+        output = tmp_path / 'shard.jsonl'
+        output.write_text(capsys.readouterr().out)
+
+        # Units of the profile that failed are left out, not scanned in the other tenancy
+        assert len(output.read_text().splitlines()) == len(own)
+        assert fake.stats()['CreateComputeCapacityReport'] == 4
+        rows, missing = shard.merge_results([str(output)], shard.load_units(str(path)))
+        assert len(rows) == len(own)
+        assert {result.tenancy for _, result in rows} == {own[0].tenancy}
+        assert missing == other
+
+    def test_dry_run_sends_no_capacity_report(self, fake, capsys):
+        """Test -dry-run lists and caches the topology, estimates the reports and sends none."""
+        estimates = {row['strategy']: row for row in self.run(fake, capsys, '-dry-run')}
+
+        assert 'CreateComputeCapacityReport' not in fake.stats()
+        assert fake.stats()['ListFaultDomains'] == 4
+        assert estimates['scan']['calls'] == {'POST computeCapacityReports': 4}
+        assert estimates['-catalog']['calls'] == {'GET shapes': 2, 'POST computeCapacityReports': 4}
+
+        fake.reset_stats()
+        self.run(fake, capsys)
+        assert fake.stats()['CreateComputeCapacityReport'] == 4
+        assert 'ListFaultDomains' not in fake.stats()
+        recorded = metrics.read_latencies()
+        assert {region for region, operation in recorded if operation == 'POST computeCapacityReports'} == \
+            {'us-ashburn-1', 'us-phoenix-1'}
+
+    def test_metrics_file(self, fake, capsys, tmp_path):
+        """Test -metrics records every API call of the scan, by region and operation."""
+        path = tmp_path / 'metrics.json'
+        self.run(fake, capsys, '-metrics', str(path))
+
+        data = json.loads(path.read_text())
+        assert set(data['stages']) == {'auth', 'regions', 'scan'}
+        assert data['operations']['POST computeCapacityReports']['calls'] == 4
+        assert data['operations']['GET faultDomains']['calls'] == 4
+        assert set(data['regions']) == {'us-ashburn-1', 'us-phoenix-1'}
+
+    def test_scan_recorded_in_history(self, fake, capsys, tmp_path):
+        """Test each sweep appends its rows to the history file as one scan."""
+        path = str(tmp_path / 'history.sqlite')
+        rows = self.run(fake, capsys, '-history', path)
+        self.run(fake, capsys, '-history', path)
+
+        with history.connect(path) as connection:
+            summary = history.query_history(connection, 'VM.Standard.E4.Flex', group_by='region')
+        assert sum(row['checks'] for row in summary) == 2 * len(rows)
+        assert {row['scans'] for row in summary} == {2}
+
+    def test_catalog_skips_regions_without_shape(self, fake, capsys):
+        """Test -catalog answers unoffered GPU shapes without capacity report calls."""
+        fake.topology.regions['us-phoenix-1']['shapes'] = ['BM.GPU.H100.8']
+        fake.topology.regions['us-ashburn-1']['shapes'] = ['VM.Standard.E4.Flex']
+        rows = self.run(fake, capsys, '-catalog', '-shape', 'BM.GPU.H100.8')
+
+        assert [row['status'] for row in rows if row['region'] == 'us-ashburn-1'] == ['HARDWARE_NOT_SUPPORTED']
+        assert len([row for row in rows if row['region'] == 'us-phoenix-1']) == 4
+        assert fake.stats()['ListShapes'] == 2
+        assert fake.stats()['CreateComputeCapacityReport'] == 2
+
+    def test_catalog_rejects_unknown_shape(self, fake, capsys):
+        """Test -catalog stops before scanning when no region offers a shape."""
+        with pytest.raises(SystemExit):
+            self.run(fake, capsys, '-catalog', '-shape', 'VM.Standard.E4.Flx')
+
+        assert 'VM.Standard.E4.Flex' in capsys.readouterr().err
+        assert 'CreateComputeCapacityReport' not in fake.stats()
+
+    def test_catalog_failure_scans_in_full(self, fake, capsys):
+        """Test a region whose ListShapes call fails is scanned in full rather than ending the run."""
+        fake.failing.add('ListShapes')
+        rows = self.run(fake, capsys, '-catalog')
+
+        assert len(rows) == 8
+        assert {row['region'] for row in rows} == {'us-ashburn-1', 'us-phoenix-1'}
+        assert 'Internal server error' in self.err and 'scanned in full' in self.err
+        assert fake.stats()['CreateComputeCapacityReport'] == 4
+
+    def test_service_coalesces_and_caches(self, fake, capsys):
+        """Test the serve mode answers concurrent identical requests with one scan, then from cache."""
+        argv = ['-auth', 'cf', '-config_file', fake.config_path, '-port', '0', '-cache-ttl', '60']
+        server = ocareport.create_service(ocareport.parse_serve_arguments(argv), metrics.Metrics())
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = 'http://{}:{}/capacity?shape=VM.Standard.E4.Flex&region=all'.format(*server.server_address[:2])
+        fake.reset_stats()
+        fake.latency = 0.2
+        try:
+            answers = []
+            clients = [threading.Thread(target=lambda: answers.append(json.load(urllib.request.urlopen(url))))
+                       for _ in range(4)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join(10)
+            cached = json.load(urllib.request.urlopen(url))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert len(answers) == 4
+        assert sorted(answer['source'] for answer in answers).count('miss') == 1
+        assert cached['source'] == 'hit'
+        assert len(cached['results']) == 8
+        assert fake.stats()['CreateComputeCapacityReport'] == 4
+
+    def test_several_profiles(self, fake, capsys):
+        """Test several profiles are scanned in one run, rows tagged with their tenancy."""
+        with open(fake.config_path) as f:
+            default = f.read()
+        with open(fake.config_path, 'a') as f:
+            f.write(default.replace('[DEFAULT]', '[SECOND]').replace(fake.tenancy_id, fake.tenancy_id + '2'))
+
+        rows = self.run(fake, capsys, '-profile', 'ALL')
+
+        assert len(rows) == 2 * 8
+        assert {row['tenancy'] for row in rows} == {'benchmark', 'benchmark2'}
+        assert fake.stats()['CreateComputeCapacityReport'] == 2 * 4
+
+    def test_since_rechecks_only_unsettled_locations(self, fake, capsys, tmp_path):
+        """Test -since carries settled rows and asks again only for ADs with other statuses."""
+        path = tmp_path / 'results.jsonl'
+        first = self.run(fake, capsys)
+        path.write_text(''.join(json.dumps(row) + '\n' for row in first))
+        unsettled = {(row['region'], row['availability_domain']) for row in first if row['status'] != 'AVAILABLE'}
+        fake.reset_stats()
+
+        rows = self.run(fake, capsys, '-since', str(path))
+
+        carried = [row for row in rows if 'age_s' in row]
+        assert len(rows) == len(first)
+        assert len(carried) == sum(row['status'] == 'AVAILABLE' for row in first)
+        assert fake.stats().get('CreateComputeCapacityReport', 0) == len(unsettled)
+        assert 'ListFaultDomains' not in fake.stats()
+
+
 class TestFlexShapeDetection:
     """Tests for flex shape detection logic."""
 